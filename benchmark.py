@@ -0,0 +1,400 @@
+"""
+Benchmark: A utility to measure the performance of every tracking mode on
+deterministic synthetic sequences, without any webcam or window.
+"""
+
+from contextlib import redirect_stdout
+import tracemalloc
+import argparse
+import tempfile
+import shutil
+import json
+import sys
+import time
+import io
+import os
+
+import numpy as np
+import cv2
+
+from src.pixel_tracking import PixelTracker
+from src.poi_identifying import PoiIdentifier
+from src.poi_tracker import PoiTracker
+from src.synthetic import SyntheticCapture
+from src.frame_buffers import FrameBuffers
+from src.lk_scheduler import LKScheduler
+from src.motion_predictor import MotionPredictor
+from src.detector import Detector
+from limits.photographer import Photographer
+from limits.matcher import PhotographsMatcher
+from limits.relocalizer import Relocalizer
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+class Benchmark:
+
+    MODES = ['pixel', 'poi', 'prediction', 'identify', 'matcher', 'detect']
+
+    def __init__(self, n_frames=300, width=640, height=480, n_poi=10, win_size=15, max_level=2, n_references=5,
+                 lk_budget=None, detect_downscales=(1, 2, 4), relocalize=None, speed=2.0, predict=False):
+        """
+        Initialize the Benchmark object.
+
+        Parameters:
+        - n_frames: Number of frames of each synthetic sequence.
+        - width, height: Size of the synthetic frames (the matcher always works on 640x480 frames).
+        - n_poi: Number of points of interest seeded by the POI modes.
+        - win_size: Size of the Lucas-Kanade search window.
+        - max_level: Number of pyramid levels of Lucas-Kanade.
+        - n_references: Number of reference photographs of the matcher.
+        - lk_budget: Frame-time budget of an LKScheduler adapting the Lucas-Kanade parameters,
+          in seconds (None to keep them fixed).
+        - detect_downscales: Downscale factors at which the detection backends are compared.
+        - relocalize: Descriptor of a Relocalizer shortlisting the photographs of the matcher
+          ('orb', None to match every photograph).
+        - speed: Speed of the synthetic motions, in pixels per frame.
+        - predict: Boolean indicating whether the pixel and POI trackers start Lucas-Kanade from
+          the positions predicted by a MotionPredictor.
+        """
+        self.n_frames = n_frames
+        self.width = width
+        self.height = height
+        self.n_poi = n_poi
+        self.win_size = win_size
+        self.max_level = max_level
+        self.n_references = n_references
+        self.lk_budget = lk_budget
+        self.detect_downscales = list(detect_downscales)
+        self.relocalize = relocalize
+        self.speed = speed
+        self.predict = predict
+
+    @property
+    def config(self):
+        """
+        Configuration of the benchmark, reported along with its results.
+        """
+        return dict(n_frames=self.n_frames, width=self.width, height=self.height, n_poi=self.n_poi,
+                    win_size=self.win_size, max_level=self.max_level, n_references=self.n_references,
+                    lk_budget=self.lk_budget, detect_downscales=self.detect_downscales, relocalize=self.relocalize,
+                    speed=self.speed, predict=self.predict)
+
+    @property
+    def roi(self):
+        """
+        Zone in which points of interest are seeded: the central half of the frame.
+        """
+        return (self.width // 4, self.height // 4), (3 * self.width // 4, 3 * self.height // 4)
+
+    def configure(self, tracker):
+        """
+        Apply the benchmarked Lucas-Kanade parameters to a tracker, or the scheduler adapting them,
+        and the motion predictor.
+        The dictionary is updated in place, as the tracker's flow cache shares it.
+        """
+        tracker.lk_params.update(winSize=(self.win_size, self.win_size), maxLevel=self.max_level)
+        if self.lk_budget is not None:
+            tracker.flow.scheduler = LKScheduler(self.lk_budget)
+        if self.predict and hasattr(tracker, 'predictor'):
+            tracker.predictor = MotionPredictor()
+        return tracker
+
+    @staticmethod
+    def percentiles(latencies):
+        """
+        Summarize latencies, given in seconds, as milliseconds percentiles.
+        """
+        latencies = np.asarray(latencies) * 1e3
+        if latencies.size == 0:
+            return dict(mean=None, p50=None, p90=None, p99=None)
+        return dict(mean=float(latencies.mean()),
+                    p50=float(np.percentile(latencies, 50)),
+                    p90=float(np.percentile(latencies, 90)),
+                    p99=float(np.percentile(latencies, 99)))
+
+    def run(self, capture, step, errors):
+        """
+        Run a tracker on a synthetic sequence and measure it.
+
+        Parameters:
+        - capture: SyntheticCapture feeding the tracker.
+        - step: Function processing one frame, called with (frame, t).
+        - errors: Function returning the tracking errors in pixels on frame t and the number
+          of lost points, called with (t) after each step.
+
+        Returns:
+        - Dictionary of measurements.
+        """
+        read, process, tracking_errors = [], [], []
+        buffers = FrameBuffers()
+        lost = 0
+        tracemalloc.start()
+        start_time = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            for t in range(capture.n_frames):
+                t0 = time.perf_counter()
+                _, frame = buffers.read(capture)
+                t1 = time.perf_counter()
+                step(frame, t)
+                t2 = time.perf_counter()
+                read.append(t1 - t0)
+                process.append(t2 - t1)
+                frame_errors, lost = errors(t)
+                if frame_errors is not None and len(frame_errors):
+                    tracking_errors.append(float(np.mean(frame_errors)))
+        elapsed = time.perf_counter() - start_time
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        max_rss = None
+        if resource is not None:
+            # ru_maxrss is in kilobytes on Linux
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        return dict(frames=capture.n_frames,
+                    fps=capture.n_frames / max(elapsed, 1e-9),
+                    latency_ms=dict(read=self.percentiles(read), process=self.percentiles(process)),
+                    peak_memory_mb=dict(traced=peak / 2 ** 20, max_rss=max_rss),
+                    error_px=dict(mean=float(np.mean(tracking_errors)) if tracking_errors else None,
+                                  final=tracking_errors[-1] if tracking_errors else None),
+                    lost=lost)
+
+    def capture(self, motion, width=None, height=None):
+        """
+        Create the synthetic sequence of a motion.
+        """
+        return SyntheticCapture(motion, self.n_frames, width or self.width, height or self.height, speed=self.speed)
+
+    def pixel(self, motion):
+        """
+        Benchmark PixelTracker on a pixel selected at the center of the first frame.
+        """
+        capture = self.capture(motion)
+        tracker = self.configure(PixelTracker(capture, headless=True))
+        tracker.select_point(cv2.EVENT_LBUTTONDOWN, self.width // 2, self.height // 2, 0, None)
+        seed = tracker.old_point.copy()
+
+        def errors(t):
+            if not tracker.point_selected:
+                return None, 1
+            return np.linalg.norm(tracker.old_point.reshape(-1, 2) - capture.map_points(seed, 0, t), axis=1), 0
+
+        return self.run(capture, lambda frame, t: tracker.process(frame), errors)
+
+    def poi(self, motion):
+        """
+        Benchmark PoiTracker on points of interest seeded in the central zone of the first frame.
+        """
+        capture = self.capture(motion)
+        tracker = self.configure(PoiTracker(capture, self.n_poi, headless=True))
+        tracker.rect_start, tracker.rect_end = self.roi
+        seeds = {}
+
+        def errors(t):
+            if tracker.tracking_points is None:
+                return None, 0
+            if 'points' not in seeds:
+                seeds['points'] = tracker.tracking_points.copy()
+            live = ~tracker.lost
+            truth = capture.map_points(seeds['points'][live], 0, t)
+            return np.linalg.norm(tracker.tracking_points[live].reshape(-1, 2) - truth, axis=1), int(tracker.lost.sum())
+
+        return self.run(capture, lambda frame, t: tracker.process(frame), errors)
+
+    def poi_in_view(self, motion, predict):
+        """
+        Run PoiTracker with or without a MotionPredictor, counting the points lost while their
+        true position is still in the frame (the points leaving the frame are lost either way).
+        """
+        capture = self.capture(motion)
+        tracker = self.configure(PoiTracker(capture, self.n_poi, headless=True))
+        tracker.predictor = MotionPredictor() if predict else None
+        tracker.rect_start, tracker.rect_end = self.roi
+        slots = {}
+
+        def errors(t):
+            if tracker.tracking_points is None:
+                return None, 0
+            points = tracker.tracking_points.reshape(-1, 2)
+            if not slots:
+                slots.update(seeds=points.copy(), born=np.zeros(len(points), dtype=int),
+                             lost=tracker.lost.copy(), count=0)
+            # The replenished slots hold new points, seen from this frame on
+            reborn = slots['lost'] & ~tracker.lost
+            slots['seeds'][reborn], slots['born'][reborn] = points[reborn], t
+            truth = np.vstack([capture.map_points(seed, born, t)
+                               for seed, born in zip(slots['seeds'], slots['born'])])
+            margin = self.win_size
+            inside = ((truth >= margin) & (truth < (self.width - margin, self.height - margin))).all(axis=1)
+            slots['count'] += int((~slots['lost'] & tracker.lost & inside).sum())
+            slots['lost'] = tracker.lost.copy()
+            live = ~tracker.lost
+            return np.linalg.norm(points[live] - truth[live], axis=1), slots['count']
+
+        return self.run(capture, lambda frame, t: tracker.process(frame), errors)
+
+    def prediction(self, motion):
+        """
+        Benchmark PoiTracker with a MotionPredictor against PoiTracker alone on the same sequence,
+        and warn if the prediction does not keep more points when some are lost without it.
+        """
+        plain = self.poi_in_view(motion, False)
+        result = self.poi_in_view(motion, True)
+        if plain['lost'] > 0 and result['lost'] >= plain['lost']:
+            # On stderr, so that the JSON report printed on stdout stays valid
+            print(f"Warning: on {motion}, the motion predictor lost {result['lost']} points in view, "
+                  f"{plain['lost']} without it.", file=sys.stderr)
+        return dict(result, lost_without_prediction=plain['lost'])
+
+    def identify(self, motion):
+        """
+        Benchmark PoiIdentifier.generate_poi, run on every frame.
+        """
+        capture = self.capture(motion)
+        tracker = PoiIdentifier(capture, self.n_poi, headless=True)
+        tracker.rect_start, tracker.rect_end = self.roi
+        return self.run(capture,
+                        lambda frame, t: setattr(tracker, 'tracking_points', tracker.generate_poi(frame)),
+                        lambda t: (None, 0))
+
+    def matcher(self, motion):
+        """
+        Benchmark PhotographsMatcher against reference photographs taken from the sequence itself,
+        each with the strongest corner of its central zone as clicked point.
+        """
+        capture = self.capture(motion, 640, 480)
+        folder = tempfile.mkdtemp()
+        try:
+            photographer = Photographer(capture, os.path.join(folder, 'benchmark'))
+            references = np.linspace(0, self.n_frames - 1, self.n_references).astype(int)
+            (x_min, y_min), (x_max, y_max) = (160, 120), (480, 360)
+            for t in references:
+                frame = capture.render(t)
+                gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                corner = cv2.goodFeaturesToTrack(gray_frame[y_min:y_max, x_min:x_max], 1, 0.01, 10)
+                photographer.dataset.append(frame, corner.reshape(2) + (x_min, y_min))
+            tracker = self.configure(PhotographsMatcher(capture, photographer, cache=False, headless=True))
+            if self.relocalize is not None:
+                tracker.relocalizer = Relocalizer(self.relocalize)
+            clicks = tracker.points.reshape(-1, 2)
+
+            def errors(t):
+                truth = np.vstack([capture.map_points(clicks[i], r, t) for i, r in enumerate(references)])
+                found = ~np.isnan(tracker.matched[:, 0])
+                return np.linalg.norm(tracker.matched[found] - truth[found], axis=1), int((~found).sum())
+
+            result = self.run(capture, lambda frame, t: tracker.process(frame), errors)
+            tracker.pool.shutdown()
+            return result
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def detect(self, motion):
+        """
+        Benchmark every detection backend, at every downscale factor and with or without sub-pixel refinement,
+        on the central zone of ten frames of the sequence: time per detection, repeatability (share of the
+        corners of the first frame detected again within 2 pixels of where the motion takes them)
+        and localization error of the repeated corners.
+        """
+        capture = self.capture(motion)
+        (x_min, y_min), (x_max, y_max) = self.roi
+        offset = np.array([x_min, y_min], dtype=np.float32)
+        frames = np.unique(np.linspace(0, self.n_frames - 1, 10).astype(int))
+        grays = [cv2.cvtColor(capture.render(t)[y_min:y_max, x_min:x_max], cv2.COLOR_BGR2GRAY) for t in frames]
+        detectors = []
+        for method in Detector.METHODS:
+            for downscale in self.detect_downscales:
+                for refine in [False, True]:
+                    detector = Detector(method, downscale=downscale, refine=refine)
+                    latencies, corners = [], []
+                    for gray_frame in grays:
+                        start_time = time.perf_counter()
+                        corners.append(detector.detect(gray_frame, self.n_poi).reshape(-1, 2) + offset)
+                        latencies.append(time.perf_counter() - start_time)
+                    repeatability, localization = [], []
+                    for t, found in zip(frames[1:], corners[1:]):
+                        expected = capture.map_points(corners[0], frames[0], t)
+                        # Corners the motion takes out of the zone cannot be detected again
+                        inside = ((expected >= offset + 4) & (expected < np.array([x_max, y_max]) - 4)).all(axis=1)
+                        expected = expected[inside]
+                        if len(expected) == 0 or len(found) == 0:
+                            continue
+                        distances = np.linalg.norm(expected[:, None] - found[None], axis=2).min(axis=1)
+                        repeated = distances < 2
+                        repeatability.append(float(repeated.mean()))
+                        localization += distances[repeated].tolist()
+                    detectors.append(dict(method=method, downscale=downscale, refine=refine,
+                                          corners=float(np.mean([len(found) for found in corners])),
+                                          latency_ms=self.percentiles(latencies),
+                                          repeatability=float(np.mean(repeatability)) if repeatability else None,
+                                          localization_px=float(np.mean(localization)) if localization else None))
+        return dict(detectors=detectors)
+
+    def main(self, modes=None, motions=None):
+        """
+        Run every requested mode on every requested motion.
+
+        Parameters:
+        - modes: List of modes among 'pixel', 'poi', 'prediction', 'identify', 'matcher' and 'detect' (defaults to all).
+        - motions: List of motions of the synthetic sequences (defaults to all).
+
+        Returns:
+        - Dictionary with the configuration and the results, ready to be dumped as JSON.
+        """
+        results = []
+        for mode in modes or self.MODES:
+            for motion in motions or SyntheticCapture.MOTIONS:
+                result = getattr(self, mode)(motion)
+                results.append(dict(mode=mode, motion=motion, **result))
+        return dict(config=self.config, opencv=cv2.__version__, results=results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('--frames', type=int, default=300,
+                        help='Number of frames of each synthetic sequence')
+    parser.add_argument('--width', type=int, default=640,
+                        help='Width of the synthetic frames')
+    parser.add_argument('--height', type=int, default=480,
+                        help='Height of the synthetic frames')
+    parser.add_argument('--n_poi', type=int, default=10,
+                        help='Number of Points Of Interest')
+    parser.add_argument('--win_size', type=int, default=15,
+                        help='Size of the Lucas-Kanade search window')
+    parser.add_argument('--max_level', type=int, default=2,
+                        help='Number of pyramid levels of Lucas-Kanade')
+    parser.add_argument('--n_references', type=int, default=5,
+                        help='Number of reference photographs of the matcher')
+    parser.add_argument('--relocalize', type=str, default=None, choices=Relocalizer.METHODS,
+                        help='Shortlist the reference photographs of the matcher with these binary descriptors')
+    parser.add_argument('--lk_budget', type=float, default=None,
+                        help='Adapt the Lucas-Kanade parameters to the motion within this frame-time budget, in ms')
+    parser.add_argument('--detect_downscales', type=str, default='1,2,4',
+                        help='Comma-separated downscale factors at which the detection backends are compared')
+    parser.add_argument('--modes', type=str, default=','.join(Benchmark.MODES),
+                        help='Comma-separated modes to benchmark (pixel, poi, prediction, identify, matcher, detect)')
+    parser.add_argument('--motions', type=str, default=','.join(SyntheticCapture.MOTIONS),
+                        help='Comma-separated motions of the synthetic sequences '
+                             '(translate, rotate, brightness, occlude)')
+    parser.add_argument('--speed', type=float, default=2.0,
+                        help='Speed of the synthetic motions, in pixels per frame')
+    parser.add_argument('--predict', action='store_true',
+                        help='Start Lucas-Kanade from the positions predicted by a constant-velocity Kalman filter')
+    parser.add_argument('--out', type=str, default=None,
+                        help='Path of the JSON report (printed if not given)')
+    args = parser.parse_args()
+
+    lk_budget = None if args.lk_budget is None else args.lk_budget / 1e3
+    detect_downscales = [int(factor) for factor in args.detect_downscales.split(',')]
+    report = Benchmark(n_frames=args.frames, width=args.width, height=args.height, n_poi=args.n_poi,
+                       win_size=args.win_size, max_level=args.max_level, n_references=args.n_references,
+                       lk_budget=lk_budget, detect_downscales=detect_downscales,
+                       relocalize=args.relocalize, speed=args.speed,
+                       predict=args.predict).main(args.modes.split(','), args.motions.split(','))
+    if args.out is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.out, 'w') as file:
+            json.dump(report, file, indent=2)
@@ -1,37 +1,59 @@
+import argparse
+import json
+import time
+
 import numpy as np
 import cv2
-import time
+
+from src.flow_cache import FlowCache
+from src.frame_buffers import FrameBuffers
+from src.illumination import IlluminationNormalizer
+from src.renderer import Renderer
+from src.synthetic import SyntheticCapture
 
 
 class Pixel_Light_Test:
     """
-    This class is used to run tests on the effect of light variance on LK methods. 
+    This class is used to run tests on the effect of light variance on LK methods.
 
-    The results: even small changes in light (overall brightness), if they happen quickly, will shift the points around. 
+    The results: even small changes in light (overall brightness), if they happen quickly, will shift the points around.
     If the changes are gradual, the pixels are much more likely to stay (or barely move).
+    An IlluminationNormalizer applied to the grayscale frames before LK compensates most of the change.
     """
 
-    def __init__(self):
+    def __init__(self, camera=0, headless=False, illumination=None):
         """
         Initialize the Pixel_Light_Test object.
 
-        Parameters: none
+        Parameters:
+        - camera: Index of the camera to use for the interactive study, or an opened capture.
+        - headless: Boolean indicating whether to run without any window (for the benchmark).
+        - illumination: Optional IlluminationNormalizer applied to the grayscale frames before LK.
         """
-        self.camera = 0
+        self.camera = camera
         self.point_selected = False
         self.point = None
         self.old_point = None
-        self.old_frame = None
+        self.illumination = illumination
 
         #self.cap = cv2.VideoCapture(self.camera, cv2.CAP_DSHOW)
-        self.cap = cv2.VideoCapture(self.camera)
-        if not self.cap.isOpened():
-            print("Camera not opened")
-        cv2.namedWindow('Frame')
-        cv2.setMouseCallback('Frame', self.select_point)
+        self.cap = None
+        if not headless:
+            self.cap = cv2.VideoCapture(self.camera) if isinstance(self.camera, int) else self.camera
+            if not self.cap.isOpened():
+                print("Camera not opened")
+            cv2.namedWindow('Frame')
+            cv2.setMouseCallback('Frame', self.select_point)
         self.lk_params = dict(winSize=(15, 15),
                               maxLevel=2,
                               criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+        self.flow = FlowCache(self.lk_params)
+        self.renderer = Renderer()
+        self.buffers = FrameBuffers()
+
+        # Lookup table of the simulated brightness change, reused by every frame
+        self.ramp = np.arange(256, dtype=np.float32)
+        self.lut = np.empty(256, dtype=np.uint8)
 
     def select_point(self, event, x, y, flags, param):
         """
@@ -48,19 +70,55 @@ class Pixel_Light_Test:
             self.point_selected = True
             self.old_point = np.array([[x, y]], dtype=np.float32)
 
+    def change_brightness(self, frame, coeff):
+        """
+        Simulate a change of brightness in place, with a single lookup table instead of an HSV round-trip.
+        coeff in [-1; 0[ scales the image down (-1 sets it to 0), coeff in [0; 1] shifts it up
+        towards 255 (1 sets its darkest pixel to 255).
+
+        Parameters:
+        - frame: uint8 image, overwritten with the changed image.
+        - coeff: The degree to which the brightness changes, in [-1; 1].
+
+        Returns:
+        - The changed frame (the same buffer).
+        """
+        if coeff == 0:
+            return frame
+        if coeff < 0:
+            levels = self.ramp * (1 + coeff)
+        else:
+            levels = self.ramp + coeff * (255 - int(frame.min()))
+        np.copyto(self.lut, np.clip(levels, 0, 255), casting='unsafe')
+        cv2.LUT(frame, self.lut, dst=frame)
+        return frame
+
+    @staticmethod
+    def coefficient(coeff, gradual, progress):
+        """
+        Brightness coefficient reached at some point of the study.
+
+        Parameters:
+        - coeff: Final coefficient.
+        - gradual: Boolean indicating whether the change is gradual or happens at once halfway.
+        - progress: Progress of the study, from 0 to 1.
+        """
+        if gradual:
+            return coeff * min(progress, 1.0)
+        return coeff if progress >= 0.5 else 0.0
+
     def main(self, coeff:float, gradual:bool, max_rounds:int=0, wait:int=3):
         """
-        This is the main function to launch the brightness study. First choose a coefficient (coeff), then if the change 
+        This is the main function to launch the brightness study. First choose a coefficient (coeff), then if the change
         is to be gradual or not, and eventually the other parameters if it will be gradual.
 
         Be sure to select a point early to observe its changes in position.
 
         Parameters:
-        - coeff: The degree to which the brightness will change. The range for coeff is [-1; 1], it is used 
-        to modify the "value" (from HSV) in the image. This is done to test the resilience of LK to illumination 
-        changes. coeff in [-1; 0[ are used to darken the image, with -1 setting the global image "value" at 0 
-        coeff in [0; 1] are used to brighten the image, with 1 setting the global image "value" at 255.
-        - gradual: Determines if the change in brightness is gradual or not. If not, then it happens after 5 seconds. 
+        - coeff: The degree to which the brightness will change. The range for coeff is [-1; 1]. This is done to test
+        the resilience of LK to illumination changes. coeff in [-1; 0[ are used to darken the image, with -1 setting
+        the image at 0; coeff in [0; 1] are used to brighten the image, with 1 setting the image at 255.
+        - gradual: Determines if the change in brightness is gradual or not. If not, then it happens after 5 seconds.
         If it is, then after max_rounds * wait seconds the simulation will have reached coeff and end.
         - max_rounds: If change is gradual, then it occurs over this many rounds.
         - wait: If change is gradual, then this sets the number of seconds to wait between each round.
@@ -69,54 +127,115 @@ class Pixel_Light_Test:
         if (coeff<-1 or coeff>1):
             raise Exception("coeff not within [-1; 1]")
         while True:
-            _, frame = self.cap.read()
+            _, frame = self.buffers.read(self.cap)
             if not gradual:
-                if coeff<0:
-                    if time.time()-start_time>5.0:
-                        frame1 = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-                        frame1[:,:,2] = (frame1[:,:,2]*(1+coeff)).astype(np.uint8)
-                        frame = cv2.cvtColor(frame1, cv2.COLOR_HSV2BGR)
-                elif coeff>=0:
-                    if time.time()-start_time>5.0:
-                        frame1 = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-                        delta = coeff*(np.uint8(255-np.min(frame1[:,:,2])))
-                        frame1[:,:,2] = (np.where(frame1[:,:,2]<(255-delta), frame1[:,:,2]+delta, 255*np.full_like(frame1[:,:,2], 1))).astype(np.uint8)
-                        frame = cv2.cvtColor(frame1, cv2.COLOR_HSV2BGR)
-            if gradual:
+                self.change_brightness(frame, self.coefficient(coeff, False, (time.time()-start_time)/10.0))
+            else:
                 round_counter = round(time.time()-start_time)//wait
-                if (coeff<0 and round_counter<=max_rounds):
-                    partial_coeff = coeff*(round_counter/max_rounds)
-                    frame1 = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-                    frame1[:,:,2] = (frame1[:,:,2]*(1+partial_coeff)).astype(np.uint8)
-                    frame = cv2.cvtColor(frame1, cv2.COLOR_HSV2BGR)
-                elif (coeff>=0 and round_counter<=max_rounds):
-                    partial_coeff = coeff*(round_counter/max_rounds)
-                    frame1 = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-                    delta = partial_coeff*(np.uint8(255-np.min(frame1[:,:,2])))
-                    frame1[:,:,2] = (np.where(frame1[:,:,2]<(255-delta), frame1[:,:,2]+delta, 255*np.full_like(frame1[:,:,2], 1))).astype(np.uint8)
-                    frame = cv2.cvtColor(frame1, cv2.COLOR_HSV2BGR)
                 if round_counter>max_rounds:
                     break
-            gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            if self.point_selected:
-                new_point, status, error = cv2.calcOpticalFlowPyrLK(self.old_frame,
-                                                                    gray_frame,
-                                                                    self.old_point,
-                                                                    None,
-                                                                    **self.lk_params)
+                self.change_brightness(frame, self.coefficient(coeff, True, round_counter/max(max_rounds, 1)))
+            gray_frame = self.buffers.gray(frame)
+            if self.illumination is not None:
+                self.illumination.apply(gray_frame)
+            self.flow.update(gray_frame)
+            if self.point_selected and self.flow.ready:
+                new_point, status, error = self.flow.calc(self.old_point)
                 good_new = new_point[status.flatten() == 1]
                 good_old = self.old_point[status.flatten() == 1]
-                for new, old in zip(good_new, good_old):
-                    a, b = new.ravel()
-                    c, d = old.ravel()
-                    frame = cv2.line(frame, (int(a), int(b)), (int(c), int(d)), (0, 255, 0), 2)
-                    frame = cv2.circle(frame, (int(a), int(b)), 5, (0, 255, 0), -1)
+                self.renderer.tracks(frame, good_new, good_old)
                 self.old_point = good_new
-            self.old_frame = gray_frame.copy()
             cv2.imshow('Frame', frame)
             key = cv2.waitKey(1) & 0xFF
             if key in [ord('q')]:
                 break
         cv2.destroyAllWindows()
 
-Pixel_Light_Test().main(-0.4, True, 20, 3)
\ No newline at end of file
+    def benchmark(self, coeff, gradual, n_frames=100, n_poi=100, speed=1.0, seed=0):
+        """
+        Track points of interest through a synthetic translation under a brightness change,
+        and measure how far they drift from the ground truth and what the normalization costs.
+
+        Parameters:
+        - coeff: Final brightness coefficient, in [-1; 1].
+        - gradual: Boolean indicating whether the change is gradual or happens at once halfway.
+        - n_frames: Number of frames of the sequence.
+        - n_poi: Number of points of interest tracked.
+        - speed: Displacement of the scene in pixels per frame.
+        - seed: Seed of the synthetic texture.
+
+        Returns:
+        - Dictionary with the drift, the number of lost points and the per-frame cost of the normalization.
+        """
+        capture = SyntheticCapture('translate', n_frames, speed=speed, seed=seed)
+        self.flow.reset()
+        if self.illumination is not None:
+            self.illumination.reset()
+        points, errors, costs = None, [], []
+        for t in range(n_frames):
+            _, frame = self.buffers.read(capture)
+            self.change_brightness(frame, self.coefficient(coeff, gradual, t / max(n_frames - 1, 1)))
+            gray_frame = self.buffers.gray(frame)
+            if self.illumination is not None:
+                start_time = time.perf_counter()
+                self.illumination.apply(gray_frame)
+                costs.append(time.perf_counter() - start_time)
+            self.flow.update(gray_frame)
+            if points is None:
+                points = cv2.goodFeaturesToTrack(gray_frame, n_poi, 0.01, 10)
+                seeds, found = points.reshape(-1, 2).copy(), np.ones(len(points), dtype=bool)
+                continue
+            new_points, status, _ = self.flow.calc(points)
+            found &= status.flatten() == 1
+            points = new_points
+            truth = capture.map_points(seeds, 0, t)
+            errors.append(np.linalg.norm(points.reshape(-1, 2)[found] - truth[found], axis=1))
+        return dict(error_px=dict(mean=float(np.mean(np.concatenate(errors))), final=float(np.mean(errors[-1]))),
+                    lost=int((~found).sum()),
+                    cost_ms=float(np.mean(costs) * 1e3) if costs else 0.0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Run the parametrized benchmark on synthetic frames instead of the interactive study')
+    parser.add_argument('--coeff', type=float, default=-0.4,
+                        help='Brightness coefficient of the interactive study, in [-1; 1]')
+    parser.add_argument('--abrupt', action='store_true',
+                        help='Change the brightness at once instead of gradually')
+    parser.add_argument('--max_rounds', type=int, default=20,
+                        help='Number of rounds of a gradual change (interactive study)')
+    parser.add_argument('--wait', type=int, default=3,
+                        help='Seconds between two rounds of a gradual change (interactive study)')
+    parser.add_argument('--illumination', type=str, default=None,
+                        help='Illumination normalization of the interactive study (clahe or gain)')
+    parser.add_argument('--coeffs', type=str, default='-0.6,-0.3,0.3,0.6',
+                        help='Comma-separated brightness coefficients of the benchmark')
+    parser.add_argument('--methods', type=str, default='none,clahe,gain',
+                        help='Comma-separated normalizations of the benchmark (none, clahe, gain)')
+    parser.add_argument('--frames', type=int, default=100,
+                        help='Number of frames of each benchmark sequence')
+    parser.add_argument('--n_poi', type=int, default=100,
+                        help='Number of Points Of Interest of the benchmark')
+    parser.add_argument('--out', type=str, default=None,
+                        help='Path of the JSON report of the benchmark (printed if not given)')
+    args = parser.parse_args()
+
+    if not args.benchmark:
+        illumination = None if args.illumination is None else IlluminationNormalizer(args.illumination)
+        Pixel_Light_Test(illumination=illumination).main(args.coeff, not args.abrupt, args.max_rounds, args.wait)
+    else:
+        results = []
+        for method in args.methods.split(','):
+            illumination = None if method == 'none' else IlluminationNormalizer(method)
+            test = Pixel_Light_Test(headless=True, illumination=illumination)
+            for coeff in [float(coeff) for coeff in args.coeffs.split(',')]:
+                for gradual in [True, False]:
+                    result = test.benchmark(coeff, gradual, n_frames=args.frames, n_poi=args.n_poi)
+                    results.append(dict(method=method, coeff=coeff, gradual=gradual, **result))
+        report = dict(frames=args.frames, n_poi=args.n_poi, opencv=cv2.__version__, results=results)
+        if args.out is None:
+            print(json.dumps(report, indent=2))
+        else:
+            with open(args.out, 'w') as file:
+                json.dump(report, file, indent=2)
@@ -0,0 +1,185 @@
+"""
+CaptureDataset: An append-only container storing captured frames
+together with their click coordinates and an explicit index.
+
+A dataset `<path>` is made of two files:
+- `<path>.frames`: the frames, appended one after the other, either raw or encoded (PNG or JPEG).
+- `<path>.index`: one fixed-size record per frame with its offset, size, shape, encoding and click coordinates.
+
+Both files are memory-mapped for reading, so raw frames are returned without any copy.
+Datasets of the former layout (a folder of `webcam_<i>.jpg` images and a `<folder>_coordinates.npy`
+array) are imported once with `import_legacy`.
+"""
+
+import numpy as np
+import cv2
+import os
+import re
+
+
+class CaptureDataset:
+
+    ENCODINGS = ['raw', 'png', 'jpg']
+    RECORD = np.dtype([('offset', '<u8'), ('length', '<u8'),
+                       ('height', '<u4'), ('width', '<u4'), ('channels', '<u1'),
+                       ('encoding', '<u1'), ('x', '<f4'), ('y', '<f4')])
+
+    def __init__(self, path, encoding='raw'):
+        """
+        Initialize the CaptureDataset object.
+
+        Parameters:
+        - path: Path of the dataset, without extension.
+        - encoding: Encoding of the appended frames ('raw', 'png' for lossless or 'jpg').
+        """
+        if encoding not in self.ENCODINGS:
+            raise ValueError(f'encoding must be one of {self.ENCODINGS}, not {encoding!r}')
+        self.path = path
+        self.encoding = encoding
+        self.frames_path = f'{path}.frames'
+        self.index_path = f'{path}.index'
+        self._index = None
+        self._frames = None
+
+    def __len__(self):
+        """
+        Number of frames in the dataset.
+        """
+        if not os.path.exists(self.index_path):
+            return 0
+        return os.path.getsize(self.index_path) // self.RECORD.itemsize
+
+    def __getitem__(self, i):
+        """
+        Get a frame and its click coordinates.
+
+        Parameters:
+        - i: Index of the frame.
+
+        Returns:
+        - Tuple (frame, (x, y)).
+        """
+        record = self.index[i]
+        return self.frame(i), (float(record['x']), float(record['y']))
+
+    @property
+    def mtime(self):
+        """
+        Time of the last append, or 0 for an empty dataset.
+        """
+        return os.path.getmtime(self.index_path) if os.path.exists(self.index_path) else 0
+
+    @property
+    def index(self):
+        """
+        Memory-mapped index records, reopened whenever frames were appended.
+        """
+        if len(self) == 0:
+            return np.empty(0, dtype=self.RECORD)
+        if self._index is None or len(self._index) != len(self):
+            self._index = np.memmap(self.index_path, dtype=self.RECORD, mode='r')
+        return self._index
+
+    @property
+    def coordinates(self):
+        """
+        Array of shape (n_frames, 2) holding the click coordinates of every frame.
+        """
+        index = self.index
+        return np.stack([index['x'], index['y']], axis=-1)
+
+    def frames(self):
+        """
+        Memory-mapped bytes of the frames, reopened whenever frames were appended.
+        """
+        size = os.path.getsize(self.frames_path)
+        if self._frames is None or len(self._frames) != size:
+            self._frames = np.memmap(self.frames_path, dtype=np.uint8, mode='r')
+        return self._frames
+
+    def frame(self, i):
+        """
+        Get a frame. Raw frames are views on the memory-mapped file, encoded frames are decoded.
+
+        Parameters:
+        - i: Index of the frame.
+
+        Returns:
+        - The frame, as an array of shape (height, width, channels).
+        """
+        record = self.index[i]
+        offset, length = int(record['offset']), int(record['length'])
+        data = self.frames()[offset:offset + length]
+        if self.ENCODINGS[record['encoding']] == 'raw':
+            return data.reshape(int(record['height']), int(record['width']), int(record['channels']))
+        return cv2.imdecode(np.asarray(data), cv2.IMREAD_UNCHANGED).reshape(int(record['height']),
+                                                                             int(record['width']),
+                                                                             int(record['channels']))
+
+    def append(self, frame, point):
+        """
+        Append a frame and its click coordinates at the end of the dataset.
+
+        Parameters:
+        - frame: Image to store.
+        - point: Click coordinates (x, y) on the image.
+
+        Returns:
+        - Index of the appended frame.
+        """
+        frame = np.ascontiguousarray(frame)
+        if self.encoding == 'raw':
+            data = frame.reshape(-1)
+        else:
+            _, data = cv2.imencode(f'.{self.encoding}', frame)
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        offset = os.path.getsize(self.frames_path) if os.path.exists(self.frames_path) else 0
+        with open(self.frames_path, 'ab') as file:
+            file.write(data.tobytes())
+        record = np.zeros(1, dtype=self.RECORD)
+        record['offset'], record['length'] = offset, data.size
+        record['height'], record['width'] = frame.shape[:2]
+        record['channels'] = frame.shape[2] if frame.ndim == 3 else 1
+        record['encoding'] = self.ENCODINGS.index(self.encoding)
+        record['x'], record['y'] = point
+        # The index is written last, so an interrupted append leaves no dangling record
+        with open(self.index_path, 'ab') as file:
+            file.write(record.tobytes())
+        return len(self) - 1
+
+    def import_legacy(self, folder, coordinates):
+        """
+        Append the photographs of a dataset of the former layout, each with its click coordinates.
+
+        Parameters:
+        - folder: Folder holding the `webcam_<i>.jpg` images.
+        - coordinates: Path of the `.npy` array of shape (n_images, 2) holding the click coordinates.
+
+        Returns:
+        - Number of imported photographs.
+        """
+        points = np.load(coordinates).reshape(-1, 2)
+        names = os.listdir(folder) if os.path.isdir(folder) else []
+        # Image i was saved as webcam_<i>.jpg when the i-th click was recorded
+        numbered = sorted((int(match.group(1)), name) for name in names
+                          for match in [re.fullmatch(r'webcam_(\d+)\.jpg', name)] if match)
+        imported = 0
+        for i, name in numbered:
+            frame = cv2.imread(os.path.join(folder, name))
+            if i >= len(points) or frame is None:
+                continue
+            self.append(frame, points[i])
+            imported += 1
+        return imported
+
+    def delete(self):
+        """
+        Delete both files of the dataset.
+        """
+        self._index = None
+        self._frames = None
+        for path in [self.frames_path, self.index_path]:
+            if os.path.exists(path):
+                os.remove(path)
@@ -6,69 +6,216 @@ Author: @SamuelDubos
 Date: February 14, 2024
 """
 
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import cv2
 import os
 
+from src.capture import open_capture
+from src.flow_cache import FlowCache
+from src.metrics import Metrics
+from src.renderer import Renderer
+from src.frame_buffers import FrameBuffers
+
 
 class PhotographsMatcher:
 
-    def __init__(self, camera, photographer):
+    def __init__(self, camera, photographer, cache=True, workers=None, headless=False):
         """
         Initialize the PhotographsMatcher object.
 
         Parameters:
-        - camera: Index of the camera to use for video capture.
+        - camera: Index of the camera to use for video capture, path of a video file, or an opened capture.
         - photographer: Instance of the Photographer class to access captured photographs and coordinates.
+        - cache: Boolean indicating whether the preprocessed photographs are cached on disk.
+        - workers: Number of threads matching photographs concurrently (defaults to the number of cores).
+        - headless: Boolean indicating whether to run without any window.
         """
         self.camera = camera
+        self.headless = headless
         self.photographer = photographer
-        self.points = np.load(self.photographer.ndarray)
+        self.cache = cache
+        self.dataset = self.photographer.dataset
+        if len(self.dataset) == 0:
+            print(f'Error: no photographs in {self.photographer.folder}, take some with --add first.')
+            exit()
+        self.points = self.dataset.coordinates.astype(np.float32).reshape(-1, 1, 2)
+        self.references = self.load_references()
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
 
         self.point = None
         self.frames = []
         self.found = 0
+        self.matched = np.full((len(self.points), 2), np.nan, dtype=np.float32)
+        self.errors = np.full(len(self.points), np.nan, dtype=np.float32)
 
         # Initialize video capture
-        self.cap = cv2.VideoCapture(self.camera, cv2.CAP_DSHOW)
-        cv2.namedWindow('Frame')
+        self.cap = open_capture(self.camera, cv2.CAP_DSHOW)
+        if not self.headless:
+            cv2.namedWindow('Frame')
 
         # Parameters for Lucas-Kanade optical flow
         self.lk_params = dict(winSize=(15, 15),
                               maxLevel=2,
                               criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+        self.flow = FlowCache(self.lk_params)
+
+        # Optional FlowValidator dropping the points that drifted
+        self.validator = None
+
+        # Optional IlluminationNormalizer applied to the grayscale frames before tracking
+        self.illumination = None
+
+        # Optional AsyncTrajectoryWriter recording the tracked points of every frame
+        self.recorder = None
+
+        # Optional Relocalizer shortlisting the photographs similar to the live frame and placing
+        # their points with a homography, so that only those are refined with Lucas-Kanade
+        self.relocalizer = None
+
+        # Per-stage timings, disabled unless replaced by an enabled Metrics object
+        self.metrics = Metrics()
+
+        # Overlay drawing, batched over all the points
+        self.renderer = Renderer()
+
+        # Preallocated frame buffers, reused by every frame
+        self.buffers = FrameBuffers()
+
+    def load_references(self):
+        """
+        Resize and convert every photograph of the dataset to grayscale once, or load them
+        from the cache if no photograph was added since it was written.
+
+        Returns:
+        - Array of shape (n_photographs, 480, 640) holding the grayscale photographs.
+        """
+        if self.cache and os.path.exists(self.photographer.references):
+            if os.path.getmtime(self.photographer.references) >= self.dataset.mtime:
+                references = np.load(self.photographer.references, mmap_mode='r')
+                if len(references) == len(self.dataset):
+                    return references
+        references = np.empty((len(self.dataset), 480, 640), dtype=np.uint8)
+        for i in range(len(self.dataset)):
+            image = cv2.resize(self.dataset.frame(i), (640, 480))
+            cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=references[i])
+        if self.cache:
+            np.save(self.photographer.references, references)
+        return references
+
+    def match(self, i, gray_frame, homography=None):
+        """
+        Match the point clicked on a photograph with the live frame.
+        OpenCV releases the GIL, so several photographs can be matched concurrently.
+
+        Parameters:
+        - i: Index of the photograph.
+        - gray_frame: Grayscale live frame.
+        - homography: Optional homography from the photograph to the live frame, whose projection
+          of the point is the initial guess refined by Lucas-Kanade.
+
+        Returns:
+        - Tuple (new_points, status, error) as returned by calcOpticalFlowPyrLK.
+        """
+        # Photograph i holds the clicked point i
+        points = self.points[i:i + 1]
+        if homography is None:
+            new_points, status, error = self.flow.calc(points, prev_img=self.references[i], next_img=gray_frame)
+        else:
+            guesses = cv2.perspectiveTransform(points, homography).astype(np.float32)
+            new_points, status, error = self.flow.calc(points, guesses, prev_img=self.references[i],
+                                                       next_img=gray_frame, flags=cv2.OPTFLOW_USE_INITIAL_FLOW)
+        if self.validator is not None:
+            keep = self.validator.validate(self.flow, points, new_points, status, error,
+                                           prev_img=self.references[i], next_img=gray_frame)
+            status = keep.astype(np.uint8).reshape(-1, 1)
+        return new_points, status, error
+
+    def relocalize(self, gray_frame):
+        """
+        Shortlist the photographs similar to the live frame and estimate their homographies,
+        describing and indexing the photographs first if they were not yet.
+
+        Parameters:
+        - gray_frame: Grayscale live frame.
+
+        Returns:
+        - Tuple (indices, homographies) of the photographs that could be placed in the frame.
+        """
+        if not self.relocalizer.ready:
+            path = self.photographer.descriptors if self.cache else None
+            self.relocalizer.build(self.references, path, self.dataset.mtime)
+        points, descriptors = self.relocalizer.describe(gray_frame)
+        candidates = list(self.relocalizer.shortlist(descriptors))
+        homographies = self.pool.map(lambda i: self.relocalizer.homography(i, points, descriptors), candidates)
+        placed = [(i, homography) for i, homography in zip(candidates, homographies) if homography is not None]
+        return [i for i, _ in placed], [homography for _, homography in placed]
+
+    def process(self, frame):
+        """
+        Match the saved pixels on a single frame and draw the matches.
+
+        Parameters:
+        - frame: BGR image captured from the camera.
+
+        Returns:
+        - The annotated frame.
+        """
+        self.found = 0
+        self.matched[:] = np.nan
+        self.errors[:] = np.nan
+        gray_frame = self.buffers.gray(frame)
+        self.metrics.lap('cvtColor')
+        if self.illumination is not None:
+            self.illumination.apply(gray_frame)
+            self.metrics.lap('illumination')
+        self.flow.update(gray_frame)
+        if self.relocalizer is None:
+            indices = list(range(len(self.references)))
+            homographies = [None] * len(indices)
+        else:
+            indices, homographies = self.relocalize(gray_frame)
+            self.metrics.lap('relocalization')
+        matches = list(self.pool.map(self.match, indices, [gray_frame] * len(indices), homographies))
+        self.metrics.lap('calcOpticalFlowPyrLK')
+        for i, (new_points, status, error) in zip(indices, matches):
+            if status[0, 0] == 1:
+                self.matched[i] = new_points.reshape(2)
+                self.found += 1
+            self.errors[i] = error[0, 0]
+        if self.recorder is not None:
+            self.recorder.write(self.matched, ~np.isnan(self.matched[:, 0]), self.errors)
+
+        # Draw every reference at once: saved pixels in blue, matches in green from their red origin
+        matched = np.flatnonzero(~np.isnan(self.matched[:, 0]))
+        good_new, good_old = self.matched[matched], self.points[matched].reshape(-1, 2)
+        self.renderer.markers(frame, self.points, (255, 0, 0))
+        self.renderer.segments(frame, good_new, good_old, (0, 255, 0))
+        self.renderer.markers(frame, good_new, (0, 255, 0))
+        self.renderer.markers(frame, good_old, (0, 0, 255))
+        self.metrics.lap('draw')
+        self.metrics.count('points_tracked', self.found)
+        self.metrics.count('points_lost', len(self.points) - self.found)
+        percentage = self.found / max(len(self.points), 1)
+        print(f'\rFound pixels: {self.found} out of {len(self.points)} ({percentage:.1%})', end='')
+        return frame
 
     def main(self):
         """
         Main function to match pixels in real-time with pixels saved from previous photographs.
         """
         while True:
-            self.found = 0
-            _, frame = self.cap.read()
-            gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            for i, image in enumerate(os.listdir(self.photographer.folder)):
-                image = cv2.resize(cv2.imread(f'{self.photographer.folder}/{image}'), (640, 480))
-                gray_image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-                point = np.array([self.points[i]]).astype(np.float32)
-                frame = cv2.circle(frame, (int(point[0, 0]), int(point[0, 1])), 5, (255, 0, 0), -1)
-                new_point, status, error = cv2.calcOpticalFlowPyrLK(gray_image,
-                                                                    gray_frame,
-                                                                    point,
-                                                                    None,
-                                                                    **self.lk_params)
-                good_new = new_point[status.flatten() == 1]
-                good_old = point[status.flatten() == 1]
-                self.found += int(good_old.size / 2)
-                for new, old in zip(good_new, good_old):
-                    a, b = new.ravel()
-                    c, d = old.ravel()
-                    frame = cv2.line(frame, (int(a), int(b)), (int(c), int(d)), (0, 255, 0), 2)
-                    frame = cv2.circle(frame, (int(a), int(b)), 5, (0, 255, 0), -1)
-                    frame = cv2.circle(frame, (int(c), int(d)), 5, (0, 0, 255), -1)
+            self.metrics.start()
+            _, frame = self.buffers.read(self.cap)
+            self.metrics.lap('read')
+            frame = self.metrics.draw(self.process(frame))
             cv2.imshow('Frame', frame)
-            percentage = self.found / len(self.points)
-            print(f'\rFound pixels: {self.found} out of {len(self.points)} ({percentage:.1%})', end='')
             key = cv2.waitKey(1) & 0xFF
+            self.metrics.lap('display')
+            self.metrics.end()
             if key in [ord('q')]:
                 break
+        self.metrics.close()
+        self.pool.shutdown()
         cv2.destroyAllWindows()
@@ -1,34 +1,54 @@
 """
 Photographer: A utility to capture images
-from a webcam and save click coordinates.
+from a webcam and save them with their click coordinates.
 
 Author: @SamuelDubos
 Date: February 14, 2024
 """
 
-import numpy as np
-import shutil
 import cv2
 import os
 
+from limits.dataset import CaptureDataset
+
 
 class Photographer:
-    def __init__(self, camera, folder, run=False):
+    def __init__(self, camera, folder, run=False, encoding='raw'):
         """
         Initialize the Photographer object.
 
         Parameters:
         - camera: Index of the camera to use for video capture.
-        - folder: Name of the folder to save images and coordinates.
+        - folder: Name of the dataset in which images and coordinates are saved.
         - run: Boolean indicating whether to execute the main process immediately.
+        - encoding: Encoding of the saved images ('raw', 'png' or 'jpg').
         """
         self.camera = camera
         self.folder = os.path.join('limits', 'images', folder)
         self.click_coordinates = []
         self.frame = None
-        self.ndarray = os.path.join('limits', 'images', f'{folder}_coordinates.npy')
+        self.dataset = CaptureDataset(self.folder, encoding=encoding)
+        self.references = os.path.join('limits', 'images', f'{folder}_references.npy')
+        self.descriptors = os.path.join('limits', 'images', f'{folder}_descriptors.npz')
+        self.legacy_coordinates = os.path.join('limits', 'images', f'{folder}_coordinates.npy')
+        self.import_legacy()
         self.run() if run else None
 
+    def import_legacy(self):
+        """
+        Import once the photographs saved with the former layout (a folder of JPEG images
+        and a coordinates array), when the dataset is still empty.
+        """
+        if len(self.dataset) or not os.path.exists(self.legacy_coordinates):
+            return
+        imported = self.dataset.import_legacy(self.folder, self.legacy_coordinates)
+        if imported:
+            print(f'{imported} photographs of the former {self.folder} folder have been imported '
+                  f'into {self.dataset.frames_path}.')
+        else:
+            print(f'Warning: {self.legacy_coordinates} has no matching images in {self.folder}, '
+                  f'nothing was imported.')
+
     def mouse_click(self, event, x, y, flags, param):
         """
         Mouse callback function to capture click coordinates.
@@ -42,10 +62,8 @@ class Photographer:
         if event == cv2.EVENT_LBUTTONDOWN:
             print(f'Click Position : ({x}, {y})')
             self.click_coordinates.append((x, y))
-            index = len(os.listdir(self.folder))
-            image_name = os.path.join(self.folder, f'webcam_{index}.jpg')
-            cv2.imwrite(image_name, self.frame)
-            print(f'Image saved : {image_name}')
+            index = self.dataset.append(self.frame, (x, y))
+            print(f'Image saved : {self.dataset.frames_path} [{index}]')
 
     def capture_webcam(self):
         """
@@ -65,49 +83,27 @@ class Photographer:
         cv2.destroyAllWindows()
         cap.release()
 
-    def save_coordinates(self):
-        """
-        Save click coordinates to a numpy ndarray file.
-        """
-        if os.path.exists(self.ndarray):
-            coordinates_array = np.concatenate((np.load(self.ndarray), np.array(self.click_coordinates)))
-        else:
-            coordinates_array = np.array(self.click_coordinates)
-        np.save(self.ndarray, coordinates_array)
-        print(f'Click coordinates have been saved to {self.ndarray}.')
-
-    @staticmethod
-    def onerror(func, path):
-        """
-        Error handler to handle file deletion errors.
-        """
-        import stat
-        os.chmod(path, stat.S_IWRITE)
-        func(path)
-
     def delete(self):
         """
-        Delete the folder containing images and the numpy ndarray file.
+        Delete the dataset holding images and coordinates.
         """
-        print(f'Deleting {self.folder} folder')
-        try:
-            n_images = len(os.listdir(self.folder))
-            shutil.rmtree(self.folder, onerror=self.onerror)
-            print(f'All {n_images} images have been deleted.')
-        except OSError as e:
-            print(f'Error: {e.filename} - {e.strerror}.')
-        if os.path.exists(self.ndarray):
-            os.remove(self.ndarray)
-            print('Numpy ndarray file has been deleted.')
+        print(f'Deleting {self.folder} dataset')
+        n_images = len(self.dataset)
+        self.dataset.delete()
+        print(f'All {n_images} images have been deleted.')
+        if os.path.exists(self.references):
+            os.remove(self.references)
+            print('Cached references have been deleted.')
+        if os.path.exists(self.descriptors):
+            os.remove(self.descriptors)
+            print('Cached descriptors have been deleted.')
 
     def run(self):
         """
-        Execute the main process: capture images, record coordinates, and save them.
+        Execute the main process: capture images and save them with their click coordinates.
         """
-        if not os.path.exists(self.folder):
-            os.makedirs(self.folder)
         self.capture_webcam()
-        self.save_coordinates()
+        print(f'{len(self.click_coordinates)} images and click coordinates have been saved to {self.folder}.')
 
 
 if __name__ == '__main__':
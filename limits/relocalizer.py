@@ -0,0 +1,186 @@
+"""
+Relocalizer: A utility to find the reference photographs that look like the live frame
+among many, with binary descriptors computed once per photograph and indexed with
+locality-sensitive hashing, and to estimate the homography placing their points in the frame.
+"""
+
+import numpy as np
+import cv2
+import os
+
+
+class Relocalizer:
+
+    METHODS = ['orb']
+
+    def __init__(self, method='orb', n_features=500, shortlist=3, bits=14, tables=6, ratio=0.8, min_inliers=12,
+                 seed=0):
+        """
+        Initialize the Relocalizer object.
+
+        Parameters:
+        - method: Binary descriptor (only 'orb', the one available in every OpenCV build).
+        - n_features: Maximum number of keypoints described per image.
+        - shortlist: Number of most similar photographs kept per live frame.
+        - bits: Number of descriptor bits hashed by every table.
+        - tables: Number of hash tables (more tables find more similar descriptors, at a higher cost).
+        - ratio: Lowe's ratio between the best and second best descriptor matches.
+        - min_inliers: Minimum number of matches consistent with the homography of a photograph.
+        - seed: Seed of the bits drawn by the hash tables.
+        """
+        if method not in self.METHODS:
+            raise ValueError(f'method must be one of {self.METHODS}, not {method!r}')
+        self.method = method
+        self.n_features = n_features
+        self.shortlist_size = shortlist
+        self.bits = bits
+        self.n_tables = tables
+        self.ratio = ratio
+        self.min_inliers = min_inliers
+        self.seed = seed
+        self.extractor = cv2.ORB_create(nfeatures=n_features)
+
+        # Keypoints and descriptors of every photograph, and the hash tables over all the descriptors
+        self.keypoints = []
+        self.descriptors = []
+        self.sizes = None
+        self.positions = None
+        self.tables = None
+
+    @property
+    def ready(self):
+        """
+        Whether the photographs were described and indexed.
+        """
+        return self.tables is not None
+
+    def describe(self, gray_frame):
+        """
+        Detect and describe the strongest keypoints of a grayscale image.
+
+        Returns:
+        - Tuple (points, descriptors) of float32 positions of shape (N, 2) and uint8 descriptors.
+        """
+        keypoints, descriptors = self.extractor.detectAndCompute(gray_frame, None)
+        if descriptors is None:
+            return np.empty((0, 2), np.float32), np.empty((0, self.extractor.descriptorSize()), np.uint8)
+        if len(keypoints) > self.n_features:
+            strongest = np.argsort([-keypoint.response for keypoint in keypoints])[:self.n_features]
+            keypoints, descriptors = [keypoints[i] for i in strongest], descriptors[strongest]
+        return np.array([keypoint.pt for keypoint in keypoints], dtype=np.float32).reshape(-1, 2), descriptors
+
+    def hash(self, descriptors):
+        """
+        Keys of some descriptors in every hash table, each made of a fixed random subset of their bits.
+
+        Returns:
+        - Array of shape (N, tables).
+        """
+        if self.positions is None:
+            rng = np.random.default_rng(self.seed)
+            n_bits = 8 * descriptors.shape[1]
+            self.positions = np.array([rng.choice(n_bits, self.bits, replace=False) for _ in range(self.n_tables)])
+        bits = (descriptors[:, self.positions // 8] >> (7 - self.positions % 8)) & 1
+        return (bits.astype(np.int64) << np.arange(self.bits)).sum(axis=2)
+
+    def build(self, references, path=None, mtime=0):
+        """
+        Describe every reference photograph, or load their descriptors from a cache written
+        after the last photograph was added, and index them.
+
+        Parameters:
+        - references: Grayscale reference photographs.
+        - path: Path of the .npz cache of the descriptors (None to disable it).
+        - mtime: Time of the last change of the photographs.
+        """
+        if len(references) == 0:
+            raise ValueError('no reference photographs to index')
+        cache = None
+        if path is not None and os.path.exists(path) and os.path.getmtime(path) >= mtime:
+            cache = np.load(path)
+            if (str(cache['method']) != self.method or int(cache['n_features']) != self.n_features
+                    or len(cache['sizes']) != len(references)):
+                cache = None
+        if cache is not None:
+            sizes, points, descriptors = cache['sizes'], cache['points'], cache['descriptors']
+        else:
+            described = [self.describe(reference) for reference in references]
+            sizes = np.array([len(reference_points) for reference_points, _ in described], dtype=np.int64)
+            points = np.concatenate([reference_points for reference_points, _ in described])
+            descriptors = np.concatenate([reference_descriptors for _, reference_descriptors in described])
+            if path is not None:
+                np.savez(path, method=self.method, n_features=self.n_features, sizes=sizes, points=points,
+                         descriptors=descriptors)
+        bounds = np.cumsum(sizes)[:-1]
+        self.sizes = sizes
+        self.keypoints = np.split(points, bounds)
+        self.descriptors = np.split(descriptors, bounds)
+        self.index(descriptors)
+
+    def index(self, descriptors):
+        """
+        Sort the keys of every descriptor of the photographs in every hash table,
+        along with the photograph each descriptor belongs to.
+        """
+        owners = np.repeat(np.arange(len(self.sizes)), self.sizes)
+        keys = self.hash(descriptors)
+        self.tables = []
+        for table in range(self.n_tables):
+            order = np.argsort(keys[:, table], kind='stable')
+            self.tables.append((keys[order, table], owners[order]))
+
+    def shortlist(self, descriptors):
+        """
+        Photographs most similar to a live frame: every descriptor of the frame votes for the photographs
+        sharing its bucket in every table, weighted by the inverse of the bucket size so that common
+        descriptors count little.
+
+        Parameters:
+        - descriptors: Descriptors of the live frame.
+
+        Returns:
+        - Indices of at most `shortlist` photographs, the most similar first.
+        """
+        votes = np.zeros(len(self.sizes))
+        if len(descriptors) == 0:
+            return np.empty(0, dtype=int)
+        keys = self.hash(descriptors)
+        for table, (sorted_keys, owners) in enumerate(self.tables):
+            left = np.searchsorted(sorted_keys, keys[:, table], side='left')
+            counts = np.searchsorted(sorted_keys, keys[:, table], side='right') - left
+            total = int(counts.sum())
+            if total == 0:
+                continue
+            # Positions of every hit, bucket after bucket
+            starts = np.repeat(left - (np.cumsum(counts) - counts), counts)
+            hits = owners[np.arange(total) + starts]
+            votes += np.bincount(hits, weights=np.repeat(1.0 / np.maximum(counts, 1), counts),
+                                 minlength=len(self.sizes))
+        scores = votes / np.sqrt(np.maximum(self.sizes, 1))
+        best = np.argsort(-scores)[:self.shortlist_size]
+        return best[scores[best] > 0]
+
+    def homography(self, i, points, descriptors):
+        """
+        Homography from a photograph to the live frame, from the descriptor matches passing the ratio test.
+        OpenCV releases the GIL, so several photographs can be processed concurrently.
+
+        Parameters:
+        - i: Index of the photograph.
+        - points, descriptors: Keypoints and descriptors of the live frame.
+
+        Returns:
+        - 3x3 homography, or None if too few matches are consistent with one.
+        """
+        if len(self.descriptors[i]) < 2 or len(descriptors) < 2:
+            return None
+        pairs = cv2.BFMatcher(cv2.NORM_HAMMING).knnMatch(self.descriptors[i], descriptors, k=2)
+        good = [pair[0] for pair in pairs if len(pair) == 2 and pair[0].distance < self.ratio * pair[1].distance]
+        if len(good) < self.min_inliers:
+            return None
+        source = self.keypoints[i][[match.queryIdx for match in good]]
+        target = points[[match.trainIdx for match in good]]
+        homography, inliers = cv2.findHomography(source, target, cv2.RANSAC, 3.0)
+        if homography is None or int(inliers.sum()) < self.min_inliers:
+            return None
+        return homography
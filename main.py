@@ -7,13 +7,29 @@ Date: January 24, 2024
 """
 
 import argparse
+import os
+
+import cv2
 
 from src.pixel_tracking import PixelTracker
 from src.zone_delimiting import ZoneDelimiter
 from src.poi_identifying import PoiIdentifier
 from src.poi_tracker import PoiTracker
+from src.pipeline import Pipeline
+from src.batch import BatchTracker
+from src.multi_camera import MultiCamera
+from src.metrics import Metrics
+from src.validation import FlowValidator
+from src.illumination import IlluminationNormalizer
+from src.renderer import Renderer
+from src.trajectories import AsyncTrajectoryWriter
+from src.lk_scheduler import LKScheduler
+from src.spatial_index import SpatialIndex
+from src.detector import Detector
+from src.motion_predictor import MotionPredictor
 from limits.photographer import Photographer
 from limits.matcher import PhotographsMatcher
+from limits.relocalizer import Relocalizer
 
 
 class Tracker:
@@ -42,48 +58,401 @@ class Tracker:
         parser = argparse.ArgumentParser(add_help=True)
 
         # General arguments
-        parser.add_argument('--camera', type=int, default=0,
+        parser.add_argument('--camera', type=str, default='0',
                             help='Select the camera peripheral '
-                                 '(0 for built-in webcam, 1 for external webcam)')
+                                 '(0 for built-in webcam, 1 for external webcam), or several comma-separated ones '
+                                 'tracked concurrently (only for item == pixel or poi)')
         parser.add_argument('--item', type=str, default='poi',
                             help='Select the type of time to track (pixel, zone, or poi)')
+        parser.add_argument('--pipeline', action='store_true',
+                            help='Run capture, tracking and display as concurrent stages')
+        parser.add_argument('--queue_size', type=int, default=2,
+                            help='Maximum number of frames waiting between two stages (only with --pipeline)')
+        parser.add_argument('--keep_frames', action='store_true',
+                            help='Block the capture instead of dropping the oldest frames (only with --pipeline)')
+        parser.add_argument('--check_frames', action='store_true',
+                            help='Count the frames changed while they wait between two stages (only with --pipeline)')
+        parser.add_argument('--input', type=str, default=None,
+                            help='Read frames from a video file instead of the camera (only for item == poi)')
+        parser.add_argument('--headless', action='store_true',
+                            help='Track without any window and save the trajectories (only for item == poi, '
+                                 'or with several cameras)')
+        parser.add_argument('--roi', type=str, default=None,
+                            help='Zone in which POIs are seeded, as x0,y0,x1,y1, whose center is the tracked pixel '
+                                 'for item == pixel (only with --headless or several cameras)')
+        parser.add_argument('--out', type=str, default='tracks.npz',
+                            help='Path of the saved trajectories (only with --headless)')
+        parser.add_argument('--metrics', action='store_true',
+                            help='Time each stage of the frame loop and display the rolling statistics')
+        parser.add_argument('--metrics_file', type=str, default=None,
+                            help='Periodically write the metrics to this file, in the Prometheus text format '
+                                 '(suffixed with the camera with several cameras)')
+        parser.add_argument('--metrics_port', type=int, default=None,
+                            help='Serve the metrics on this local port, in the Prometheus text format '
+                                 '(one port per camera from this one with several cameras)')
+        parser.add_argument('--max_frames', type=int, default=None,
+                            help='Stop after this many frames of every camera (with several cameras, '
+                                 'otherwise until Ctrl+C or \'q\')')
+        parser.add_argument('--no_render', action='store_true',
+                            help='Show the raw frames without drawing any overlay')
+        parser.add_argument('--trail', type=int, default=0,
+                            help='Number of past frames whose track segments stay drawn')
+        parser.add_argument('--record', type=str, default=None,
+                            help='Record the positions, status and LK error of the tracked points of every frame '
+                                 'to this .npz or .csv file, from a background thread '
+                                 '(suffixed with the camera with several cameras)')
+        parser.add_argument('--batch', type=str, default=None,
+                            help='JSON list of videos to track in parallel, each with its input, roi, n_poi and out')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of worker processes (only with --batch), '
+                                 'or of tracking threads (with several cameras)')
 
         # Specific arguments
         parser.add_argument('--mesh', action='store_true',
                             help='Add a mesh (only for item == zone)')
+        parser.add_argument('--track_zone', action='store_true',
+                            help='Track the mesh with Lucas-Kanade to follow the deformation of the zone '
+                                 '(only for item == zone, with --mesh)')
+        parser.add_argument('--grid_size', type=int, default=10,
+                            help='Number of mesh points along each axis (only for item == zone)')
+        parser.add_argument('--dense', action='store_true',
+                            help='Advect the mesh with dense optical flow computed inside the zone (only for item == zone)')
+        parser.add_argument('--dense_method', type=str, default='dis',
+                            help='Dense optical flow algorithm: dis or farneback (only with --dense)')
+        parser.add_argument('--downscale', type=int, default=2,
+                            help='Factor by which the zone is shrunk before computing the dense flow (only with --dense)')
+        parser.add_argument('--dense_every', type=int, default=1,
+                            help='Compute the dense flow every N frames and extrapolate the last velocity in between '
+                                 '(only with --dense)')
         parser.add_argument('--n_poi', type=int, default=10,
                             help='Add Points Of Interest (only for item == poi)')
         parser.add_argument('--track', action='store_false',
                             help='Track the Points Of Interest (only for item == poi)')
+        parser.add_argument('--replenish', type=int, default=0,
+                            help='Re-detect lost Points Of Interest every N frames (only for item == poi)')
+        parser.add_argument('--min_live', type=int, default=0,
+                            help='Re-detect lost Points Of Interest as soon as fewer are tracked (only for item == poi)')
+        parser.add_argument('--crop', action='store_true',
+                            help='Convert and track only a window around the Points Of Interest (only for item == poi)')
+        parser.add_argument('--crop_padding', type=int, default=60,
+                            help='Margin of the tracked window around the Points Of Interest, in pixels (only with --crop)')
+        parser.add_argument('--detector', type=str, default='shi-tomasi', choices=Detector.METHODS,
+                            help='Detection backend of the Points Of Interest (only for item == poi)')
+        parser.add_argument('--detect_downscale', type=int, default=1,
+                            help='Detect the Points Of Interest on the zone downscaled by this factor, '
+                                 'then refine them at full resolution (only for item == poi)')
+        parser.add_argument('--no_subpix', action='store_true',
+                            help='Keep the detected Points Of Interest at the detection resolution, '
+                                 'without sub-pixel refinement')
+        parser.add_argument('--predict', action='store_true',
+                            help='Start Lucas-Kanade from the positions predicted by a constant-velocity '
+                                 'Kalman filter, and let the points that are not found coast on their prediction '
+                                 '(only for item == pixel or poi)')
+        parser.add_argument('--max_coast', type=int, default=10,
+                            help='Number of frames a point coasts before it is lost (only with --predict)')
+        parser.add_argument('--dedup', type=float, default=None,
+                            help='Drop the Points Of Interest that merge, closer than this distance in pixels, '
+                                 'and select the nearest one with a right click (only for item == poi)')
+        parser.add_argument('--fb_threshold', type=float, default=None,
+                            help='Drop points whose forward-backward error exceeds this many pixels '
+                                 '(only for item == pixel, poi or limits)')
+        parser.add_argument('--max_error', type=float, default=None,
+                            help='Drop points whose Lucas-Kanade error exceeds this value '
+                                 '(only for item == pixel, poi or limits)')
+        parser.add_argument('--median_flow', type=float, default=None,
+                            help='Drop points moving more than this many median deviations away from the median flow '
+                                 '(only for item == poi, as it needs at least 3 points tracked together)')
+        parser.add_argument('--lk_budget', type=float, default=None,
+                            help='Adapt the pyramid levels, window size and iterations of Lucas-Kanade to the motion '
+                                 'of the points within this tracking time per frame, in ms (e.g. 16)')
+        parser.add_argument('--illumination', type=str, default=None,
+                            help='Normalize the illumination of the frames before tracking (clahe or gain)')
+        parser.add_argument('--clip_limit', type=float, default=2.0,
+                            help='Contrast limit of CLAHE (only with --illumination clahe)')
         parser.add_argument('--folder', type=str, default='',
                             help='Select the folder (only for item == limits)')
         parser.add_argument('--add', action='store_true',
                             help='Take new screenshots (only for item == limits)')
-        return parser.parse_args()
+        parser.add_argument('--encoding', type=str, default='raw',
+                            help='Encoding of the new screenshots: raw, png or jpg (only for item == limits)')
+        parser.add_argument('--relocalize', type=str, default=None, choices=Relocalizer.METHODS,
+                            help='Shortlist the screenshots similar to the live frame with these binary descriptors, '
+                                 'and place their pixels with a homography before refining them '
+                                 '(only for item == limits)')
+        parser.add_argument('--shortlist', type=int, default=3,
+                            help='Number of screenshots matched per frame (only with --relocalize)')
+        args = parser.parse_args()
+        args.cameras = [int(camera) for camera in args.camera.split(',')]
+        args.camera = args.cameras[0]
+        return args
+
+    @property
+    def metrics(self):
+        """
+        Build the instrumentation requested on the command line.
+
+        Returns:
+        - Metrics object, disabled if no metrics were requested.
+        """
+        enabled = self.args.metrics or self.args.metrics_file is not None or self.args.metrics_port is not None
+        return Metrics(enabled=enabled,
+                       overlay=self.args.metrics,
+                       path=self.args.metrics_file,
+                       port=self.args.metrics_port)
+
+    def camera_metrics(self, index, camera):
+        """
+        Build the instrumentation of one of several cameras, with its own file and port.
+
+        Parameters:
+        - index: Position of the camera in --camera.
+        - camera: Camera peripheral.
+
+        Returns:
+        - Metrics object, disabled if no metrics were requested.
+        """
+        enabled = self.args.metrics or self.args.metrics_file is not None or self.args.metrics_port is not None
+        path = None
+        if self.args.metrics_file is not None:
+            root, extension = os.path.splitext(self.args.metrics_file)
+            path = f'{root}_camera{camera}{extension}'
+        port = None if self.args.metrics_port is None else self.args.metrics_port + index
+        return Metrics(enabled=enabled, overlay=self.args.metrics, path=path, port=port)
+
+    @property
+    def validator(self):
+        """
+        Build the validation stage requested on the command line.
+
+        Returns:
+        - FlowValidator object, or None if no validation was requested.
+        """
+        if self.args.fb_threshold is None and self.args.max_error is None and self.args.median_flow is None:
+            return None
+        if self.args.median_flow is not None and self.args.item in ['pixel', 'limits']:
+            print(f'Warning: --median_flow needs at least 3 points tracked together, '
+                  f'it has no effect for item == {self.args.item}.')
+        return FlowValidator(fb_threshold=self.args.fb_threshold,
+                             max_error=self.args.max_error,
+                             median_factor=self.args.median_flow)
+
+    @property
+    def illumination(self):
+        """
+        Build the illumination normalization stage requested on the command line.
+
+        Returns:
+        - IlluminationNormalizer object, or None if no normalization was requested.
+        """
+        if self.args.illumination is None:
+            return None
+        return IlluminationNormalizer(self.args.illumination, clip_limit=self.args.clip_limit)
+
+    @property
+    def scheduler(self):
+        """
+        Build the adaptive Lucas-Kanade parameters requested on the command line.
+
+        Returns:
+        - LKScheduler object, or None if the parameters are fixed.
+        """
+        if self.args.lk_budget is None:
+            return None
+        return LKScheduler(budget=self.args.lk_budget / 1e3)
+
+    @property
+    def detector(self):
+        """
+        Build the detector of the points of interest requested on the command line.
+
+        Returns:
+        - Detector object.
+        """
+        return Detector(self.args.detector, downscale=self.args.detect_downscale, refine=not self.args.no_subpix)
+
+    @property
+    def predictor(self):
+        """
+        Build the motion prediction requested on the command line.
+
+        Returns:
+        - MotionPredictor object, or None if Lucas-Kanade starts from the previous positions.
+        """
+        if not self.args.predict:
+            return None
+        return MotionPredictor(max_coast=self.args.max_coast)
+
+    @property
+    def spatial_index(self):
+        """
+        Build the spatial index over the tracked points requested on the command line.
+
+        Returns:
+        - SpatialIndex object, or None if the points that merge are kept.
+        """
+        if self.args.dedup is None:
+            return None
+        return SpatialIndex(min_distance=self.args.dedup)
+
+    @property
+    def recorder(self):
+        """
+        Open the trajectory recording requested on the command line.
+
+        Returns:
+        - AsyncTrajectoryWriter object, or None if no recording was requested.
+        """
+        if self.args.record is None:
+            return None
+        return AsyncTrajectoryWriter(self.args.record)
+
+    def multi_camera(self):
+        """
+        Track every camera given to --camera concurrently, with an independent tracker per camera.
+        """
+        trackers = []
+        for index, camera in enumerate(self.args.cameras):
+            if self.args.item == 'pixel':
+                tracker = PixelTracker(camera, headless=True)
+            elif self.args.item == 'poi':
+                tracker = PoiTracker(camera,
+                                     self.args.n_poi,
+                                     headless=True,
+                                     replenish_every=self.args.replenish,
+                                     min_live=self.args.min_live,
+                                     crop=self.args.crop,
+                                     padding=self.args.crop_padding)
+                tracker.index = self.spatial_index
+                tracker.detector = self.detector
+            else:
+                print('Error: several cameras are only supported for item == pixel or poi.')
+                exit()
+            if self.args.roi is not None:
+                x_min, y_min, x_max, y_max = [int(value) for value in self.args.roi.split(',')]
+                if self.args.item == 'pixel':
+                    tracker.select_point(cv2.EVENT_LBUTTONDOWN, (x_min + x_max) // 2, (y_min + y_max) // 2, 0, None)
+                else:
+                    tracker.rect_start, tracker.rect_end = (x_min, y_min), (x_max, y_max)
+            tracker.metrics = self.camera_metrics(index, camera)
+            tracker.validator = self.validator
+            tracker.illumination = self.illumination
+            tracker.renderer = Renderer(enabled=not self.args.no_render, trail=self.args.trail)
+            tracker.flow.scheduler = self.scheduler
+            tracker.predictor = self.predictor
+            if self.args.record is not None:
+                root, extension = os.path.splitext(self.args.record)
+                tracker.recorder = AsyncTrajectoryWriter(f'{root}_camera{camera}{extension}')
+            trackers.append(tracker)
+        try:
+            MultiCamera(trackers,
+                        names=[str(camera) for camera in self.args.cameras],
+                        workers=self.args.workers,
+                        headless=self.args.headless,
+                        max_frames=self.args.max_frames).run()
+        finally:
+            for tracker in trackers:
+                if tracker.recorder is not None:
+                    tracker.recorder.close()
 
     def main(self):
         """
         Handle the parsed command-line arguments and
         initiate the corresponding tracking mechanism.
         """
+        if self.args.batch is not None:
+            BatchTracker(self.args.batch, self.args.workers).main()
+            return
+        if len(self.args.cameras) > 1:
+            self.multi_camera()
+            return
         if self.args.item == 'pixel':
-            PixelTracker(self.args.camera).main()
+            tracker = PixelTracker(self.args.camera)
         elif self.args.item == 'zone':
-            ZoneDelimiter(self.args.camera,
-                          self.args.mesh).main()
+            tracker = ZoneDelimiter(self.args.camera,
+                                    self.args.mesh,
+                                    dense=self.args.dense,
+                                    method=self.args.dense_method,
+                                    downscale=self.args.downscale,
+                                    every=self.args.dense_every,
+                                    track=self.args.track_zone,
+                                    grid_size=self.args.grid_size)
         elif self.args.item == 'poi':
+            source = self.args.camera if self.args.input is None else self.args.input
+            if self.args.headless:
+                if self.args.roi is None:
+                    print('Error: --roi is required with --headless.')
+                    exit()
+                roi = [int(value) for value in self.args.roi.split(',')]
+                tracker = PoiTracker(source,
+                                     self.args.n_poi,
+                                     headless=True,
+                                     replenish_every=self.args.replenish,
+                                     min_live=self.args.min_live,
+                                     crop=self.args.crop,
+                                     padding=self.args.crop_padding)
+                if not tracker.cap.isOpened():
+                    print(f'Error: cannot open {source}.')
+                    exit()
+                tracker.metrics = self.metrics
+                tracker.validator = self.validator
+                tracker.illumination = self.illumination
+                tracker.recorder = self.recorder
+                tracker.index = self.spatial_index
+                tracker.detector = self.detector
+                tracker.predictor = self.predictor
+                tracker.flow.scheduler = self.scheduler
+                try:
+                    tracker.run_headless(roi, self.args.out)
+                finally:
+                    # Flush the pending batches and surface the writer failures, even on Ctrl+C
+                    if tracker.recorder is not None:
+                        tracker.recorder.close()
+                return
             if self.args.track:
-                PoiTracker(self.args.camera,
-                           self.args.n_poi).main()
+                tracker = PoiTracker(source,
+                                     self.args.n_poi,
+                                     replenish_every=self.args.replenish,
+                                     min_live=self.args.min_live,
+                                     crop=self.args.crop,
+                                     padding=self.args.crop_padding)
+                tracker.index = self.spatial_index
             else:
-                PoiIdentifier(self.args.camera,
-                              self.args.n_poi).main()
+                tracker = PoiIdentifier(self.args.camera,
+                                        self.args.n_poi)
         elif self.args.item == 'limits':
             photographer = Photographer(camera=self.args.camera,
                                         folder=self.args.folder,
-                                        run=self.args.add)
-            PhotographsMatcher(camera=self.args.camera,
-                               photographer=photographer).main()
+                                        run=self.args.add,
+                                        encoding=self.args.encoding)
+            tracker = PhotographsMatcher(camera=self.args.camera,
+                                         photographer=photographer)
+            if self.args.relocalize is not None:
+                tracker.relocalizer = Relocalizer(self.args.relocalize, shortlist=self.args.shortlist)
+        else:
+            return
+        tracker.metrics = self.metrics
+        tracker.validator = self.validator
+        tracker.illumination = self.illumination
+        tracker.renderer = Renderer(enabled=not self.args.no_render, trail=self.args.trail)
+        tracker.recorder = self.recorder
+        if hasattr(tracker, 'flow'):
+            tracker.flow.scheduler = self.scheduler
+        if hasattr(tracker, 'detector'):
+            tracker.detector = self.detector
+        if hasattr(tracker, 'predictor'):
+            tracker.predictor = self.predictor
+        try:
+            if self.args.pipeline:
+                Pipeline(tracker,
+                         queue_size=self.args.queue_size,
+                         drop_oldest=not self.args.keep_frames,
+                         check_frames=self.args.check_frames).run()
+            else:
+                tracker.main()
+        finally:
+            # Flush the pending batches and surface the writer failures, even on Ctrl+C
+            if tracker.recorder is not None:
+                tracker.recorder.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,92 @@
+"""
+Batch tracker: A utility to track points of interest in many video files
+in parallel, with one headless POI tracker per worker process.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import time
+import os
+
+import cv2
+
+from src.poi_tracker import PoiTracker
+
+
+def init_worker():
+    """
+    Keep OpenCV single-threaded in each worker so that processes do not compete for cores.
+    """
+    cv2.setNumThreads(1)
+
+
+def track_video(job):
+    """
+    Track the points of interest of a single video without any window.
+
+    Parameters:
+    - job: Dictionary with the `input` video, its `roi` as [x0, y0, x1, y1],
+      and optionally `n_poi`, the `out` path of the trajectories and `crop` to track only a window around the POIs.
+
+    Returns:
+    - Dictionary with the input, output, number of frames and elapsed time.
+    A video that cannot be opened, or from which no frame can be read, raises an IOError.
+    """
+    out = job.get('out', os.path.splitext(job['input'])[0] + '.npz')
+    tracker = PoiTracker(job['input'], job.get('n_poi', 10), headless=True, crop=job.get('crop', False))
+    frames, elapsed = tracker.run_headless(job['roi'], out)
+    if frames == 0:
+        # An empty or corrupt video is a failure, not an empty success
+        os.remove(out)
+        raise IOError(f"no frame could be read from {job['input']}")
+    return dict(input=job['input'], out=out, frames=frames, elapsed=elapsed)
+
+
+class BatchTracker:
+
+    def __init__(self, jobs, workers=None):
+        """
+        Initialize the BatchTracker object.
+
+        Parameters:
+        - jobs: List of job dictionaries (see `track_video`), or path of a JSON file holding them.
+        - workers: Number of worker processes (defaults to the number of cores).
+        """
+        if isinstance(jobs, str):
+            with open(jobs) as file:
+                jobs = json.load(file)
+        self.jobs = jobs
+        self.workers = workers or os.cpu_count()
+        self.results = []
+
+    def main(self):
+        """
+        Fan the jobs out over the worker processes, collect their trajectories and report the throughput.
+        A job that fails is reported and does not stop the others.
+
+        Returns:
+        - List of the results of every job, in the order of the jobs, with an `error` entry for the failed ones.
+        """
+        start_time = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker) as executor:
+            futures = {executor.submit(track_video, job): i for i, job in enumerate(self.jobs)}
+            results = [None] * len(self.jobs)
+            for future in as_completed(futures):
+                job = self.jobs[futures[future]]
+                try:
+                    result = future.result()
+                except Exception as error:
+                    result = dict(input=job['input'], error=f'{type(error).__name__}: {error}')
+                    print(f"{result['input']}: failed ({result['error']}).")
+                else:
+                    print(f"{result['input']}: {result['frames']} frames saved to {result['out']}.")
+                results[futures[future]] = result
+        elapsed = time.perf_counter() - start_time
+        done = [result for result in results if 'error' not in result]
+        frames = sum(result['frames'] for result in done)
+        print(f'Tracked {len(done)} videos ({frames} frames) in {elapsed:.1f}s '
+              f'with {self.workers} workers ({frames / max(elapsed, 1e-9):.1f} fps overall).')
+        if len(done) < len(results):
+            print(f'{len(results) - len(done)} videos failed.')
+        self.results = results
+        return results
@@ -0,0 +1,24 @@
+"""
+Capture: A utility to open the frame source of a tracker, whether a camera,
+a video file, or any object exposing the `read()` method of cv2.VideoCapture.
+"""
+
+import cv2
+
+
+def open_capture(source, api=None):
+    """
+    Open a frame source.
+
+    Parameters:
+    - source: Index of a camera, path of a video file, or an already opened capture.
+    - api: Preferred capture API for cameras (e.g. cv2.CAP_DSHOW).
+
+    Returns:
+    - Object exposing `read()`, `isOpened()` and `release()` like cv2.VideoCapture.
+    """
+    if hasattr(source, 'read'):
+        return source
+    if isinstance(source, str) or api is None:
+        return cv2.VideoCapture(source)
+    return cv2.VideoCapture(source, api)
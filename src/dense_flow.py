@@ -0,0 +1,134 @@
+"""
+Dense flow: A utility to compute dense optical flow (Farneback or DIS) inside a zone
+only, on a downscaled grid, and to advect points by sampling the flow field.
+"""
+
+import numpy as np
+import cv2
+
+
+class DenseFlow:
+
+    METHODS = ['farneback', 'dis']
+    # Smallest side of a crop DIS accepts with its 8 px patches; smaller crops fall back to Farneback
+    DIS_MIN_SIZE = 12
+
+    def __init__(self, method='dis', downscale=2, every=1):
+        """
+        Initialize the DenseFlow object.
+
+        Parameters:
+        - method: Dense optical flow algorithm ('farneback' or 'dis').
+        - downscale: Factor by which the zone is shrunk before computing the flow.
+        - every: Compute the flow every this many frames only, and extrapolate the points
+          with their last velocity in between.
+        """
+        if method not in self.METHODS:
+            raise ValueError(f'method must be one of {self.METHODS}, not {method!r}')
+        self.method = method
+        self.downscale = downscale
+        self.every = max(1, every)
+        if method == 'dis':
+            self.dis = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_ULTRAFAST)
+        self.rect = None
+        self.points = None
+        self.anchor = None
+        self.anchor_img = None
+        self.velocity = None
+        self.since = 0
+
+    def reset(self, rect, points):
+        """
+        Start advecting new points inside a new zone.
+
+        Parameters:
+        - rect: Zone in which the flow is computed, as (x_min, y_min, x_max, y_max).
+        - points: Array of shape (N, 2) of the points to advect.
+        """
+        self.rect = tuple(int(v) for v in rect)
+        self.points = np.asarray(points, dtype=np.float32).reshape(-1, 2).copy()
+        self.anchor = self.points.copy()
+        self.anchor_img = None
+        self.velocity = np.zeros_like(self.points)
+        self.since = 0
+
+    def crop(self, gray_frame):
+        """
+        Crop the zone out of a grayscale frame and downscale it.
+
+        Returns:
+        - The crop, or None if the zone does not overlap the frame.
+        """
+        x_min, y_min, x_max, y_max = self.rect
+        crop = gray_frame[max(y_min, 0):max(y_max, 0), max(x_min, 0):max(x_max, 0)]
+        if crop.size == 0:
+            return None
+        if self.downscale > 1:
+            size = (max(2, crop.shape[1] // self.downscale), max(2, crop.shape[0] // self.downscale))
+            return cv2.resize(crop, size, interpolation=cv2.INTER_AREA)
+        # The crop is kept as the anchor for several frames, while the frame buffer it views is reused
+        return crop.copy()
+
+    def flow(self, prev_img, next_img):
+        """
+        Compute the dense flow field between two crops. Crops too small for DIS use Farneback.
+
+        Returns:
+        - Array of shape (height, width, 2) of displacements, in crop pixels.
+        """
+        if self.method == 'dis' and min(prev_img.shape[:2]) >= self.DIS_MIN_SIZE:
+            return self.dis.calc(prev_img, next_img, None)
+        return cv2.calcOpticalFlowFarneback(prev_img, next_img, None, 0.5, 3, 15, 3, 5, 1.2, 0)
+
+    @staticmethod
+    def sample(field, points):
+        """
+        Sample a field at sub-pixel positions with bilinear interpolation.
+
+        Parameters:
+        - field: Array of shape (height, width, channels).
+        - points: Array of shape (N, 2) of (x, y) positions, clipped to the field.
+
+        Returns:
+        - Array of shape (N, channels) of interpolated values.
+        """
+        height, width = field.shape[:2]
+        x = np.clip(points[:, 0], 0, width - 1.001)
+        y = np.clip(points[:, 1], 0, height - 1.001)
+        x0, y0 = x.astype(int), y.astype(int)
+        fx, fy = (x - x0)[:, None], (y - y0)[:, None]
+        top = field[y0, x0] * (1 - fx) + field[y0, x0 + 1] * fx
+        bottom = field[y0 + 1, x0] * (1 - fx) + field[y0 + 1, x0 + 1] * fx
+        return top * (1 - fy) + bottom * fy
+
+    def update(self, gray_frame):
+        """
+        Advect the points to a new frame.
+
+        Parameters:
+        - gray_frame: Grayscale image of the whole frame.
+
+        Returns:
+        - Array of shape (N, 2) of the advected points, unchanged if the zone is empty.
+        """
+        crop = self.crop(gray_frame)
+        if crop is None:
+            return self.points
+        if self.anchor_img is None:
+            self.anchor_img = crop
+            return self.points
+        self.since += 1
+        if self.since >= self.every:
+            field = self.flow(self.anchor_img, crop)
+            x_min, y_min = max(self.rect[0], 0), max(self.rect[1], 0)
+            positions = (self.anchor - (x_min, y_min)) / self.downscale
+            displacements = self.sample(field, positions) * self.downscale
+            self.points = self.anchor + displacements
+            self.velocity = displacements / self.since
+            self.anchor = self.points.copy()
+            self.anchor_img = crop
+            self.since = 0
+        else:
+            # Constant-velocity extrapolation from the last flow computation
+            self.points = self.anchor + self.velocity * self.since
+        return self.points
@@ -0,0 +1,112 @@
+"""
+Detector: A utility to detect points of interest coarse-to-fine, on a downscaled
+image first and then refined at full resolution with sub-pixel accuracy,
+with Shi-Tomasi, FAST or ORB as detection backend.
+"""
+
+import numpy as np
+import cv2
+
+from src.spatial_index import SpatialIndex
+
+
+class Detector:
+
+    METHODS = ['shi-tomasi', 'fast', 'orb']
+
+    def __init__(self, method='shi-tomasi', downscale=1, refine=True, window=5, quality_level=0.01,
+                 min_distance=10, fast_threshold=20):
+        """
+        Initialize the Detector object.
+
+        Parameters:
+        - method: Detection backend ('shi-tomasi' for goodFeaturesToTrack, 'fast' or 'orb' for keypoints).
+        - downscale: Factor by which the image is downscaled before detection (1 to detect at full resolution).
+        - refine: Boolean indicating whether the corners are refined at full resolution with cornerSubPix.
+        - window: Half size of the cornerSubPix search window at full resolution, in pixels
+          (widened to the downscale factor, which is how far a coarse corner may be from the true one).
+        - quality_level: Minimal quality of the Shi-Tomasi corners, relative to the best one.
+        - min_distance: Minimal distance between two corners at full resolution, in pixels.
+        - fast_threshold: Intensity threshold of the FAST test (also used by ORB).
+        """
+        if method not in self.METHODS:
+            raise ValueError(f'method must be one of {self.METHODS}, not {method!r}')
+        self.method = method
+        self.downscale = max(int(downscale), 1)
+        self.refine = refine
+        self.window = max(int(window), self.downscale)
+        self.quality_level = quality_level
+        self.min_distance = min_distance
+        self.criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03)
+        if method == 'fast':
+            self.fast = cv2.FastFeatureDetector_create(threshold=fast_threshold, nonmaxSuppression=True)
+        elif method == 'orb':
+            self.orb = cv2.ORB_create(fastThreshold=fast_threshold, edgeThreshold=15, patchSize=15)
+
+    def keypoints(self, image, max_corners, mask, min_distance):
+        """
+        Detect corners with the selected backend.
+
+        Parameters:
+        - image: Grayscale image, possibly downscaled.
+        - max_corners: Maximum number of corners.
+        - mask: Optional uint8 mask of the zone where corners may be detected.
+        - min_distance: Minimal distance between two corners in this image, in pixels.
+
+        Returns:
+        - Float32 array of shape (N, 2), the strongest corners first.
+        """
+        if self.method == 'shi-tomasi':
+            corners = cv2.goodFeaturesToTrack(image, maxCorners=max_corners, qualityLevel=self.quality_level,
+                                              minDistance=min_distance, mask=mask)
+            return np.empty((0, 2), np.float32) if corners is None else corners.reshape(-1, 2)
+        if self.method == 'fast':
+            keypoints = self.fast.detect(image, mask)
+        else:
+            self.orb.setMaxFeatures(4 * max_corners)
+            keypoints = self.orb.detect(image, mask)
+        if not keypoints:
+            return np.empty((0, 2), np.float32)
+        keypoints = sorted(keypoints, key=lambda keypoint: -keypoint.response)
+        corners = np.array([keypoint.pt for keypoint in keypoints], dtype=np.float32)
+        # Keypoints are not spread by the backends: drop the weaker of two close ones
+        index = SpatialIndex(min_distance)
+        index.reset(image.shape[1], image.shape[0], len(corners))
+        kept = np.ones(len(corners), dtype=bool)
+        kept[index.update(corners, kept)] = False
+        return corners[kept][:max_corners]
+
+    def detect(self, gray_frame, max_corners, mask=None, min_distance=None):
+        """
+        Detect points of interest on a downscaled copy of a grayscale image,
+        and refine them at full resolution.
+
+        Parameters:
+        - gray_frame: Grayscale image.
+        - max_corners: Maximum number of points.
+        - mask: Optional uint8 mask of the zone where points may be detected, of the size of the image.
+        - min_distance: Minimal distance between two points, in pixels (defaults to the detector's).
+
+        Returns:
+        - Float32 array of shape (N, 1, 2) of points in the image, possibly empty.
+        """
+        min_distance = self.min_distance if min_distance is None else min_distance
+        height, width = gray_frame.shape[:2]
+        image = gray_frame
+        if self.downscale > 1:
+            size = (max(width // self.downscale, 1), max(height // self.downscale, 1))
+            image = cv2.resize(gray_frame, size, interpolation=cv2.INTER_AREA)
+            if mask is not None:
+                mask = cv2.resize(mask, size, interpolation=cv2.INTER_NEAREST)
+        corners = self.keypoints(image, max_corners, mask, max(min_distance / self.downscale, 1))
+        if len(corners) == 0:
+            return corners.reshape(-1, 1, 2)
+        if self.downscale > 1:
+            # Centers of the downscaled pixels at full resolution
+            corners = (corners + 0.5) * self.downscale - 0.5
+        corners = corners.reshape(-1, 1, 2)
+        if self.refine:
+            cv2.cornerSubPix(gray_frame, corners, (self.window, self.window), (-1, -1), self.criteria)
+            np.clip(corners[..., 0], 0, width - 1, out=corners[..., 0])
+            np.clip(corners[..., 1], 0, height - 1, out=corners[..., 1])
+        return corners
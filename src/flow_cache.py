@@ -0,0 +1,85 @@
+"""
+Flow cache: A utility to keep the last grayscale frame and hand it over
+as the previous frame on the next Lucas-Kanade call, with parameters that
+are either fixed or chosen by an LKScheduler.
+"""
+
+import cv2
+
+
+class FlowCache:
+
+    def __init__(self, lk_params):
+        """
+        Initialize the FlowCache object.
+
+        Parameters:
+        - lk_params: Parameters for Lucas-Kanade optical flow (winSize, maxLevel, criteria).
+        """
+        self.lk_params = lk_params
+        self.prev_img = None
+        self.next_img = None
+
+        # Optional LKScheduler replacing the fixed parameters
+        self.scheduler = None
+
+    @property
+    def ready(self):
+        """
+        Whether a previous and a next frame are both available.
+        """
+        return self.prev_img is not None and self.next_img is not None
+
+    @property
+    def params(self):
+        """
+        Parameters of the next Lucas-Kanade call: the fixed ones, or those chosen by the scheduler.
+        """
+        return self.lk_params if self.scheduler is None else self.scheduler.params
+
+    def update(self, img):
+        """
+        Push a new frame and hand the last one over as the previous frame.
+        The frame is kept by reference, so the caller must not write into it afterwards.
+
+        Parameters:
+        - img: Grayscale image of the new frame.
+
+        Returns:
+        - The new frame.
+        """
+        self.prev_img = self.next_img
+        self.next_img = img
+        if self.scheduler is not None:
+            self.scheduler.frame()
+        return img
+
+    def reset(self):
+        """
+        Forget the cached frames.
+        """
+        self.prev_img = None
+        self.next_img = None
+
+    def calc(self, prev_pts, next_pts=None, prev_img=None, next_img=None, **kwargs):
+        """
+        Run Lucas-Kanade optical flow between cached frames.
+
+        Parameters:
+        - prev_pts: Points to track, as an (N, 1, 2) float32 array.
+        - next_pts: Initial guesses for the tracked points (optional).
+        - prev_img: Image to track from (defaults to the previous frame).
+        - next_img: Image to track to (defaults to the last frame).
+        - kwargs: Overrides for the Lucas-Kanade parameters.
+
+        Returns:
+        - Tuple (next_pts, status, error) as returned by calcOpticalFlowPyrLK.
+        """
+        prev_img = self.prev_img if prev_img is None else prev_img
+        next_img = self.next_img if next_img is None else next_img
+        params = dict(self.params, **kwargs)
+        next_pts, status, error = cv2.calcOpticalFlowPyrLK(prev_img, next_img, prev_pts, next_pts, **params)
+        # Calls with flags, such as the reverse pass of the FlowValidator, do not measure the motion
+        if self.scheduler is not None and 'flags' not in kwargs and status is not None:
+            self.scheduler.observe(prev_pts, next_pts, status)
+        return next_pts, status, error
@@ -0,0 +1,56 @@
+"""
+Frame buffers: A utility to read frames and convert them to grayscale into
+preallocated arrays, so that the frame loop does not allocate an image per frame.
+"""
+
+import numpy as np
+import cv2
+
+
+class FrameBuffers:
+
+    def __init__(self):
+        """
+        Initialize the FrameBuffers object. The BGR buffer suits a sequential frame loop,
+        where a frame is done with before the next one is read.
+        """
+        self.frame = None
+
+        # Two grayscale buffers, swapped on every frame: one holds the previous frame
+        # of the flow cache while the other receives the new one
+        self.grays = [None, None]
+        self.gray_index = 0
+
+    def read(self, cap):
+        """
+        Read the next frame into the BGR buffer, like cv2.VideoCapture.read().
+        The buffer is allocated by the first read and reused as long as the frame size does not change.
+
+        Parameters:
+        - cap: Capture exposing `read(image)`.
+
+        Returns:
+        - Tuple (ret, frame).
+        """
+        ret, frame = cap.read(self.frame)
+        if ret:
+            self.frame = frame
+        return ret, frame
+
+    def gray(self, frame):
+        """
+        Convert a BGR frame to grayscale into the buffer that does not hold the previous frame.
+        The returned image is overwritten two calls later.
+
+        Parameters:
+        - frame: BGR image.
+
+        Returns:
+        - Grayscale image.
+        """
+        buffer = self.grays[self.gray_index]
+        if buffer is None or buffer.shape != frame.shape[:2]:
+            buffer = self.grays[self.gray_index] = np.empty(frame.shape[:2], dtype=np.uint8)
+        cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=buffer)
+        self.gray_index ^= 1
+        return buffer
@@ -0,0 +1,86 @@
+"""
+Illumination normalizer: A preprocessing stage compensating brightness changes
+before Lucas-Kanade, either with CLAHE or with a gain/offset computed from the
+frame statistics, applied in place on the grayscale frame.
+"""
+
+import numpy as np
+import cv2
+
+
+class IlluminationNormalizer:
+
+    METHODS = ['clahe', 'gain']
+
+    def __init__(self, method='gain', roi=None, clip_limit=2.0, tile_size=8, target=None):
+        """
+        Initialize the IlluminationNormalizer object.
+
+        Parameters:
+        - method: Normalization ('clahe' for local histogram equalization, 'gain' to match the
+          mean and contrast of a reference frame with a single lookup table).
+        - roi: Zone to normalize with CLAHE and on which the statistics are measured,
+          as (x_min, y_min, x_max, y_max) (defaults to the whole frame).
+        - clip_limit: Contrast limit of CLAHE.
+        - tile_size: Number of CLAHE tiles along each axis.
+        - target: (mean, standard deviation) the frames are mapped to with the 'gain' method
+          (defaults to the statistics of the first normalized frame).
+        """
+        if method not in self.METHODS:
+            raise ValueError(f'method must be one of {self.METHODS}, not {method!r}')
+        self.method = method
+        self.roi = None if roi is None else tuple(int(v) for v in roi)
+        self.target = target
+        self.learned = target is None
+        if method == 'clahe':
+            self.clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=(tile_size, tile_size))
+
+        # Buffers of the lookup table, reused by every frame
+        self.ramp = np.arange(256, dtype=np.float32)
+        self.levels = np.empty(256, dtype=np.float32)
+        self.lut = np.empty(256, dtype=np.uint8)
+
+    def reset(self):
+        """
+        Forget the statistics learned from the first frame.
+        """
+        if self.learned:
+            self.target = None
+
+    def region(self, gray_frame):
+        """
+        View of the zone of a grayscale frame, sharing its memory.
+        """
+        if self.roi is None:
+            return gray_frame
+        x_min, y_min, x_max, y_max = self.roi
+        return gray_frame[max(y_min, 0):y_max, max(x_min, 0):x_max]
+
+    def apply(self, gray_frame):
+        """
+        Normalize the illumination of a grayscale frame, in place.
+
+        Parameters:
+        - gray_frame: uint8 grayscale image, overwritten with the normalized image.
+
+        Returns:
+        - The normalized frame (the same buffer).
+        """
+        region = self.region(gray_frame)
+        if region.size == 0:
+            return gray_frame
+        if self.method == 'clahe':
+            self.clahe.apply(region, dst=region)
+            return gray_frame
+
+        mean, std = cv2.meanStdDev(region)
+        mean, std = float(mean[0, 0]), max(float(std[0, 0]), 1e-3)
+        if self.target is None:
+            self.target = (mean, std)
+        gain = self.target[1] / std
+        np.multiply(self.ramp, gain, out=self.levels)
+        np.add(self.levels, self.target[0] - gain * mean, out=self.levels)
+        np.clip(self.levels, 0, 255, out=self.levels)
+        np.copyto(self.lut, self.levels, casting='unsafe')
+        cv2.LUT(gray_frame, self.lut, dst=gray_frame)
+        return gray_frame
@@ -0,0 +1,129 @@
+"""
+LK scheduler: A utility adapting the Lucas-Kanade parameters (pyramid levels, window size
+and iteration count) to the motion of the tracked points and to a frame-time budget.
+"""
+
+import threading
+import time
+
+import numpy as np
+import cv2
+
+
+class LKScheduler:
+
+    def __init__(self, budget=0.016, win_sizes=(9, 15, 21, 31), levels=(0, 1, 2, 3, 4), iterations=(3, 5, 10, 20),
+                 period=5, smoothing=0.3):
+        """
+        Initialize the LKScheduler object. It starts from the default parameters of the trackers
+        (15x15 window, 2 pyramid levels, 10 iterations).
+
+        Parameters:
+        - budget: Target tracking time per frame, from the arrival of the frame in the flow cache
+          to the end of its last Lucas-Kanade call, in seconds.
+        - win_sizes: Window sizes the scheduler chooses from, in increasing order.
+        - levels: Numbers of pyramid levels the scheduler chooses from, in increasing order.
+        - iterations: Iteration counts the scheduler chooses from, in increasing order.
+        - period: Number of frames between two adjustments, so that each one can be measured.
+        - smoothing: Weight of the last frame in the moving averages of the displacement and frame time.
+        """
+        self.budget = budget
+        self.win_sizes = win_sizes
+        self.levels = levels
+        self.iterations = iterations
+        self.period = period
+        self.smoothing = smoothing
+        self.win_index = self.nearest(win_sizes, 15)
+        self.level_index = self.nearest(levels, 2)
+        self.iteration_index = self.nearest(iterations, 10)
+        self.displacement = None
+        self.frame_time = None
+        self.start = None
+        self.end = None
+        self.frames = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def nearest(values, value):
+        """
+        Index of the value of a list closest to a given value.
+        """
+        return int(np.argmin(np.abs(np.asarray(values) - value)))
+
+    @property
+    def params(self):
+        """
+        Current parameters for Lucas-Kanade optical flow (winSize, maxLevel, criteria).
+        """
+        win_size = self.win_sizes[self.win_index]
+        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, self.iterations[self.iteration_index], 0.03)
+        return dict(winSize=(win_size, win_size), maxLevel=self.levels[self.level_index], criteria=criteria)
+
+    @property
+    def reach(self):
+        """
+        Half a window at the coarsest level, in pixels. Lucas-Kanade reliably follows about a quarter of it.
+        """
+        return self.win_sizes[self.win_index] // 2 * 2 ** self.levels[self.level_index]
+
+    def average(self, mean, value):
+        """
+        Exponential moving average update.
+        """
+        return value if mean is None else (1 - self.smoothing) * mean + self.smoothing * value
+
+    def observe(self, prev_pts, next_pts, status):
+        """
+        Record the displacement of the points found by a Lucas-Kanade call, and the time at which it ended.
+
+        Parameters:
+        - prev_pts, next_pts: Tracked points and their new positions.
+        - status: Status returned by the call.
+        """
+        self.end = time.perf_counter()
+        found = status.reshape(-1) == 1
+        if not found.any():
+            return
+        displacements = np.linalg.norm(next_pts.reshape(-1, 2)[found] - prev_pts.reshape(-1, 2)[found], axis=1)
+        with self.lock:
+            self.displacement = self.average(self.displacement, float(np.median(displacements)))
+
+    def frame(self):
+        """
+        Mark the arrival of a new frame, record the tracking time of the previous one
+        (time spent waiting for the camera is not counted), and adjust the parameters once per period,
+        or at once if the points move faster than the current parameters can follow.
+        """
+        with self.lock:
+            if self.start is not None and self.end is not None and self.end > self.start:
+                self.frame_time = self.average(self.frame_time, self.end - self.start)
+            self.start = time.perf_counter()
+            self.frames += 1
+            urgent = (self.displacement or 0.0) > self.reach / 4
+            if self.frame_time is not None and (urgent or self.frames % self.period == 0):
+                self.adjust()
+
+    def adjust(self):
+        """
+        Move one parameter by one step: cheaper parameters when over budget, more pyramid levels
+        (then a larger window) when the points move close to the reach of the current parameters,
+        fewer levels and iterations when they barely move, and more iterations when time is left.
+        """
+        displacement = self.displacement or 0.0
+        if self.frame_time > self.budget:
+            if self.iteration_index > 0:
+                self.iteration_index -= 1
+            elif self.win_index > 0 and displacement < self.reach / 4:
+                self.win_index -= 1
+        elif displacement > self.reach / 4:
+            if self.level_index < len(self.levels) - 1:
+                self.level_index += 1
+            elif self.win_index < len(self.win_sizes) - 1:
+                self.win_index += 1
+        elif displacement < self.reach / 16:
+            if self.level_index > 0:
+                self.level_index -= 1
+            elif self.iteration_index > 0:
+                self.iteration_index -= 1
+        elif self.frame_time < self.budget / 2 and self.iteration_index < len(self.iterations) - 1:
+            self.iteration_index += 1
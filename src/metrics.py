@@ -0,0 +1,195 @@
+"""
+Metrics: A lightweight instrumentation layer timing each stage of the frame loop,
+with a rolling overlay and a Prometheus-style export of the counters.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+import os
+
+import numpy as np
+import cv2
+
+
+class Metrics:
+
+    def __init__(self, enabled=False, capacity=300, overlay=False, path=None, port=None, export_every=30):
+        """
+        Initialize the Metrics object.
+
+        Parameters:
+        - enabled: Boolean indicating whether anything is recorded. When disabled, every call returns at once.
+        - capacity: Number of frames kept in the ring buffers.
+        - overlay: Boolean indicating whether the rolling statistics are drawn on the frames.
+        - path: Path of a file to which the metrics are periodically written (optional).
+        - port: Port of a local HTTP endpoint serving the metrics (optional).
+        - export_every: Number of frames between two writes of the metrics file.
+        """
+        self.enabled = enabled
+        self.capacity = capacity
+        self.overlay = overlay
+        self.path = path
+        self.export_every = export_every
+        self.stages = {}
+        self.laps = {}
+        self.counters = dict(frames=0, points_tracked=0, points_lost=0)
+        self.timestamps = np.zeros(capacity)
+        self.last = 0.0
+        self.server = None
+        if enabled and port is not None:
+            self.serve(port)
+
+    def start(self):
+        """
+        Mark the beginning of a frame.
+        """
+        if not self.enabled:
+            return
+        self.last = time.perf_counter()
+        self.timestamps[self.counters['frames'] % self.capacity] = self.last
+
+    def lap(self, stage):
+        """
+        Record the time spent in a stage since the beginning of the frame or the previous lap.
+
+        Parameters:
+        - stage: Name of the stage that just finished.
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if stage not in self.stages:
+            self.stages[stage] = np.zeros(self.capacity)
+            self.laps[stage] = 0
+        self.stages[stage][self.laps[stage] % self.capacity] = now - self.last
+        self.laps[stage] += 1
+        self.last = now
+
+    def count(self, name, value=1):
+        """
+        Increment a counter.
+
+        Parameters:
+        - name: Name of the counter.
+        - value: Increment.
+        """
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def end(self):
+        """
+        Mark the end of a frame, and write the metrics file if it is due.
+        """
+        if not self.enabled:
+            return
+        self.counters['frames'] += 1
+        if self.path is not None and self.counters['frames'] % self.export_every == 0:
+            self.export(self.path)
+
+    @property
+    def fps(self):
+        """
+        Rolling number of frames per second over the ring buffer.
+        """
+        n = min(self.counters['frames'], self.capacity)
+        if n < 2:
+            return 0.0
+        timestamps = self.timestamps[:n]
+        return (n - 1) / max(timestamps.max() - timestamps.min(), 1e-9)
+
+    def summary(self):
+        """
+        Rolling latency percentiles of every stage.
+
+        Returns:
+        - Dictionary mapping each stage to its (p50, p99) latencies in seconds.
+        """
+        summary = {}
+        for stage, latencies in list(self.stages.items()):
+            latencies = latencies[:min(self.laps[stage], self.capacity)]
+            summary[stage] = tuple(np.percentile(latencies, [50, 99]))
+        return summary
+
+    def draw(self, frame):
+        """
+        Draw the rolling frame rate and stage latencies on a frame, if the overlay is enabled.
+
+        Parameters:
+        - frame: BGR image to draw on.
+
+        Returns:
+        - The annotated frame.
+        """
+        if not (self.enabled and self.overlay):
+            return frame
+        lines = [f'FPS: {self.fps:.1f}']
+        lines += [f'{stage}: p50 {p50 * 1e3:.1f} ms / p99 {p99 * 1e3:.1f} ms'
+                  for stage, (p50, p99) in self.summary().items()]
+        for i, line in enumerate(lines):
+            cv2.putText(frame, line, (10, 20 + 18 * i), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 1)
+        return frame
+
+    def prometheus(self):
+        """
+        Format the counters, frame rate and stage latencies in the Prometheus text format.
+
+        Returns:
+        - The metrics, as a string.
+        """
+        lines = []
+        for name, value in list(self.counters.items()):
+            lines += [f'# TYPE optiflow_{name}_total counter', f'optiflow_{name}_total {value}']
+        lines += ['# TYPE optiflow_fps gauge', f'optiflow_fps {self.fps:.3f}',
+                  '# TYPE optiflow_stage_latency_seconds summary']
+        for stage, (p50, p99) in self.summary().items():
+            lines += [f'optiflow_stage_latency_seconds{{stage="{stage}",quantile="0.5"}} {p50:.6f}',
+                      f'optiflow_stage_latency_seconds{{stage="{stage}",quantile="0.99"}} {p99:.6f}']
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path):
+        """
+        Write the metrics to a file, atomically so that readers never see a partial file.
+
+        Parameters:
+        - path: Path of the metrics file.
+        """
+        with open(f'{path}.tmp', 'w') as file:
+            file.write(self.prometheus())
+        os.replace(f'{path}.tmp', path)
+
+    def serve(self, port):
+        """
+        Serve the metrics on a local HTTP endpoint, from a background thread.
+
+        Parameters:
+        - port: Port of the endpoint.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f'Metrics served on http://127.0.0.1:{port}/metrics')
+
+    def close(self):
+        """
+        Write the last metrics and stop the endpoint.
+        """
+        if self.enabled and self.path is not None:
+            self.export(self.path)
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
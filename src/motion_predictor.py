@@ -0,0 +1,232 @@
+"""
+Motion predictor: A constant-velocity Kalman filter over the whole array of tracked points,
+predicting where each point will be on the next frame to seed Lucas-Kanade, and letting
+the points that are not found coast on their prediction until they are found again.
+"""
+
+import numpy as np
+import cv2
+
+from src.validation import FlowValidator
+
+
+class MotionPredictor:
+
+    def __init__(self, process_noise=1.0, measurement_noise=0.1, max_coast=10, patch=31, gate=3.0, max_error=8.0,
+                 fb_threshold=1.0):
+        """
+        Initialize the MotionPredictor object. The x and y axes share the same model, so each point
+        only keeps one 2x2 covariance (position and velocity) for both.
+
+        Parameters:
+        - process_noise: Variance of the acceleration of the points, in squared pixels per squared frame.
+        - measurement_noise: Variance of the positions found by Lucas-Kanade, in squared pixels.
+        - max_coast: Number of frames a point that is not found coasts on its prediction before it is lost.
+        - patch: Minimum size of the patches kept around the points when they disappear, and searched
+          around their prediction to find them again, in pixels. The patches always hold twice
+          the current Lucas-Kanade window, so that the window fits around the point with room to search.
+        - gate: Number of standard deviations of the prediction beyond which a measured position is rejected.
+        - max_error: Maximum Lucas-Kanade error between a patch and the frame for its point to be found again
+          (a patch always matches something nearby, so reacquisitions are checked more strictly than tracking).
+        - fb_threshold: Maximum forward-backward error of the measurements correcting the filters, in pixels.
+          A point partially hidden by an occluder drifts within the gate, and would corrupt its velocity.
+        """
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.max_coast = max_coast
+        self.patch = patch | 1
+        self.gate = gate
+        self.max_error = max_error
+        self.validator = FlowValidator(fb_threshold=fb_threshold)
+        self.state = None
+        self.covariance = None
+        self.coasting = None
+        self.templates = None
+        self.anchors = None
+        self.prediction = None
+
+    def reset(self, points):
+        """
+        Start a filter for every point slot, at rest at the given positions.
+
+        Parameters:
+        - points: Positions of shape (N, 1, 2) or (N, 2).
+        """
+        n = len(points)
+        # x, y, vx, vy of every point
+        self.state = np.zeros((n, 4), dtype=np.float32)
+        # Position variance, position-velocity covariance and velocity variance of every point
+        self.covariance = np.zeros((n, 3), dtype=np.float32)
+        # Number of frames since every point was last found (0 for the points found on the last frame)
+        self.coasting = np.zeros(n, dtype=np.int32)
+        # Patches around the points where they were last found, and their positions in the patches
+        self.templates = np.zeros((n, self.patch, self.patch), dtype=np.uint8)
+        self.anchors = np.zeros((n, 2), dtype=np.float32)
+        self.prediction = np.zeros((n, 1, 2), dtype=np.float32)
+        self.spawn(np.arange(n), points)
+
+    def spawn(self, indices, points):
+        """
+        Restart the filters of some slots, at rest at new positions (for instance replenished points).
+        """
+        self.state[indices, :2] = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        self.state[indices, 2:] = 0
+        # The velocity of a new point is unknown: a few pixels per frame either way
+        self.covariance[indices] = (self.measurement_noise, 0, 25)
+        self.coasting[indices] = 0
+
+    def predict(self):
+        """
+        Advance every filter by one frame.
+
+        Returns:
+        - Predicted positions of every slot, of shape (N, 1, 2), overwritten by the next call.
+        """
+        self.state[:, :2] += self.state[:, 2:]
+        position, covariance, velocity = self.covariance.T
+        q = self.process_noise
+        self.covariance[:] = np.stack([position + 2 * covariance + velocity + q / 4,
+                                       covariance + velocity + q / 2,
+                                       velocity + q], axis=1)
+        np.copyto(self.prediction.reshape(-1, 2), self.state[:, :2])
+        return self.prediction
+
+    def consistent(self, indices, measured):
+        """
+        Whether some measured positions agree with the prediction. A point that Lucas-Kanade moved
+        further than the uncertainty of its prediction most likely jumped to another feature,
+        and is better left coasting than followed with a wrong velocity.
+
+        Parameters:
+        - indices: Indices of the points.
+        - measured: Their positions, of shape (len(indices), 1, 2) or (len(indices), 2).
+
+        Returns:
+        - Boolean array of the consistent measurements.
+        """
+        innovation = np.asarray(measured, dtype=np.float32).reshape(-1, 2) - self.state[indices, :2]
+        variance = self.covariance[indices, 0] + self.measurement_noise
+        return (innovation ** 2).sum(axis=1) <= self.gate ** 2 * variance
+
+    def correct(self, indices, measured):
+        """
+        Update the filters of the points found on this frame with their measured positions.
+
+        Parameters:
+        - indices: Indices of the points.
+        - measured: Their positions, of shape (len(indices), 1, 2) or (len(indices), 2).
+        """
+        if len(indices) == 0:
+            return
+        position, covariance, velocity = self.covariance[indices].T
+        gain_position = position / (position + self.measurement_noise)
+        gain_velocity = covariance / (position + self.measurement_noise)
+        innovation = np.asarray(measured, dtype=np.float32).reshape(-1, 2) - self.state[indices, :2]
+        self.state[indices, :2] += gain_position[:, None] * innovation
+        self.state[indices, 2:] += gain_velocity[:, None] * innovation
+        self.covariance[indices] = np.stack([(1 - gain_position) * position,
+                                             (1 - gain_position) * covariance,
+                                             velocity - gain_velocity * covariance], axis=1)
+        self.coasting[indices] = 0
+
+    @property
+    def size(self):
+        """
+        Current size of the patches, in pixels.
+        """
+        return self.templates.shape[1]
+
+    def fit(self, flow):
+        """
+        Grow the patches to twice the current Lucas-Kanade window, which the scheduler may have enlarged
+        since they were cut. The kept patches are padded by replicating their borders.
+
+        Parameters:
+        - flow: FlowCache whose parameters the reacquisitions use.
+        """
+        size = max(self.patch, 2 * max(flow.params['winSize']) + 1) | 1
+        pad = (size - self.size) // 2
+        if pad > 0:
+            self.templates = np.pad(self.templates, ((0, 0), (pad, pad), (pad, pad)), mode='edge')
+            self.anchors += pad
+
+    def patches(self, gray_frame, centers):
+        """
+        Square patches of a grayscale image around some integer centers, replicating its borders.
+
+        Returns:
+        - Array of shape (len(centers), size, size).
+        """
+        offsets = np.arange(self.size) - self.size // 2
+        height, width = gray_frame.shape[:2]
+        rows = np.clip(centers[:, 1, None, None] + offsets[None, :, None], 0, height - 1)
+        columns = np.clip(centers[:, 0, None, None] + offsets[None, None, :], 0, width - 1)
+        return gray_frame[rows, columns]
+
+    def occlude(self, flow, indices, positions, gray_frame):
+        """
+        Start coasting some points that were not found, keeping the patches around their last positions.
+
+        Parameters:
+        - flow: FlowCache whose parameters the reacquisitions use.
+        - indices: Indices of the points.
+        - positions: Their last positions in the grayscale image, of shape (len(indices), 1, 2) or (len(indices), 2).
+        - gray_frame: Grayscale image in which they were last found.
+        """
+        if len(indices) == 0:
+            return
+        self.fit(flow)
+        positions = np.asarray(positions, dtype=np.float32).reshape(-1, 2)
+        centers = np.round(positions).astype(int)
+        self.templates[indices] = self.patches(gray_frame, centers)
+        self.anchors[indices] = positions - centers + self.size // 2
+        self.coasting[indices] = 1
+
+    def reacquire(self, flow, gray_frame, indices, offset=(0, 0)):
+        """
+        Look for coasting points around their prediction, with a single Lucas-Kanade call
+        between their patches and the patches around their prediction, stacked into two images.
+
+        Parameters:
+        - flow: FlowCache running the call.
+        - gray_frame: Grayscale image of the current frame.
+        - indices: Indices of the coasting points.
+        - offset: Position of the grayscale image in the frame, when it is a window of it.
+
+        Returns:
+        - Tuple (found, measured) of a boolean array of the points found again and their positions in the frame.
+        """
+        if len(indices) == 0:
+            return np.zeros(0, dtype=bool), np.zeros((0, 2), dtype=np.float32)
+        self.fit(flow)
+        size = self.size
+        offset = np.asarray(offset, dtype=np.float32)
+        predicted = self.state[indices, :2] - offset
+        centers = np.round(predicted).astype(int)
+        rows = np.zeros((len(indices), 2), dtype=np.float32)
+        rows[:, 1] = np.arange(len(indices)) * size
+        templates = self.templates[indices].reshape(-1, size)
+        current = self.patches(gray_frame, centers).reshape(-1, size)
+        prev_pts = (self.anchors[indices] + rows).reshape(-1, 1, 2)
+        next_pts = (predicted - centers + size // 2 + rows).astype(np.float32).reshape(-1, 1, 2)
+        new_pts, status, error = flow.calc(prev_pts, next_pts, prev_img=templates, next_img=current, maxLevel=1,
+                                           flags=cv2.OPTFLOW_USE_INITIAL_FLOW)
+        local = new_pts.reshape(-1, 2) - rows
+        measured = local - size // 2 + centers + offset
+        found = self.validator.validate(flow, prev_pts, new_pts, status, error, prev_img=templates, next_img=current)
+        found &= error.reshape(-1) <= self.max_error
+        found &= (local >= 0).all(axis=1) & (local < size).all(axis=1)
+        # The replicated borders of the frame match anything flat: points predicted outside stay hidden
+        height, width = gray_frame.shape[:2]
+        found &= (centers >= 0).all(axis=1) & (centers[:, 0] < width) & (centers[:, 1] < height)
+        return found & self.consistent(indices, measured), measured
+
+    def coast(self, indices):
+        """
+        Let some points coast for one more frame.
+
+        Returns:
+        - Indices of the points that coasted for too long and are lost.
+        """
+        self.coasting[indices] += 1
+        return indices[self.coasting[indices] > self.max_coast]
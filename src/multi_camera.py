@@ -0,0 +1,261 @@
+"""
+Multi-camera: A utility to capture from several cameras concurrently, one thread per camera,
+and to run an independent tracker per stream on a shared pool of worker threads,
+with a tiled display and per-camera frame rates and dropped frames.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import numpy as np
+import cv2
+
+
+class CameraStream:
+
+    def __init__(self, tracker, name):
+        """
+        Initialize the CameraStream object.
+
+        Parameters:
+        - tracker: Tracker exposing a `cap` video capture and a `process(frame)` method.
+        - name: Name of the stream in the display and the report.
+        """
+        self.tracker = tracker
+        self.name = name
+        self.lock = threading.Lock()
+        self.frame = None
+        self.timestamp = None
+        self.spare = []
+        self.scale = (1.0, 1.0)
+        self.running = True
+        self.captured = 0
+        self.dropped = 0
+        self.processed = 0
+
+    def capture(self, stop, fresh):
+        """
+        Capture thread: read frames as fast as the camera delivers them, and keep only the latest one.
+        A frame replaced before being processed is counted as dropped, and its buffer is read into again.
+
+        Parameters:
+        - stop: Event stopping the thread.
+        - fresh: Event set whenever a new frame is available.
+        """
+        while not stop.is_set():
+            with self.lock:
+                buffer = self.spare.pop() if self.spare else None
+            ret, frame = self.tracker.cap.read(buffer)
+            timestamp = time.perf_counter()
+            if not ret:
+                break
+            with self.lock:
+                if self.frame is not None:
+                    self.dropped += 1
+                    self.spare.append(self.frame)
+                self.frame, self.timestamp = frame, timestamp
+                self.captured += 1
+            fresh.set()
+        self.running = False
+        fresh.set()
+
+    def take(self):
+        """
+        Take the latest frame, if any was captured since the last call.
+
+        Returns:
+        - Tuple (frame, timestamp), with frame None if there is no new frame.
+        """
+        with self.lock:
+            frame, timestamp = self.frame, self.timestamp
+            self.frame = None
+        return frame, timestamp
+
+    def give_back(self, frame):
+        """
+        Hand a processed frame back to the capture thread, which reads the next frames into it.
+        """
+        with self.lock:
+            self.spare.append(frame)
+
+
+class MultiCamera:
+
+    def __init__(self, trackers, names=None, workers=None, headless=False, window='Frame', max_frames=None):
+        """
+        Initialize the MultiCamera object.
+
+        Parameters:
+        - trackers: One tracker per camera, each exposing `cap` and `process(frame)`,
+          and created headless so that the tiled window is the only one.
+        - names: Names of the cameras (defaults to their positions).
+        - workers: Number of threads processing the streams (defaults to the number of cameras).
+        - headless: Boolean indicating whether to run without any window.
+        - window: Name of the tiled window.
+        - max_frames: Number of frames of every camera after which to stop (optional, otherwise
+          until the captures end, 'q' is pressed or Ctrl+C).
+        """
+        names = names or [str(i) for i in range(len(trackers))]
+        self.streams = [CameraStream(tracker, name) for tracker, name in zip(trackers, names)]
+        self.pool = ThreadPoolExecutor(max_workers=workers or len(trackers))
+        self.headless = headless
+        self.window = window
+        self.max_frames = max_frames
+        self.stop = threading.Event()
+        self.fresh = threading.Event()
+        self.columns = int(np.ceil(np.sqrt(len(trackers))))
+        self.rows = int(np.ceil(len(trackers) / self.columns))
+        self.tile = None
+        self.mosaic = None
+        self.skews = []
+        if not headless:
+            cv2.namedWindow(window)
+            cv2.setMouseCallback(window, self.click)
+
+    def click(self, event, x, y, flags, param):
+        """
+        Mouse callback of the tiled window, forwarded to the tracker of the clicked tile
+        with coordinates in its own frame.
+        """
+        if self.tile is None:
+            return
+        width, height = self.tile
+        index = (y // height) * self.columns + x // width
+        if index >= len(self.streams):
+            return
+        tracker = self.streams[index].tracker
+        scale_x, scale_y = self.streams[index].scale
+        x, y = int((x % width) * scale_x), int((y % height) * scale_y)
+        callback = getattr(tracker, 'select_rect', None) or getattr(tracker, 'select_point', None)
+        if callback is not None:
+            callback(event, x, y, flags, param)
+
+    def step(self, index, frame):
+        """
+        Process a frame with the tracker of its stream, timed by the metrics of that tracker.
+
+        Parameters:
+        - index: Index of the stream.
+        - frame: BGR frame of the stream.
+
+        Returns:
+        - Processed BGR frame.
+        """
+        tracker = self.streams[index].tracker
+        metrics = getattr(tracker, 'metrics', None)
+        if metrics is not None:
+            metrics.start()
+        processed = tracker.process(frame)
+        if metrics is not None:
+            metrics.end()
+        return processed
+
+    def done(self):
+        """
+        Returns:
+        - Boolean indicating whether every camera has processed max_frames frames.
+        """
+        return self.max_frames is not None and all(stream.processed >= self.max_frames for stream in self.streams)
+
+    def draw(self, index, frame, elapsed):
+        """
+        Copy a processed frame into its tile of the mosaic, with the frame rate and dropped frames of its camera.
+
+        Parameters:
+        - index: Index of the stream.
+        - frame: Processed BGR frame.
+        - elapsed: Time since the start, in seconds.
+        """
+        stream = self.streams[index]
+        if self.mosaic is None:
+            self.tile = (frame.shape[1], frame.shape[0])
+            self.mosaic = np.zeros((self.rows * frame.shape[0], self.columns * frame.shape[1], 3), dtype=np.uint8)
+        width, height = self.tile
+        row, column = divmod(index, self.columns)
+        tile = self.mosaic[row * height:(row + 1) * height, column * width:(column + 1) * width]
+        if frame.shape[:2] == (height, width):
+            tile[:] = frame
+        else:
+            cv2.resize(frame, (width, height), dst=tile)
+        stream.scale = (frame.shape[1] / width, frame.shape[0] / height)
+        text = f'Camera {stream.name}: {stream.processed / max(elapsed, 1e-9):.1f} fps, {stream.dropped} dropped'
+        cv2.putText(tile, text, (10, height - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 1)
+
+    def report(self, elapsed):
+        """
+        Print the captured, processed and dropped frames of every camera, and the mean capture skew.
+
+        Returns:
+        - List of dictionaries with the statistics of every camera.
+        """
+        stats = []
+        for stream in self.streams:
+            stats.append(dict(camera=stream.name, captured=stream.captured, processed=stream.processed,
+                              dropped=stream.dropped, capture_fps=stream.captured / max(elapsed, 1e-9),
+                              fps=stream.processed / max(elapsed, 1e-9)))
+            print(f"Camera {stream.name}: {stream.processed} frames processed ({stats[-1]['fps']:.1f} fps), "
+                  f"{stream.captured} captured ({stats[-1]['capture_fps']:.1f} fps), {stream.dropped} dropped.")
+        if self.skews:
+            print(f'Mean skew between the frames processed together: {np.mean(self.skews) * 1e3:.1f} ms.')
+        return stats
+
+    def run(self):
+        """
+        Start one capture thread per camera, and process the latest frame of every camera
+        on the worker pool until the captures end, every camera has processed max_frames frames,
+        'q' is pressed or Ctrl+C.
+
+        Returns:
+        - List of dictionaries with the statistics of every camera.
+        """
+        threads = [threading.Thread(target=stream.capture, args=(self.stop, self.fresh), daemon=True)
+                   for stream in self.streams]
+        for thread in threads:
+            thread.start()
+        start_time = time.perf_counter()
+        try:
+            while not self.stop.is_set():
+                self.fresh.wait(timeout=0.1)
+                self.fresh.clear()
+                taken = [(i, *stream.take()) for i, stream in enumerate(self.streams)]
+                ready = [(i, frame, timestamp) for i, frame, timestamp in taken if frame is not None]
+                if self.max_frames is not None:
+                    for i, frame, _ in ready:
+                        if self.streams[i].processed >= self.max_frames:
+                            self.streams[i].give_back(frame)
+                    ready = [item for item in ready if self.streams[item[0]].processed < self.max_frames]
+                if not ready:
+                    if self.done() or not any(stream.running for stream in self.streams):
+                        break
+                    continue
+                results = self.pool.map(lambda item: self.step(item[0], item[1]), ready)
+                elapsed = time.perf_counter() - start_time
+                for (i, frame, _), processed in zip(ready, results):
+                    self.streams[i].processed += 1
+                    if not self.headless:
+                        self.draw(i, processed, elapsed)
+                    self.streams[i].give_back(frame)
+                if len(ready) > 1:
+                    timestamps = [timestamp for _, _, timestamp in ready]
+                    self.skews.append(max(timestamps) - min(timestamps))
+                if self.done():
+                    break
+                if not self.headless:
+                    cv2.imshow(self.window, self.mosaic)
+                    if cv2.waitKey(1) & 0xFF in [ord('q')]:
+                        self.stop.set()
+        except KeyboardInterrupt:
+            print('Interrupted, stopping the cameras.')
+        self.stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start_time
+        self.pool.shutdown()
+        for stream in self.streams:
+            stream.tracker.cap.release()
+            if getattr(stream.tracker, 'metrics', None) is not None:
+                stream.tracker.metrics.close()
+        if not self.headless:
+            cv2.destroyAllWindows()
+        return self.report(elapsed)
@@ -0,0 +1,182 @@
+"""
+Pipeline: A utility to run any tracker as three concurrent stages
+(capture, tracking and display) connected by bounded queues.
+"""
+
+import threading
+import queue
+import zlib
+
+import cv2
+
+
+class Pipeline:
+
+    def __init__(self, tracker, queue_size=2, drop_oldest=True, window='Frame', check_frames=False):
+        """
+        Initialize the Pipeline object.
+
+        Parameters:
+        - tracker: Tracker exposing a `cap` video capture, a `process(frame)` method and `metrics`.
+        - queue_size: Maximum number of frames waiting between two stages.
+        - drop_oldest: Boolean indicating whether a full queue drops its oldest frame
+          (so that each stage always works on the freshest frame) instead of blocking the producer.
+        - window: Name of the window in which processed frames are displayed.
+        - check_frames: Boolean indicating whether a checksum of every frame is checked by the next stage,
+          counting the frames changed while they waited in a queue.
+        """
+        self.tracker = tracker
+        self.drop_oldest = drop_oldest
+        self.window = window
+        self.captured = queue.Queue(maxsize=queue_size)
+        self.processed = queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.dropped = 0
+        self.check_frames = check_frames
+        self.corrupted = 0
+
+        # Mouse events are queued by the display stage and applied by the tracking stage between two frames,
+        # so that the tracker state is only ever changed by the thread that processes the frames
+        self.callback = getattr(tracker, 'select_rect', None) or getattr(tracker, 'select_point', None)
+        self.events = queue.Queue()
+
+        # Frames displayed or dropped are handed back, and the capture stage reads the next frames into them:
+        # a frame is never read into while it waits in a queue or is processed
+        self.lock = threading.Lock()
+        self.spare = []
+
+    def give_back(self, frame):
+        """
+        Hand a frame the pipeline is done with back to the capture stage, which reads the next frames into it.
+        """
+        with self.lock:
+            self.spare.append(frame)
+
+    def checksum(self, frame):
+        """
+        Checksum travelling with a frame to the next stage, or None if frames are not checked.
+        """
+        return zlib.crc32(frame) if self.check_frames else None
+
+    def check(self, frame, checksum):
+        """
+        Count a frame that changed since its checksum was computed by the previous stage.
+        """
+        if checksum is not None and zlib.crc32(frame) != checksum:
+            self.corrupted += 1
+
+    def put(self, frames, item):
+        """
+        Put a frame in a queue according to the drop policy.
+
+        Parameters:
+        - frames: Queue receiving the frame.
+        - item: Tuple (frame, checksum) to enqueue.
+        """
+        while not self.stop.is_set():
+            try:
+                if self.drop_oldest:
+                    frames.put_nowait(item)
+                else:
+                    frames.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if self.drop_oldest:
+                    try:
+                        dropped, _ = frames.get_nowait()
+                        self.dropped += 1
+                        self.give_back(dropped)
+                    except queue.Empty:
+                        pass
+
+    def get(self, frames):
+        """
+        Get a frame from a queue, giving up when the pipeline is stopped.
+
+        Parameters:
+        - frames: Queue providing the frame.
+
+        Returns:
+        - Tuple (frame, checksum), or None if the pipeline was stopped.
+        """
+        while not self.stop.is_set():
+            try:
+                return frames.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return None
+
+    def post(self, event, x, y, flags, param):
+        """
+        Mouse callback of the display window: queue the event for the tracking stage.
+        """
+        self.events.put((event, x, y, flags, param))
+
+    def dispatch(self):
+        """
+        Apply the queued mouse events to the tracker, in the order they happened.
+        """
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                return
+            self.callback(*event)
+
+    def capture(self):
+        """
+        Capture stage: read frames from the camera as fast as it delivers them.
+        """
+        while not self.stop.is_set():
+            with self.lock:
+                buffer = self.spare.pop() if self.spare else None
+            ret, frame = self.tracker.cap.read(buffer)
+            if not ret:
+                self.stop.set()
+                break
+            self.put(self.captured, (frame, self.checksum(frame)))
+
+    def track(self):
+        """
+        Tracking stage: process the captured frames with the tracker.
+        """
+        while not self.stop.is_set():
+            item = self.get(self.captured)
+            if item is None:
+                break
+            self.check(*item)
+            self.dispatch()
+            self.tracker.metrics.start()
+            frame = self.tracker.process(item[0])
+            self.tracker.metrics.end()
+            self.put(self.processed, (frame, self.checksum(frame)))
+
+    def run(self):
+        """
+        Start the capture and tracking stages and run the display stage in the calling thread,
+        which is where OpenCV expects windows and mouse callbacks to live.
+        """
+        if self.callback is not None:
+            cv2.setMouseCallback(self.window, self.post)
+        stages = [threading.Thread(target=self.capture, daemon=True),
+                  threading.Thread(target=self.track, daemon=True)]
+        for stage in stages:
+            stage.start()
+        while not self.stop.is_set():
+            try:
+                frame, checksum = self.processed.get(timeout=0.1)
+                self.check(frame, checksum)
+                cv2.imshow(self.window, self.tracker.metrics.draw(frame))
+                self.give_back(frame)
+            except queue.Empty:
+                pass
+            if cv2.waitKey(1) & 0xFF in [ord('q')]:
+                self.stop.set()
+        for stage in stages:
+            stage.join()
+        print(f'\nPipeline stopped ({self.dropped} frames dropped).')
+        if self.check_frames:
+            print(f'{self.corrupted} frames were changed while in flight.')
+        self.tracker.metrics.close()
+        self.tracker.cap.release()
+        cv2.destroyAllWindows()
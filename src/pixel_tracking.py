@@ -8,34 +8,70 @@ Date: February 14, 2024
 import numpy as np
 import cv2
 
+from src.capture import open_capture
+from src.flow_cache import FlowCache
+from src.metrics import Metrics
+from src.renderer import Renderer
+from src.frame_buffers import FrameBuffers
+
 
 class PixelTracker:
 
-    def __init__(self, camera):
+    def __init__(self, camera, headless=False):
         """
         Initialize the PixelTracker object.
 
         Parameters:
-        - camera: Index of the camera to use for video capture.
+        - camera: Index of the camera to use for video capture, path of a video file, or an opened capture.
+        - headless: Boolean indicating whether to run without any window.
         """
         self.camera = camera
+        self.headless = headless
 
         # Initialize variables for point selection and tracking
         self.point_selected = False
-        self.old_point = None
-        self.old_frame = None
+
+        # Point state, in fixed buffers that the Lucas-Kanade calls write into and that are swapped afterwards
+        self.old_point = np.zeros((1, 1, 2), dtype=np.float32)
+        self.new_point = np.zeros((1, 1, 2), dtype=np.float32)
+        self.status = np.zeros((1, 1), dtype=np.uint8)
+        self.error = np.zeros((1, 1), dtype=np.float32)
 
         # Initialize video capture
-        self.cap = cv2.VideoCapture(self.camera, cv2.CAP_DSHOW)
+        self.cap = open_capture(self.camera, cv2.CAP_DSHOW)
 
         # Create a window and set mouse callback function
-        cv2.namedWindow('Frame')
-        cv2.setMouseCallback('Frame', self.select_point)
+        if not self.headless:
+            cv2.namedWindow('Frame')
+            cv2.setMouseCallback('Frame', self.select_point)
 
         # Parameters for Lucas-Kanade optical flow
         self.lk_params = dict(winSize=(15, 15),
                               maxLevel=2,
                               criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+        self.flow = FlowCache(self.lk_params)
+
+        # Optional FlowValidator dropping the points that drifted
+        self.validator = None
+
+        # Optional IlluminationNormalizer applied to the grayscale frames before tracking
+        self.illumination = None
+
+        # Optional AsyncTrajectoryWriter recording the tracked points of every frame
+        self.recorder = None
+
+        # Optional MotionPredictor seeding Lucas-Kanade with the predicted position,
+        # and letting the point coast through short occlusions
+        self.predictor = None
+
+        # Per-stage timings, disabled unless replaced by an enabled Metrics object
+        self.metrics = Metrics()
+
+        # Overlay drawing, batched over all the points
+        self.renderer = Renderer()
+
+        # Preallocated frame buffers, reused by every frame
+        self.buffers = FrameBuffers()
 
     def select_point(self, event, x, y, flags, param):
         """
@@ -50,7 +86,105 @@ class PixelTracker:
         if event == cv2.EVENT_LBUTTONDOWN:
             # Set the selected point
             self.point_selected = True
-            self.old_point = np.array([[x, y]], dtype=np.float32)
+            self.old_point[:] = (x, y)
+            if self.predictor is not None:
+                self.predictor.reset(self.old_point)
+
+    def process(self, frame):
+        """
+        Track the selected pixel on a single frame and draw its track.
+
+        Parameters:
+        - frame: BGR image captured from the camera.
+
+        Returns:
+        - The annotated frame.
+        """
+        new_frame = self.buffers.gray(frame)
+        self.metrics.lap('cvtColor')
+        if self.illumination is not None:
+            self.illumination.apply(new_frame)
+            self.metrics.lap('illumination')
+        self.flow.update(new_frame)
+
+        # Track the selected point using Lucas-Kanade optical flow
+        if self.point_selected and self.flow.ready and self.predictor is not None:
+            if self.predictor.state is None:
+                self.predictor.reset(self.old_point)
+            guess = self.predictor.predict()
+            if self.predictor.coasting[0] > 0:
+                return self.coast(frame, new_frame)
+            self.new_point[:] = guess
+        if self.point_selected and self.flow.ready:
+            if self.predictor is None:
+                new_point, status, error = self.flow.calc(self.old_point, self.new_point,
+                                                          status=self.status, err=self.error)
+            else:
+                new_point, status, error = self.flow.calc(self.old_point, self.new_point, status=self.status,
+                                                          err=self.error, flags=cv2.OPTFLOW_USE_INITIAL_FLOW)
+                if self.flow.scheduler is not None:
+                    # The search only has to cover the error of the prediction, not the whole motion
+                    self.flow.scheduler.observe(self.predictor.prediction, new_point, status)
+            self.metrics.lap('calcOpticalFlowPyrLK')
+            # Select good points
+            found = status[:, 0] == 1
+            validator = self.validator
+            if validator is None and self.predictor is not None:
+                # Only a forward-backward consistent measurement may correct the filter
+                validator = self.predictor.validator
+            if validator is not None:
+                found = validator.validate(self.flow, self.old_point, new_point, status, error)
+                self.metrics.lap('validation')
+            if self.predictor is not None:
+                found &= self.predictor.consistent([0], new_point)
+            self.metrics.count('points_tracked', found.sum())
+            self.metrics.count('points_lost', (~found).sum())
+            if self.recorder is not None:
+                self.recorder.write(new_point, found, error)
+
+            # Draw tracks
+            self.renderer.tracks(frame, new_point[found], self.old_point[found])
+            self.metrics.lap('draw')
+
+            if found.all():
+                if self.predictor is not None:
+                    self.predictor.correct([0], new_point)
+                self.old_point, self.new_point = self.new_point, self.old_point
+            elif self.predictor is not None:
+                # The point coasts on its prediction from the next frame on
+                self.predictor.occlude(self.flow, [0], self.old_point, self.flow.prev_img)
+                self.old_point[:] = self.predictor.prediction
+            else:
+                self.point_selected = False
+        return frame
+
+    def coast(self, frame, new_frame):
+        """
+        Look for the coasting point around its prediction, and let it follow the prediction
+        if it is not found, until it coasted for too long.
+
+        Parameters:
+        - frame: BGR image captured from the camera.
+        - new_frame: Its grayscale image.
+
+        Returns:
+        - The frame, with the predicted position drawn while the point coasts.
+        """
+        found, measured = self.predictor.reacquire(self.flow, new_frame, np.zeros(1, dtype=int))
+        self.metrics.lap('reacquisition')
+        if found[0]:
+            self.predictor.correct([0], measured)
+            self.old_point[:] = measured
+            self.renderer.markers(frame, self.old_point, (0, 255, 0))
+        elif self.predictor.coast(np.zeros(1, dtype=int)).size:
+            self.point_selected = False
+        else:
+            self.old_point[:] = self.predictor.prediction
+            self.renderer.markers(frame, self.old_point, (0, 255, 255))
+        if self.recorder is not None:
+            self.recorder.write(self.old_point, found, np.full(1, np.nan, dtype=np.float32))
+        self.metrics.lap('draw')
+        return frame
 
     def main(self):
         """
@@ -58,40 +192,23 @@ class PixelTracker:
         """
         while True:
             # Capture frame-by-frame
-            _, frame = self.cap.read()
-            new_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-
-            # Track the selected point using Lucas-Kanade optical flow
-            if self.point_selected:
-                new_point, status, error = cv2.calcOpticalFlowPyrLK(self.old_frame,
-                                                                    new_frame,
-                                                                    self.old_point,
-                                                                    None,
-                                                                    **self.lk_params)
-                # Select good points
-                good_new = new_point[status.flatten() == 1]
-                good_old = self.old_point[status.flatten() == 1]
-
-                # Draw tracks
-                for new, old in zip(good_new, good_old):
-                    a, b = new.ravel()
-                    c, d = old.ravel()
-                    frame = cv2.line(frame, (int(a), int(b)), (int(c), int(d)), (0, 255, 0), 2)
-                    frame = cv2.circle(frame, (int(a), int(b)), 5, (0, 255, 0), -1)
-
-                self.old_point = good_new
-
-            self.old_frame = new_frame.copy()
+            self.metrics.start()
+            _, frame = self.buffers.read(self.cap)
+            self.metrics.lap('read')
+            frame = self.metrics.draw(self.process(frame))
 
             # Display the frame
             cv2.imshow('Frame', frame)
 
             # Check for user input to quit the program
             key = cv2.waitKey(1) & 0xFF
+            self.metrics.lap('display')
+            self.metrics.end()
             if key in [ord('q')]:
                 break
 
         # Release the video capture and close all windows
+        self.metrics.close()
         self.cap.release()
         cv2.destroyAllWindows()
 
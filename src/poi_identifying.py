@@ -9,30 +9,51 @@ Date: February 14, 2024
 import numpy as np
 import cv2
 
+from src.capture import open_capture
+from src.detector import Detector
+from src.metrics import Metrics
+from src.renderer import Renderer
+from src.frame_buffers import FrameBuffers
+
 
 class PoiIdentifier:
 
-    def __init__(self, camera, num_points):
+    def __init__(self, camera, num_points, headless=False):
         """
         Initialize the POI Identifier object.
 
         Parameters:
-        - camera: Index of the camera to use for video capture.
+        - camera: Index of the camera to use for video capture, path of a video file, or an opened capture.
         - num_points: Number of points of interest to identify.
+        - headless: Boolean indicating whether to run without any window.
         """
         self.camera = camera
         self.num_points = num_points
+        self.headless = headless
         self.rect_start = None
         self.rect_end = None
         self.selecting_rect = False
         self.tracking_points = []
 
         # Initialize video capture
-        self.cap = cv2.VideoCapture(self.camera)
+        self.cap = open_capture(self.camera)
 
         # Create a window and set mouse callback function
-        cv2.namedWindow('Frame')
-        cv2.setMouseCallback('Frame', self.select_rect)
+        if not self.headless:
+            cv2.namedWindow('Frame')
+            cv2.setMouseCallback('Frame', self.select_rect)
+
+        # Detection backend of the points of interest
+        self.detector = Detector()
+
+        # Per-stage timings, disabled unless replaced by an enabled Metrics object
+        self.metrics = Metrics()
+
+        # Overlay drawing, batched over all the points
+        self.renderer = Renderer()
+
+        # Preallocated frame buffers, reused by every frame
+        self.buffers = FrameBuffers()
 
     def select_rect(self, event, x, y, flags, param):
         """
@@ -52,10 +73,10 @@ class PoiIdentifier:
                 self.selecting_rect = True
             else:
                 print(f'Zone ends {x, y}')
+                # Points are identified on the next processed frame
+                self.tracking_points = None
                 self.rect_end = (x, y)
                 self.selecting_rect = False
-                _, frame = self.cap.read()
-                self.tracking_points = self.generate_poi(frame)
 
     def generate_poi(self, frame):
         """
@@ -65,34 +86,53 @@ class PoiIdentifier:
         - frame: Image frame from which points of interest are generated.
 
         Returns:
-        - List of points of interest.
+        - Float32 array of shape (N, 2) of points of interest, with sub-pixel coordinates.
         """
         if self.rect_start is not None and self.rect_end is not None:
             x_min, y_min = np.min([self.rect_start, self.rect_end], axis=0).ravel()
             x_max, y_max = np.max([self.rect_start, self.rect_end], axis=0).ravel()
-            gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            corners = cv2.goodFeaturesToTrack(gray_frame[y_min:y_max, x_min:x_max],
-                                              maxCorners=self.num_points, qualityLevel=0.01, minDistance=10)
-            corners = corners.reshape(-1, 2) + np.array([x_min, y_min])
+            gray_frame = cv2.cvtColor(frame[y_min:y_max, x_min:x_max], cv2.COLOR_BGR2GRAY)
+            corners = self.detector.detect(gray_frame, self.num_points)
+            corners = corners.reshape(-1, 2) + np.array([x_min, y_min], dtype=np.float32)
             corners[:, 0] = np.clip(corners[:, 0], x_min, x_max)
             corners[:, 1] = np.clip(corners[:, 1], y_min, y_max)
-            return corners.astype(int)
+            return corners
+
+    def process(self, frame):
+        """
+        Identify the points of interest if a zone was just selected and draw them on a single frame.
+
+        Parameters:
+        - frame: BGR image captured from the camera.
+
+        Returns:
+        - The annotated frame.
+        """
+        if self.rect_start is not None and self.rect_end is not None:
+            if self.tracking_points is None:
+                self.tracking_points = self.generate_poi(frame)
+                self.metrics.lap('detection')
+            cv2.rectangle(frame, self.rect_start, self.rect_end, (0, 255, 0), 2)
+            self.renderer.markers(frame, self.tracking_points, (0, 0, 255), 3)
+            self.metrics.lap('draw')
+        return frame
 
     def main(self):
         """
         Main function to select a region and identify points of interest within it.
         """
         while True:
-            _, frame = self.cap.read()
-            if self.rect_start is not None and self.rect_end is not None:
-                cv2.rectangle(frame, self.rect_start, self.rect_end, (0, 255, 0), 2)
-                for point in self.tracking_points:
-                    x, y = point
-                    cv2.circle(frame, (x, y), 3, (0, 0, 255), -1)
+            self.metrics.start()
+            _, frame = self.buffers.read(self.cap)
+            self.metrics.lap('read')
+            frame = self.metrics.draw(self.process(frame))
             cv2.imshow('Frame', frame)
             key = cv2.waitKey(1) & 0xFF
+            self.metrics.lap('display')
+            self.metrics.end()
             if key in [ord('q')]:
                 break
+        self.metrics.close()
         cv2.destroyAllWindows()
 
 
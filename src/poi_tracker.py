@@ -6,43 +6,103 @@ Author: @SamuelDubos
 Date: February 14, 2024
 """
 
+import time
+
 import numpy as np
 import cv2
 
+from src.capture import open_capture
+from src.flow_cache import FlowCache
+from src.detector import Detector
+from src.metrics import Metrics
+from src.renderer import Renderer
+from src.frame_buffers import FrameBuffers
+from src.trajectories import TrajectoryWriter
+
 
 class PoiTracker:
 
-    def __init__(self, camera, num_points):
+    def __init__(self, camera, num_points, headless=False, replenish_every=0, min_live=0, crop=False, padding=60):
         """
         Initialize the POI Tracker object.
 
         Parameters:
-        - camera: Index of the camera to use for video capture.
+        - camera: Index of the camera to use for video capture, path of a video file, or an opened capture.
         - num_points: Number of points of interest to track.
+        - headless: Boolean indicating whether to run without any window.
+        - replenish_every: Number of frames between two re-detections filling the slots of lost points (0 to disable).
+        - min_live: Number of live points under which lost points are re-detected at once (0 to disable).
+        - crop: Boolean indicating whether only a window around the points is converted and tracked,
+          instead of the whole frame.
+        - padding: Margin of that window around the points, in pixels.
         """
         self.camera = camera
         self.num_points = num_points
+        self.headless = headless
+        self.replenish_every = replenish_every
+        self.min_live = min_live
+        self.crop = crop
+        self.padding = padding
+        self.window = None
         self.rect_start = None
         self.rect_end = None
         self.selecting_rect = False
         self.tracking_points = None
-        self.prev_img = None
+        self.lost = None
+        self.selected = None
+        self.frame_index = 0
+
+        # Buffers the Lucas-Kanade calls gather the live points into and write their outputs into,
+        # allocated with the tracking points
+        self.lk_buffers = None
 
         # Initialize video capture
-        self.cap = cv2.VideoCapture(self.camera, cv2.CAP_DSHOW)
+        self.cap = open_capture(self.camera, cv2.CAP_DSHOW)
 
         # Create a window and set mouse callback function
-        cv2.namedWindow('Frame')
-        cv2.setMouseCallback('Frame', self.select_rect)
+        if not self.headless:
+            cv2.namedWindow('Frame')
+            cv2.setMouseCallback('Frame', self.select_rect)
 
         # Parameters for Lucas-Kanade optical flow
         self.lk_params = dict(winSize=(15, 15),
                               maxLevel=2,
                               criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+        self.flow = FlowCache(self.lk_params)
+
+        # Optional FlowValidator dropping the points that drifted
+        self.validator = None
+
+        # Optional IlluminationNormalizer applied to the grayscale frames before tracking
+        self.illumination = None
+
+        # Optional AsyncTrajectoryWriter recording the tracked points of every frame
+        self.recorder = None
+
+        # Optional MotionPredictor seeding Lucas-Kanade with the predicted positions,
+        # and letting the points that are not found coast through short occlusions
+        self.predictor = None
+
+        # Optional SpatialIndex over the live points, dropping the points that merge
+        # and finding the point nearest to a right click
+        self.index = None
+
+        # Detection backend of the points of interest
+        self.detector = Detector()
+
+        # Per-stage timings, disabled unless replaced by an enabled Metrics object
+        self.metrics = Metrics()
+
+        # Overlay drawing, batched over all the points
+        self.renderer = Renderer()
+
+        # Preallocated frame buffers, reused by every frame
+        self.buffers = FrameBuffers()
 
     def select_rect(self, event, x, y, flags, param):
         """
-        Mouse callback function to select a rectangle on the screen.
+        Mouse callback function to select a rectangle on the screen,
+        or the tracked point nearest to a right click (with a spatial index).
 
         Parameters:
         - event: Type of mouse event.
@@ -58,10 +118,19 @@ class PoiTracker:
                 self.selecting_rect = True
             else:
                 print(f'Zone ends {x, y}')
+                # Points are seeded from the next processed frame
+                self.tracking_points = None
+                self.window = None
                 self.rect_end = (x, y)
                 self.selecting_rect = False
-                _, frame = self.cap.read()
-                self.tracking_points = self.generate_poi(frame)
+        elif event == cv2.EVENT_RBUTTONDOWN and self.index is not None and self.tracking_points is not None:
+            self.selected = self.index.nearest(x, y)
+            if self.selected is not None:
+                x_point, y_point = self.tracking_points[self.selected, 0]
+                zone = np.min([self.rect_start, self.rect_end], axis=0).tolist() + \
+                    np.max([self.rect_start, self.rect_end], axis=0).tolist()
+                print(f'Pixel n°{self.selected} selected at ({x_point:.1f}, {y_point:.1f}), '
+                      f'{self.index.count(zone)} points left in the zone.')
 
     def generate_poi(self, frame):
         """
@@ -71,51 +140,361 @@ class PoiTracker:
         - frame: Image frame from which points of interest are generated.
 
         Returns:
-        - Array of points of interest.
+        - Float32 array of shape (N, 1, 2) of points of interest.
         """
         if self.rect_start is not None and self.rect_end is not None:
             x_min, y_min = np.min([self.rect_start, self.rect_end], axis=0).ravel()
             x_max, y_max = np.max([self.rect_start, self.rect_end], axis=0).ravel()
-            gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            corners = cv2.goodFeaturesToTrack(gray_frame[y_min:y_max, x_min:x_max],
-                                              maxCorners=self.num_points, qualityLevel=0.01, minDistance=10)
-            corners = corners.reshape(-1, 2) + np.array([x_min, y_min])
+            gray_frame = cv2.cvtColor(frame[y_min:y_max, x_min:x_max], cv2.COLOR_BGR2GRAY)
+            corners = self.detector.detect(gray_frame, self.num_points)
+            corners = corners.reshape(-1, 2) + np.array([x_min, y_min], dtype=np.float32)
             corners[:, 0] = np.clip(corners[:, 0], x_min, x_max)
             corners[:, 1] = np.clip(corners[:, 1], y_min, y_max)
-            return np.array([[corner] for corner in corners]).astype(np.float32)
+            return corners.reshape(-1, 1, 2)
+
+    def replenish(self, gray_frame, padding=20, min_distance=10, offset=(0, 0)):
+        """
+        Re-detect points of interest around the live points and put them in the slots of the lost ones.
+        Detection is restricted to the bounding box of the live points (or to the selected zone if none
+        is left), and existing points are masked out so that new points do not duplicate them.
+
+        Parameters:
+        - gray_frame: Grayscale image in which points are detected.
+        - padding: Margin added around the bounding box of the live points, in pixels.
+        - min_distance: Minimum distance between a new point and any other point, in pixels.
+        - offset: Position of the grayscale image in the frame, when it is a window of it.
+
+        Returns:
+        - Number of replenished points.
+        """
+        free = np.flatnonzero(self.lost)
+        if free.size == 0:
+            return 0
+        offset = np.asarray(offset)
+        live_points = self.tracking_points[~self.lost].reshape(-1, 2) - offset
+        height, width = gray_frame.shape[:2]
+        if live_points.size:
+            x_min, y_min = np.floor(live_points.min(axis=0)).astype(int) - padding
+            x_max, y_max = np.ceil(live_points.max(axis=0)).astype(int) + padding
+        else:
+            x_min, y_min = np.min([self.rect_start, self.rect_end], axis=0).ravel() - offset
+            x_max, y_max = np.max([self.rect_start, self.rect_end], axis=0).ravel() - offset
+        x_min, x_max = np.clip([x_min, x_max], 0, width)
+        y_min, y_max = np.clip([y_min, y_max], 0, height)
+        if x_max - x_min < 2 or y_max - y_min < 2:
+            return 0
+        mask = np.full((y_max - y_min, x_max - x_min), 255, dtype=np.uint8)
+        for x, y in live_points - np.array([x_min, y_min]):
+            cv2.circle(mask, (int(x), int(y)), min_distance, 0, -1)
+        corners = self.detector.detect(gray_frame[y_min:y_max, x_min:x_max], free.size,
+                                       mask=mask, min_distance=min_distance)
+        self.metrics.lap('detection')
+        if len(corners) == 0:
+            return 0
+        free = free[:len(corners)]
+        self.tracking_points[free] = corners + (offset + (x_min, y_min)).astype(np.float32)
+        self.lost[free] = False
+        if self.predictor is not None and self.predictor.state is not None:
+            self.predictor.spawn(free, self.tracking_points[free])
+        return free.size
+
+    def deduplicate(self):
+        """
+        Update the spatial index with the tracked points, and mark the points that merged
+        into another one as lost, so that their slots can be replenished.
+        """
+        duplicates = self.index.update(self.tracking_points, ~self.lost)
+        self.lost[duplicates] = True
+        if self.selected is not None and self.lost[self.selected]:
+            self.selected = None
+        self.metrics.count('points_merged', duplicates.size)
+        self.metrics.lap('deduplication')
+
+    def fit_window(self, frame):
+        """
+        Window around the live points (or around the selected zone before they are seeded),
+        padded and clipped to the frame.
+
+        Parameters:
+        - frame: Image of the whole frame.
+
+        Returns:
+        - Window as (x_min, y_min, x_max, y_max).
+        """
+        if self.tracking_points is not None and not self.lost.all():
+            points = self.tracking_points[~self.lost].reshape(-1, 2)
+            (x_min, y_min), (x_max, y_max) = np.floor(points.min(axis=0)), np.ceil(points.max(axis=0))
+        else:
+            x_min, y_min = np.min([self.rect_start, self.rect_end], axis=0).ravel()
+            x_max, y_max = np.max([self.rect_start, self.rect_end], axis=0).ravel()
+        height, width = frame.shape[:2]
+        return (max(int(x_min) - self.padding, 0), max(int(y_min) - self.padding, 0),
+                min(int(x_max) + self.padding, width), min(int(y_max) + self.padding, height))
+
+    def window_fits(self, frame):
+        """
+        Whether the live points are still at least half the padding away from the borders of the window,
+        except for the borders it shares with the frame.
+
+        Parameters:
+        - frame: Image of the whole frame.
+        """
+        if self.lost.all():
+            return True
+        points = self.tracking_points[~self.lost].reshape(-1, 2)
+        height, width = frame.shape[:2]
+        x_min, y_min, x_max, y_max = self.window
+        margin = self.padding // 2
+        low = np.where([x_min > 0, y_min > 0], [x_min + margin, y_min + margin], -np.inf)
+        high = np.where([x_max < width, y_max < height], [x_max - margin, y_max - margin], np.inf)
+        return bool((points >= low).all() and (points <= high).all())
+
+    def convert(self, frame):
+        """
+        Convert the window of a frame (or the whole frame if there is none) to grayscale,
+        and normalize its illumination if requested.
+
+        Parameters:
+        - frame: BGR image captured from the camera.
+
+        Returns:
+        - Grayscale image of the window.
+        """
+        if self.window is not None:
+            x_min, y_min, x_max, y_max = self.window
+            frame = frame[y_min:y_max, x_min:x_max]
+        gray_frame = self.buffers.gray(frame)
+        if self.illumination is not None:
+            self.illumination.apply(gray_frame)
+        return gray_frame
+
+    def flow_step(self, live, offset, guesses=None):
+        """
+        Track some live points of interest with a single Lucas-Kanade call
+        between the two last frames pushed to the flow cache.
+
+        Parameters:
+        - live: Indices of the points.
+        - offset: Position of the cached images in the frame, as a float32 array.
+        - guesses: Optional predicted positions of every point slot in the frame, from which the call starts.
+
+        Returns:
+        - Tuple (old_points, new_points, found, error), with the points in the cached images.
+        """
+        n = live.size
+        if self.lk_buffers is None or len(self.lk_buffers[0]) < len(self.tracking_points):
+            self.lk_buffers = (np.empty_like(self.tracking_points), np.empty_like(self.tracking_points),
+                               np.empty((len(self.tracking_points), 1), dtype=np.uint8),
+                               np.empty((len(self.tracking_points), 1), dtype=np.float32))
+        old_points, new_points, status, error = (buffer[:n] for buffer in self.lk_buffers)
+        if n == 0:
+            return old_points, new_points, np.zeros(0, dtype=bool), error
+        np.take(self.tracking_points, live, axis=0, out=old_points)
+        old_points -= offset
+        if guesses is None:
+            new_points, status, error = self.flow.calc(old_points, new_points, status=status, err=error)
+        else:
+            np.take(guesses, live, axis=0, out=new_points)
+            new_points -= offset
+            predicted = new_points.copy()
+            new_points, status, error = self.flow.calc(old_points, new_points, status=status, err=error,
+                                                       flags=cv2.OPTFLOW_USE_INITIAL_FLOW)
+            if self.flow.scheduler is not None:
+                # The search only has to cover the error of the prediction, not the whole motion
+                self.flow.scheduler.observe(predicted, new_points, status)
+        self.metrics.lap('calcOpticalFlowPyrLK')
+        found = status[:, 0] == 1
+        validator = self.validator
+        if validator is None and self.predictor is not None:
+            # Only the forward-backward consistent measurements may correct the filters
+            validator = self.predictor.validator
+        if validator is not None:
+            found = validator.validate(self.flow, old_points, new_points, status, error)
+            self.metrics.lap('validation')
+        return old_points, new_points, found, error
+
+    def recover(self, coasting, offset):
+        """
+        Look for the coasting points around their prediction: the points found again resume,
+        the others follow their prediction until they coasted for too long.
+
+        Parameters:
+        - coasting: Indices of the coasting points.
+        - offset: Position of the cached images in the frame.
+
+        Returns:
+        - Indices of the points that coasted for too long.
+        """
+        found, measured = self.predictor.reacquire(self.flow, self.flow.next_img, coasting, offset)
+        self.predictor.correct(coasting[found], measured[found])
+        self.tracking_points[coasting[found]] = measured[found].reshape(-1, 1, 2)
+        self.tracking_points[coasting[~found]] = self.predictor.prediction[coasting[~found]]
+        self.metrics.count('points_recovered', found.sum())
+        self.metrics.lap('reacquisition')
+        return self.predictor.coast(coasting[~found])
+
+    def track(self, offset=(0, 0)):
+        """
+        Track every live point of interest with a single Lucas-Kanade call
+        between the two last frames pushed to the flow cache. With a motion predictor, the call starts
+        from the predicted positions, and the points that are not found coast on their prediction
+        instead of being lost at once.
+
+        Parameters:
+        - offset: Position of the cached images in the frame, when they are a window of it.
+
+        Returns:
+        - Tuple (good_new, good_old) of the tracked points and their previous positions.
+        """
+        live = np.flatnonzero(~self.lost)
+        if live.size == 0:
+            return np.empty((0, 2), np.float32), np.empty((0, 2), np.float32)
+        offset = np.asarray(offset, dtype=np.float32)
+        guesses, coasting = None, live[:0]
+        if self.predictor is not None:
+            if self.predictor.state is None or len(self.predictor.state) != len(self.tracking_points):
+                self.predictor.reset(self.tracking_points)
+            guesses = self.predictor.predict()
+            coasting = live[self.predictor.coasting[live] > 0]
+            live = live[self.predictor.coasting[live] == 0]
+        old_points, new_points, found, error = self.flow_step(live, offset, guesses)
+        if self.predictor is not None:
+            found &= self.predictor.consistent(live, new_points + offset)
+        lost = live[~found]
+        if self.predictor is not None:
+            self.predictor.occlude(self.flow, lost, old_points[~found], self.flow.prev_img)
+            self.tracking_points[lost] = guesses[lost]
+            lost = self.recover(coasting, offset)
+            self.predictor.correct(live[found], new_points[found] + offset)
+        old_points += offset
+        new_points += offset
+        self.metrics.count('points_tracked', found.sum())
+        self.metrics.count('points_lost', lost.size)
+        self.tracking_points[live[found]] = new_points[found]
+        self.lost[lost] = True
+        if self.recorder is not None:
+            errors = np.full(len(self.tracking_points), np.nan, dtype=np.float32)
+            errors[live] = error[:, 0]
+            visible = ~self.lost
+            if self.predictor is not None:
+                visible &= self.predictor.coasting == 0
+            self.recorder.write(self.tracking_points, visible, errors)
+        elif lost.size:
+            # A single write for all the points lost on this frame
+            print('\n'.join(f'Pixel n°{i} was lost.' for i in lost))
+        return new_points[found].reshape(-1, 2), old_points[found].reshape(-1, 2)
+
+    def step(self, frame):
+        """
+        Seed the points of interest if a zone was just selected, otherwise track them on a single frame.
+
+        Parameters:
+        - frame: BGR image captured from the camera.
+
+        Returns:
+        - Tuple (good_new, good_old) of the tracked points and their previous positions.
+        """
+        zone_selected = self.rect_start is not None and self.rect_end is not None
+        if self.crop and zone_selected and self.window is None:
+            self.window = self.fit_window(frame)
+        next_img = self.convert(frame)
+        self.metrics.lap('cvtColor')
+        self.flow.update(next_img)
+        if zone_selected and self.tracking_points is None:
+            self.tracking_points = self.generate_poi(frame)
+            self.lost = np.zeros(len(self.tracking_points), dtype=bool)
+            self.selected = None
+            self.metrics.lap('detection')
+            if self.predictor is not None:
+                self.predictor.reset(self.tracking_points)
+            if self.index is not None:
+                self.index.reset(frame.shape[1], frame.shape[0], len(self.tracking_points))
+                self.deduplicate()
+        elif zone_selected and self.flow.ready:
+            self.frame_index += 1
+            offset = (0, 0) if self.window is None else self.window[:2]
+            good_new, good_old = self.track(offset)
+            due = self.replenish_every and self.frame_index % self.replenish_every == 0
+            if due or len(good_new) < self.min_live:
+                self.replenish(next_img, offset=offset)
+            if self.index is not None:
+                self.deduplicate()
+            if self.window is not None and not self.window_fits(frame):
+                # The next frame is tracked from this one, so this one is converted again in the new window
+                self.window = self.fit_window(frame)
+                self.flow.next_img = self.convert(frame)
+                self.metrics.lap('cvtColor')
+            return good_new, good_old
+        return np.empty((0, 2), np.float32), np.empty((0, 2), np.float32)
+
+    def process(self, frame):
+        """
+        Track the points of interest on a single frame and draw their tracks.
+
+        Parameters:
+        - frame: BGR image captured from the camera.
+
+        Returns:
+        - The annotated frame.
+        """
+        good_new, good_old = self.step(frame)
+        self.renderer.tracks(frame, good_new, good_old)
+        if self.selected is not None:
+            self.renderer.markers(frame, self.tracking_points[self.selected], (255, 0, 0), 8)
+        self.metrics.lap('draw')
+        return frame
+
+    def run_headless(self, roi, out):
+        """
+        Track points of interest through the whole video without any window,
+        as fast as frames can be decoded, and stream their positions to disk.
+        A video that cannot be opened raises an IOError before the archive is created.
+
+        Parameters:
+        - roi: Zone in which points of interest are seeded, as (x0, y0, x1, y1).
+        - out: Path of the .npz archive receiving the trajectories.
+
+        Returns:
+        - Tuple (frames, elapsed) of the number of processed frames and the elapsed time in seconds.
+        """
+        if not self.cap.isOpened():
+            raise IOError(f'cannot open {self.camera}')
+        self.rect_start, self.rect_end = tuple(roi[:2]), tuple(roi[2:])
+        writer = TrajectoryWriter(out)
+        start_time = time.perf_counter()
+        while True:
+            self.metrics.start()
+            ret, frame = self.buffers.read(self.cap)
+            if not ret:
+                break
+            self.metrics.lap('read')
+            self.step(frame)
+            writer.write(self.tracking_points, self.lost)
+            self.metrics.lap('write')
+            self.metrics.end()
+        elapsed = time.perf_counter() - start_time
+        self.metrics.close()
+        writer.close()
+        self.cap.release()
+        print(f'Processed {writer.frames} frames in {elapsed:.1f}s ({writer.frames / max(elapsed, 1e-9):.1f} fps).')
+        return writer.frames, elapsed
 
     def main(self):
         """
         Main function to track points of interest using Lucas-Kanade method.
         """
         while True:
-            _, frame = self.cap.read()
-            next_img = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-            zone_selected = self.rect_start is not None and self.rect_end is not None
-            if zone_selected:
-                for i, point in enumerate(self.tracking_points):
-                    if not np.array_equal(point, [[np.inf, np.inf]]):
-                        new_point, status, error = cv2.calcOpticalFlowPyrLK(prevImg=self.prev_img,
-                                                                            nextImg=next_img,
-                                                                            prevPts=np.array([point]),
-                                                                            nextPts=None,
-                                                                            **self.lk_params)
-                        good_new = new_point[status.flatten() == 1]
-                        good_old = point[status.flatten() == 1]
-                        for new, old in zip(good_new, good_old):
-                            a, b = new.ravel()
-                            c, d = old.ravel()
-                            frame = cv2.line(frame, (int(a), int(b)), (int(c), int(d)), (0, 255, 0), 2)
-                            frame = cv2.circle(frame, (int(a), int(b)), 5, (0, 255, 0), -1)
-                        if good_new.size == 2:
-                            self.tracking_points[i] = good_new
-                        else:
-                            print(f'Pixel n°{i} was lost.')
-                            self.tracking_points[i] = [[np.inf, np.inf]]
-            self.prev_img = next_img.copy()
+            self.metrics.start()
+            _, frame = self.buffers.read(self.cap)
+            self.metrics.lap('read')
+            frame = self.metrics.draw(self.process(frame))
             cv2.imshow('Frame', frame)
-            if cv2.waitKey(1) & 0xFF in [ord('q')]:
+            key = cv2.waitKey(1) & 0xFF
+            self.metrics.lap('display')
+            self.metrics.end()
+            if key in [ord('q')]:
                 break
+        self.metrics.close()
         cv2.destroyAllWindows()
 
 
@@ -0,0 +1,111 @@
+"""
+Renderer: A utility drawing the overlays of every tracker in batches, with all
+track segments in a single cv2.polylines call and all markers in a single
+vectorized pass, an optional trail history, and the option to draw nothing.
+"""
+
+import numpy as np
+import cv2
+
+
+class Renderer:
+
+    def __init__(self, enabled=True, trail=0):
+        """
+        Initialize the Renderer object.
+
+        Parameters:
+        - enabled: Boolean indicating whether anything is drawn.
+        - trail: Number of past frames whose track segments are drawn again (0 for none).
+        """
+        self.enabled = enabled
+        self.trail = trail
+        self.history = [None] * trail
+        self.index = 0
+        self.disks = {}
+
+    def disk(self, radius):
+        """
+        Pixel offsets of a filled disk, computed once per radius.
+
+        Returns:
+        - Tuple (dx, dy) of integer arrays.
+        """
+        if radius not in self.disks:
+            dy, dx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+            inside = dx ** 2 + dy ** 2 <= radius ** 2
+            self.disks[radius] = (dx[inside], dy[inside])
+        return self.disks[radius]
+
+    def markers(self, frame, points, color, radius=5):
+        """
+        Draw filled disks at every point in a single vectorized pass.
+
+        Parameters:
+        - frame: BGR image to draw on, modified in place.
+        - points: Array of shape (N, 2) or (N, 1, 2) of positions.
+        - color: BGR color of the disks.
+        - radius: Radius of the disks, in pixels.
+
+        Returns:
+        - The annotated frame.
+        """
+        points = np.asarray(points).reshape(-1, 2)
+        if not self.enabled or points.size == 0:
+            return frame
+        points = points[np.isfinite(points).all(axis=1)].astype(int)
+        dx, dy = self.disk(radius)
+        xs = (points[:, :1] + dx).ravel()
+        ys = (points[:, 1:] + dy).ravel()
+        height, width = frame.shape[:2]
+        inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+        frame[ys[inside], xs[inside]] = color
+        return frame
+
+    def segments(self, frame, new, old, color, thickness=2):
+        """
+        Draw a segment between every pair of points in a single cv2.polylines call.
+
+        Parameters:
+        - frame: BGR image to draw on, modified in place.
+        - new, old: Arrays of shape (N, 2) or (N, 1, 2) of the segment ends.
+        - color: BGR color of the segments.
+        - thickness: Thickness of the segments, in pixels.
+
+        Returns:
+        - The annotated frame.
+        """
+        new, old = np.asarray(new).reshape(-1, 2), np.asarray(old).reshape(-1, 2)
+        if not self.enabled or new.size == 0:
+            return frame
+        lines = np.stack([new, old], axis=1).astype(np.int32)
+        cv2.polylines(frame, list(lines), False, color, thickness)
+        return frame
+
+    def tracks(self, frame, new, old, color=(0, 255, 0), thickness=2, radius=5):
+        """
+        Draw the tracks of points that moved from `old` to `new`, as segments ended by a marker,
+        along with the segments of the last `trail` frames.
+
+        Parameters:
+        - frame: BGR image to draw on, modified in place.
+        - new, old: Arrays of shape (N, 2) or (N, 1, 2) of the current and previous positions.
+        - color: BGR color of the tracks.
+        - thickness: Thickness of the segments, in pixels.
+        - radius: Radius of the markers, in pixels.
+
+        Returns:
+        - The annotated frame.
+        """
+        if not self.enabled:
+            return frame
+        new, old = np.asarray(new).reshape(-1, 2), np.asarray(old).reshape(-1, 2)
+        if self.trail:
+            self.history[self.index % self.trail] = np.stack([new, old], axis=1).astype(np.int32)
+            self.index += 1
+            lines = np.concatenate([segments for segments in self.history if segments is not None])
+            if len(lines):
+                cv2.polylines(frame, list(lines), False, color, thickness)
+        else:
+            self.segments(frame, new, old, color, thickness)
+        return self.markers(frame, new, color, radius)
@@ -0,0 +1,189 @@
+"""
+Spatial index: A uniform grid over the tracked points, updated incrementally on every frame,
+to suppress the points that merge and to find the points near a click or inside a zone
+without scanning all of them.
+"""
+
+import numpy as np
+
+
+class SpatialIndex:
+
+    def __init__(self, min_distance=10):
+        """
+        Initialize the SpatialIndex object. Cells are min_distance / sqrt(2) wide, so that two points
+        in the same cell are always duplicates and every cell holds at most one point.
+
+        Parameters:
+        - min_distance: Distance under which two live points are duplicates, in pixels.
+        """
+        self.min_distance = float(min_distance)
+        self.cell_size = self.min_distance / np.sqrt(2)
+        # Cells to look at after a point to find every point closer than min_distance, each pair once
+        reach = int(np.ceil(self.min_distance / self.cell_size))
+        self.offsets = np.array([(dy, dx) for dy in range(0, reach + 1) for dx in range(-reach, reach + 1)
+                                 if dy > 0 or dx > 0])
+        self.grid = None
+        self.cells = None
+        self.points = None
+
+    def reset(self, width, height, n_points):
+        """
+        Empty the index, for a frame size and a number of point slots.
+
+        Parameters:
+        - width, height: Size of the frame, in pixels.
+        - n_points: Number of point slots, which keep their index.
+        """
+        shape = (int(np.ceil(height / self.cell_size)) + 1, int(np.ceil(width / self.cell_size)) + 1)
+        # Index of the point owning every cell (-1 for an empty cell)
+        self.grid = np.full(shape, -1, dtype=np.int32)
+        # Flat cell of every point (-1 for a lost point or a point outside the frame)
+        self.cells = np.full(n_points, -1, dtype=np.int64)
+        self.points = np.zeros((n_points, 2), dtype=np.float32)
+
+    def locate(self, points):
+        """
+        Flat cells of some points, -1 for the points outside the grid.
+        """
+        cells = np.floor(points / self.cell_size).astype(np.int64)
+        rows, columns = self.grid.shape
+        inside = (cells[:, 0] >= 0) & (cells[:, 0] < columns) & (cells[:, 1] >= 0) & (cells[:, 1] < rows)
+        return np.where(inside, cells[:, 1] * columns + cells[:, 0], -1)
+
+    def neighbours(self, cells, offsets):
+        """
+        Owners of the cells at some offsets of some cells, -1 for the empty cells and those outside the grid.
+
+        Parameters:
+        - cells: Flat cells, all inside the grid.
+        - offsets: Array of (row, column) offsets.
+
+        Returns:
+        - Array of shape (len(cells), len(offsets)).
+        """
+        rows, columns = self.grid.shape
+        rows_around = (cells // columns)[:, None] + offsets[:, 0]
+        columns_around = (cells % columns)[:, None] + offsets[:, 1]
+        inside = (rows_around >= 0) & (rows_around < rows) & (columns_around >= 0) & (columns_around < columns)
+        owners = self.grid[np.clip(rows_around, 0, rows - 1), np.clip(columns_around, 0, columns - 1)]
+        return np.where(inside, owners, -1)
+
+    def update(self, points, live):
+        """
+        Move the points whose cell changed since the last update, and suppress the duplicates:
+        of two live points closer than min_distance, the one with the highest index is dropped.
+        The grid is only written for the points that changed cell, and each point is compared
+        with the few cells around it, so the cost grows linearly with the number of points.
+
+        Parameters:
+        - points: Positions of every point slot, of shape (n_points, 1, 2) or (n_points, 2).
+        - live: Boolean array of the live points.
+
+        Returns:
+        - Indices of the suppressed points, which the caller marks as lost.
+        """
+        np.copyto(self.points, points.reshape(-1, 2))
+        cells = np.where(live, self.locate(self.points), -1)
+        moved = np.flatnonzero(cells != self.cells)
+        dropped = [np.empty(0, dtype=np.intp)]
+        if moved.size:
+            # Free the cells the moved points leave (unless another point took them over)
+            old = self.cells[moved]
+            left = old >= 0
+            owned = self.grid.flat[old[left]] == moved[left]
+            self.grid.flat[old[left][owned]] = -1
+            self.cells[moved] = cells[moved]
+            arriving = moved[cells[moved] >= 0]
+            # Points sharing a cell are duplicates: the lowest index takes the cell
+            order = arriving[np.lexsort((arriving, cells[arriving]))]
+            first = np.ones(order.size, dtype=bool)
+            first[1:] = cells[order[1:]] != cells[order[:-1]]
+            taken = order[first]
+            occupant = self.grid.flat[cells[taken]]
+            keep = (occupant < 0) | (occupant > taken)
+            dropped += [order[~first], taken[~keep], occupant[(occupant >= 0) & (occupant > taken)]]
+            self.grid.flat[cells[taken[keep]]] = taken[keep]
+            self.remove(np.concatenate(dropped))
+        # Points closer than min_distance in neighbouring cells
+        indexed = np.flatnonzero(self.cells >= 0)
+        owners = self.neighbours(self.cells[indexed], self.offsets)
+        rows, columns = np.nonzero(owners >= 0)
+        if rows.size:
+            first_points, second_points = indexed[rows], owners[rows, columns]
+            distances = np.linalg.norm(self.points[first_points] - self.points[second_points], axis=1)
+            close = distances < self.min_distance
+            duplicates = np.maximum(first_points[close], second_points[close])
+            self.remove(duplicates)
+            dropped.append(duplicates)
+        return np.unique(np.concatenate(dropped)).astype(np.intp)
+
+    def remove(self, indices):
+        """
+        Take some points out of the index.
+        """
+        indices = np.asarray(indices, dtype=np.intp)
+        cells = self.cells[indices]
+        inside = cells >= 0
+        owned = self.grid.flat[cells[inside]] == indices[inside]
+        self.grid.flat[cells[inside][owned]] = -1
+        self.cells[indices] = -1
+
+    def within(self, x, y, radius):
+        """
+        Live points closer than some radius to a position.
+
+        Parameters:
+        - x, y: Position, in pixels.
+        - radius: Radius of the query, in pixels.
+
+        Returns:
+        - Tuple (indices, distances), sorted by distance.
+        """
+        x_min, y_min = int(np.floor((x - radius) / self.cell_size)), int(np.floor((y - radius) / self.cell_size))
+        x_max, y_max = int(np.floor((x + radius) / self.cell_size)), int(np.floor((y + radius) / self.cell_size))
+        block = self.grid[max(y_min, 0):max(y_max + 1, 0), max(x_min, 0):max(x_max + 1, 0)]
+        candidates = block[block >= 0]
+        distances = np.linalg.norm(self.points[candidates] - np.array([x, y], dtype=np.float32), axis=1)
+        order = np.argsort(distances)
+        order = order[distances[order] <= radius]
+        return candidates[order], distances[order]
+
+    def nearest(self, x, y, radius=20):
+        """
+        Live point nearest to a position, such as a click.
+
+        Parameters:
+        - x, y: Position, in pixels.
+        - radius: Maximum distance of the point, in pixels.
+
+        Returns:
+        - Index of the point, or None if no live point is close enough.
+        """
+        indices, _ = self.within(x, y, radius)
+        return int(indices[0]) if indices.size else None
+
+    def inside(self, rect):
+        """
+        Live points inside a zone. Only the cells covering the zone are looked at.
+
+        Parameters:
+        - rect: Zone as (x_min, y_min, x_max, y_max).
+
+        Returns:
+        - Indices of the points.
+        """
+        x_min, y_min, x_max, y_max = rect
+        block = self.grid[max(int(y_min // self.cell_size), 0):max(int(y_max // self.cell_size) + 1, 0),
+                          max(int(x_min // self.cell_size), 0):max(int(x_max // self.cell_size) + 1, 0)]
+        candidates = block[block >= 0]
+        points = self.points[candidates]
+        found = ((points[:, 0] >= x_min) & (points[:, 0] <= x_max) &
+                 (points[:, 1] >= y_min) & (points[:, 1] <= y_max))
+        return np.sort(candidates[found])
+
+    def count(self, rect):
+        """
+        Number of live points inside a zone, as (x_min, y_min, x_max, y_max).
+        """
+        return len(self.inside(rect))
@@ -0,0 +1,140 @@
+"""
+Synthetic capture: A deterministic fake camera producing a textured scene
+under a known motion, so that trackers can be run and checked without a webcam.
+"""
+
+import numpy as np
+import cv2
+
+
+class SyntheticCapture:
+
+    MOTIONS = ['translate', 'rotate', 'brightness', 'occlude']
+
+    def __init__(self, motion='translate', n_frames=300, width=640, height=480, speed=2.0, seed=0):
+        """
+        Initialize the SyntheticCapture object.
+
+        Parameters:
+        - motion: Motion of the scene: 'translate', 'rotate', 'brightness' (slow translation
+          under a brightness ramp like in illumination_change.py), or 'occlude' (translation
+          with part of the central zone hidden for 3 frames every 30 frames).
+        - n_frames: Number of frames before `read()` reports the end of the sequence.
+        - width, height: Size of the produced frames.
+        - speed: Displacement in pixels per frame (a quarter of it in degrees per frame for rotations).
+        - seed: Seed of the random texture.
+        """
+        if motion not in self.MOTIONS:
+            raise ValueError(f'motion must be one of {self.MOTIONS}, not {motion!r}')
+        self.motion = motion
+        self.n_frames = n_frames
+        self.width = width
+        self.height = height
+        self.speed = speed
+        self.index = 0
+
+        # Blurred noise gives plenty of corners to detect and track
+        rng = np.random.default_rng(seed)
+        noise = (rng.random((2 * height, 2 * width, 3)) * 255).astype(np.uint8)
+        self.texture = cv2.GaussianBlur(noise, (7, 7), 0)
+
+    def transform(self, t):
+        """
+        Affine transform mapping texture coordinates onto frame `t`.
+
+        Parameters:
+        - t: Index of the frame.
+
+        Returns:
+        - Array of shape (3, 3) holding the transform in homogeneous coordinates.
+        """
+        center = np.array([self.width / 2, self.height / 2])
+        if self.motion == 'rotate':
+            matrix = cv2.getRotationMatrix2D(tuple(center), self.speed / 4 * t, 1.0)
+        else:
+            speed = self.speed / 4 if self.motion == 'brightness' else self.speed
+            matrix = np.array([[1, 0, -speed * t], [0, 1, -speed * t / 2]], dtype=np.float64)
+        # The texture is centered on the frame at t = 0
+        matrix[:, 2] -= matrix[:, :2] @ center
+        return np.vstack([matrix, [0, 0, 1]])
+
+    def gain(self, t):
+        """
+        Brightness gain applied to frame `t`.
+        """
+        if self.motion != 'brightness':
+            return 1.0
+        return 1 - 0.4 * t / max(self.n_frames - 1, 1)
+
+    def occluder(self, t):
+        """
+        Zone hidden on frame `t`, as (x_min, y_min, x_max, y_max), or None if nothing is hidden.
+        """
+        if self.motion != 'occlude' or t < 30 or t % 30 >= 3:
+            return None
+        return self.width // 4, self.height // 4, self.width // 2, 3 * self.height // 4
+
+    def map_points(self, points, start, end):
+        """
+        Ground truth positions in frame `end` of points seen in frame `start`.
+
+        Parameters:
+        - points: Array of shape (N, 2) or (N, 1, 2) of positions in frame `start`.
+        - start, end: Indices of the frames.
+
+        Returns:
+        - Array of shape (N, 2) of positions in frame `end`.
+        """
+        matrix = self.transform(end) @ np.linalg.inv(self.transform(start))
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        return points @ matrix[:2, :2].T + matrix[:2, 2]
+
+    def render(self, t, image=None):
+        """
+        Render frame `t` of the sequence.
+
+        Parameters:
+        - t: Index of the frame.
+        - image: Buffer of shape (height, width, 3) receiving the frame (optional).
+
+        Returns:
+        - BGR image of shape (height, width, 3).
+        """
+        frame = cv2.warpAffine(self.texture, self.transform(t)[:2], (self.width, self.height), dst=image,
+                               flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT_101)
+        gain = self.gain(t)
+        if gain != 1.0:
+            cv2.convertScaleAbs(frame, dst=frame, alpha=gain)
+        occluder = self.occluder(t)
+        if occluder is not None:
+            x_min, y_min, x_max, y_max = occluder
+            frame[y_min:y_max, x_min:x_max] = 128
+        return frame
+
+    def read(self, image=None):
+        """
+        Read the next frame, like cv2.VideoCapture.read().
+
+        Parameters:
+        - image: Buffer of shape (height, width, 3) receiving the frame (optional).
+
+        Returns:
+        - Tuple (ret, frame), with ret False once the sequence is over.
+        """
+        if self.index >= self.n_frames:
+            return False, None
+        frame = self.render(self.index, image)
+        self.index += 1
+        return True, frame
+
+    def isOpened(self):
+        """
+        A synthetic capture is always opened, like a working camera.
+        """
+        return True
+
+    def release(self):
+        """
+        End the sequence.
+        """
+        self.index = self.n_frames
@@ -0,0 +1,175 @@
+"""
+Trajectory writer: Utilities to stream per-frame point arrays to disk while tracking,
+either synchronously to a NumPy .npz archive, or in batches from a background thread
+to chunked .npz or CSV files.
+"""
+
+import threading
+import zipfile
+import queue
+import os
+
+import numpy as np
+
+
+class TrajectoryWriter:
+
+    def __init__(self, path):
+        """
+        Initialize the TrajectoryWriter object.
+
+        Parameters:
+        - path: Path of the .npz archive to write.
+        """
+        self.path = path
+        self.archive = zipfile.ZipFile(path, mode='w', compression=zipfile.ZIP_STORED, allowZip64=True)
+        self.frames = 0
+
+    def add(self, name, array):
+        """
+        Append an array to the archive without keeping it in memory.
+
+        Parameters:
+        - name: Key of the array in the archive.
+        - array: Array to write.
+        """
+        with self.archive.open(f'{name}.npy', mode='w', force_zip64=True) as file:
+            np.lib.format.write_array(file, np.asanyarray(array), allow_pickle=False)
+
+    def write(self, points, lost):
+        """
+        Write the state of the tracked points for one frame.
+
+        Parameters:
+        - points: Array of point positions.
+        - lost: Boolean mask of the lost points.
+        """
+        self.add(f'points_{self.frames:06d}', np.asarray(points, dtype=np.float32).reshape(-1, 2))
+        self.add(f'lost_{self.frames:06d}', lost)
+        self.frames += 1
+
+    def close(self):
+        """
+        Write the number of frames and close the archive.
+        """
+        self.add('n_frames', self.frames)
+        self.archive.close()
+        print(f'{self.frames} frames of trajectories have been saved to {self.path}.')
+
+
+class AsyncTrajectoryWriter:
+
+    # Columns of the recorded rows, one row per point and per frame
+    RECORD = np.dtype([('frame', '<i4'), ('point', '<i4'), ('x', '<f4'), ('y', '<f4'),
+                       ('status', 'u1'), ('error', '<f4')])
+    FORMATS = ['.npz', '.csv']
+
+    def __init__(self, path, batch_size=64, max_batches=8):
+        """
+        Initialize the AsyncTrajectoryWriter object.
+
+        Parameters:
+        - path: Path of the file to write, whose extension selects the format: '.npz' for an archive
+          of chunks, each a structured array of rows (frame, point, x, y, status, error) readable
+          with np.load, or '.csv' for a text file with one row
+          per point and per frame.
+        - batch_size: Number of frames handed over to the writing thread at once.
+        - max_batches: Number of batches that may wait for the writing thread, beyond which
+          the caller waits, so that memory stays bounded when the disk is slower than the capture.
+        """
+        self.path = path
+        self.format = os.path.splitext(path)[1].lower()
+        if self.format not in self.FORMATS:
+            raise ValueError(f'the extension of path must be one of {self.FORMATS}, not {self.format!r}')
+        self.batch_size = batch_size
+        self.frames = 0
+        self.chunks = 0
+        self.pending = []
+        self.batches = queue.Queue(maxsize=max_batches)
+        # Exception raised by the writing thread, raised again by close()
+        self.error = None
+        if self.format == '.npz':
+            self.file = zipfile.ZipFile(path, mode='w', compression=zipfile.ZIP_STORED, allowZip64=True)
+        else:
+            self.file = open(path, 'w')
+            self.file.write(','.join(self.RECORD.names) + '\n')
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, points, status, error=None):
+        """
+        Record the state of the tracked points for one frame. The arrays are copied, so the caller
+        may reuse its buffers at once; nothing touches the disk in the calling thread.
+
+        Parameters:
+        - points: Array of shape (N, 2) or (N, 1, 2) of point positions.
+        - status: Array of N values, nonzero for the points tracked on this frame.
+        - error: Array of N Lucas-Kanade errors (optional, NaN if not given).
+        """
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        rows = np.empty(len(points), dtype=self.RECORD)
+        rows['frame'] = self.frames
+        rows['point'] = np.arange(len(points))
+        rows['x'], rows['y'] = points[:, 0], points[:, 1]
+        rows['status'] = np.asarray(status).reshape(-1) != 0
+        rows['error'] = np.nan if error is None else np.asarray(error, dtype=np.float32).reshape(-1)
+        self.pending.append(rows)
+        self.frames += 1
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Hand the pending frames over to the writing thread.
+        """
+        if self.pending:
+            self.put(self.pending)
+            self.pending = []
+
+    def put(self, batch):
+        """
+        Queue a batch for the writing thread, waiting while the queue is full.
+        Once the thread has failed, batches are discarded: close() raises its exception.
+        """
+        while self.error is None:
+            try:
+                self.batches.put(batch, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def run(self):
+        """
+        Writing thread: write the batches of frames until the writer is closed, or until a write fails.
+        """
+        try:
+            while True:
+                batch = self.batches.get()
+                if batch is None:
+                    break
+                rows = np.concatenate(batch)
+                if self.format == '.npz':
+                    with self.file.open(f'chunk_{self.chunks:06d}.npy', mode='w', force_zip64=True) as file:
+                        np.lib.format.write_array(file, rows, allow_pickle=False)
+                else:
+                    np.savetxt(self.file, rows, fmt=['%d', '%d', '%.3f', '%.3f', '%d', '%.4f'], delimiter=',')
+                self.chunks += 1
+        except Exception as error:
+            self.error = error
+
+    def close(self):
+        """
+        Write the pending frames, wait for the writing thread and close the file.
+        Raises the exception of the writing thread if a write failed.
+        """
+        self.flush()
+        self.put(None)
+        self.thread.join()
+        if self.error is not None:
+            self.file.close()
+            raise self.error
+        if self.format == '.npz':
+            with self.file.open('n_frames.npy', mode='w') as file:
+                np.lib.format.write_array(file, np.asarray(self.frames), allow_pickle=False)
+        self.file.close()
+        print(f'{self.frames} frames of trajectories have been recorded to {self.path}.')
@@ -0,0 +1,63 @@
+"""
+Flow validator: A utility to drop the points that Lucas-Kanade reports as found
+but that drifted, using a forward-backward consistency check, the LK error,
+and the median flow of the other points.
+"""
+
+import numpy as np
+import cv2
+
+
+class FlowValidator:
+
+    def __init__(self, fb_threshold=1.0, max_error=None, median_factor=None, min_residual=1.0):
+        """
+        Initialize the FlowValidator object.
+
+        Parameters:
+        - fb_threshold: Maximum forward-backward error in pixels (None to skip the reverse pass).
+        - max_error: Maximum LK error of a kept point (None to ignore the LK error).
+        - median_factor: Points whose displacement differs from the median displacement by more than
+          this many median absolute deviations are dropped (None to skip the median flow check).
+        - min_residual: Deviation from the median displacement, in pixels, that is always tolerated.
+        """
+        self.fb_threshold = fb_threshold
+        self.max_error = max_error
+        self.median_factor = median_factor
+        self.min_residual = min_residual
+
+    def validate(self, flow, prev_pts, next_pts, status, error, prev_img=None, next_img=None):
+        """
+        Select the points to keep after a forward Lucas-Kanade pass.
+
+        Parameters:
+        - flow: FlowCache used for the forward pass.
+        - prev_pts: Tracked points, as an (N, 1, 2) float32 array.
+        - next_pts, status, error: Output of the forward pass.
+        - prev_img, next_img: Images of the forward pass (default to the frames cached by `flow`).
+
+        Returns:
+        - Boolean array of shape (N,) of the points to keep.
+        """
+        keep = status.reshape(-1) == 1
+        if self.max_error is not None:
+            keep &= error.reshape(-1) <= self.max_error
+        prev_flat, next_flat = prev_pts.reshape(-1, 2), next_pts.reshape(-1, 2)
+
+        if self.fb_threshold is not None and keep.any():
+            # The reverse pass starts from the original positions, so it converges in a few iterations
+            kept = np.flatnonzero(keep)
+            back_pts, back_status, _ = flow.calc(next_pts[kept],
+                                                 next_pts=prev_pts[kept].copy(),
+                                                 prev_img=flow.next_img if next_img is None else next_img,
+                                                 next_img=flow.prev_img if prev_img is None else prev_img,
+                                                 flags=cv2.OPTFLOW_USE_INITIAL_FLOW)
+            fb_error = np.linalg.norm(back_pts.reshape(-1, 2) - prev_flat[kept], axis=1)
+            keep[kept] &= (back_status.reshape(-1) == 1) & (fb_error <= self.fb_threshold)
+
+        if self.median_factor is not None and keep.sum() >= 3:
+            kept = np.flatnonzero(keep)
+            displacements = next_flat[kept] - prev_flat[kept]
+            residuals = np.linalg.norm(displacements - np.median(displacements, axis=0), axis=1)
+            keep[kept] &= residuals <= max(self.median_factor * np.median(residuals), self.min_residual)
+        return keep
@@ -8,19 +8,44 @@ Date: February 14, 2024
 import numpy as np
 import cv2
 
+from src.capture import open_capture
+from src.dense_flow import DenseFlow
+from src.flow_cache import FlowCache
+from src.metrics import Metrics
+from src.renderer import Renderer
+from src.frame_buffers import FrameBuffers
+
 
 class ZoneDelimiter:
 
-    def __init__(self, camera, mesh=False):
+    def __init__(self, camera, mesh=False, dense=False, method='dis', downscale=2, every=1, headless=False,
+                 track=False, grid_size=10):
         """
         Initialize the ZoneDelimiter object.
 
         Parameters:
-        - camera: Index of the camera to use for video capture.
+        - camera: Index of the camera to use for video capture, path of a video file, or an opened capture.
         - mesh: Boolean indicating whether to generate a mesh over the selected region.
+        - dense: Boolean indicating whether the mesh is advected by dense optical flow computed inside the region.
+        - method: Dense optical flow algorithm ('farneback' or 'dis').
+        - downscale: Factor by which the region is shrunk before computing the dense flow.
+        - every: Compute the dense flow every this many frames only, extrapolating the last velocity in between.
+        - headless: Boolean indicating whether to run without any window.
+        - track: Boolean indicating whether the mesh is tracked with Lucas-Kanade to follow the deformation of the region
+          (only with a mesh).
+        - grid_size: Number of mesh points along each axis.
         """
         self.camera = camera
         self.mesh = mesh
+        self.headless = headless
+        self.dense = DenseFlow(method, downscale, every) if dense else None
+        # Only a mesh can be tracked
+        self.track = track and mesh
+        self.grid_size = grid_size
+        self.mesh_cache = (None, None)
+        self.tracked_rect = None
+        self.tracking_points = None
+        self.lost = None
 
         # Initialize variables for rectangle selection
         self.rect_start = None
@@ -28,11 +53,33 @@ class ZoneDelimiter:
         self.selecting_rect = False
 
         # Initialize video capture
-        self.cap = cv2.VideoCapture(self.camera)
+        self.cap = open_capture(self.camera)
 
         # Create a window and set mouse callback function
-        cv2.namedWindow('Frame')
-        cv2.setMouseCallback('Frame', self.select_rect)
+        if not self.headless:
+            cv2.namedWindow('Frame')
+            cv2.setMouseCallback('Frame', self.select_rect)
+
+        # Parameters for Lucas-Kanade optical flow, used to track the mesh
+        self.lk_params = dict(winSize=(15, 15),
+                              maxLevel=2,
+                              criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+        self.flow = FlowCache(self.lk_params)
+
+        # Optional IlluminationNormalizer applied to the grayscale frames before tracking
+        self.illumination = None
+
+        # Optional AsyncTrajectoryWriter recording the tracked points of every frame
+        self.recorder = None
+
+        # Per-stage timings, disabled unless replaced by an enabled Metrics object
+        self.metrics = Metrics()
+
+        # Overlay drawing, batched over all the points
+        self.renderer = Renderer()
+
+        # Preallocated frame buffers, reused by every frame
+        self.buffers = FrameBuffers()
 
     def select_rect(self, event, x, y, flags, param):
         """
@@ -55,42 +102,126 @@ class ZoneDelimiter:
                 self.rect_end = (x, y)
                 self.selecting_rect = False
 
-    def generate_mesh(self, grid_size=10):
+    def zone(self):
+        """
+        Selected rectangle, as (x_min, y_min, x_max, y_max).
+        """
+        x_min, y_min = np.min([self.rect_start, self.rect_end], axis=0)
+        x_max, y_max = np.max([self.rect_start, self.rect_end], axis=0)
+        return int(x_min), int(y_min), int(x_max), int(y_max)
+
+    def generate_mesh(self, grid_size=None):
         """
         Generate a mesh of points within the selected rectangle.
+        The mesh is cached, and only rebuilt when the rectangle or the grid size changes.
+
+        Parameters:
+        - grid_size: Number of points along each axis (defaults to the configured grid size).
+
+        Returns:
+        - Array of shape (grid_size * grid_size, 2) of points within the rectangle, row by row.
+        """
+        grid_size = grid_size or self.grid_size
+        key = (self.rect_start, self.rect_end, grid_size)
+        if self.mesh_cache[0] != key:
+            x_range = np.linspace(self.rect_start[0], self.rect_end[0], grid_size)
+            y_range = np.linspace(self.rect_start[1], self.rect_end[1], grid_size)
+            xs, ys = np.meshgrid(x_range, y_range)
+            points = np.stack([xs.ravel(), ys.ravel()], axis=-1).astype(np.float32)
+            self.mesh_cache = (key, points)
+        return self.mesh_cache[1]
+
+    def track_mesh(self, gray_frame):
+        """
+        Track the whole mesh with a single Lucas-Kanade call, restarting it when the rectangle changes.
+
+        Parameters:
+        - gray_frame: Grayscale image of the frame.
+
+        Returns:
+        - Array of shape (N, 2) of the positions of the live mesh points.
+        """
+        self.flow.update(gray_frame)
+        rect = self.zone()
+        if self.tracked_rect != rect:
+            self.tracked_rect = rect
+            self.tracking_points = self.generate_mesh().reshape(-1, 1, 2).copy()
+            self.lost = np.zeros(len(self.tracking_points), dtype=bool)
+        elif self.flow.ready:
+            live = np.flatnonzero(~self.lost)
+            if live.size:
+                new_points, status, error = self.flow.calc(self.tracking_points[live])
+                found = status.flatten() == 1
+                self.tracking_points[live[found]] = new_points[found]
+                self.lost[live[~found]] = True
+                self.metrics.count('points_tracked', found.sum())
+                self.metrics.count('points_lost', (~found).sum())
+                if self.recorder is not None:
+                    errors = np.full(len(self.tracking_points), np.nan, dtype=np.float32)
+                    errors[live] = error[:, 0]
+                    self.recorder.write(self.tracking_points, ~self.lost, errors)
+        return self.tracking_points[~self.lost].reshape(-1, 2)
+
+    def process(self, frame):
+        """
+        Draw the selected zone, and its mesh if requested, on a single frame.
+        The mesh is advected by dense flow or tracked with Lucas-Kanade if requested.
 
         Parameters:
-        - grid_size: Number of points along each axis.
+        - frame: BGR image captured from the camera.
 
         Returns:
-        - List of points within the rectangle.
+        - The annotated frame.
         """
-        points = []
-        x_range = np.linspace(self.rect_start[0], self.rect_end[0], grid_size)
-        y_range = np.linspace(self.rect_start[1], self.rect_end[1], grid_size)
-        for y in y_range:
-            for x in x_range:
-                points.append((int(x), int(y)))
-        return points
+        if self.rect_start is not None and self.rect_end is not None:
+            tracked_points = None
+            if self.dense is not None or self.track:
+                gray_frame = self.buffers.gray(frame)
+                self.metrics.lap('cvtColor')
+                if self.illumination is not None:
+                    self.illumination.apply(gray_frame)
+                    self.metrics.lap('illumination')
+            if self.dense is not None:
+                # Advect the mesh with the dense flow of the region, restarting it when the region changes
+                if self.dense.rect != self.zone():
+                    self.dense.reset(self.zone(), self.generate_mesh())
+                tracked_points = self.dense.update(gray_frame)
+                self.metrics.lap('denseFlow')
+            elif self.track:
+                tracked_points = self.track_mesh(gray_frame)
+                self.metrics.lap('calcOpticalFlowPyrLK')
+            elif self.mesh:
+                tracked_points = self.generate_mesh()
+
+            # Draw the rectangle and the mesh points on the frame
+            cv2.rectangle(frame, self.rect_start, self.rect_end, (0, 255, 0), 2)
+            if tracked_points is not None:
+                self.renderer.markers(frame, tracked_points, (0, 0, 255), 3)
+            self.metrics.lap('draw')
+        elif self.track:
+            # Keep the previous frame for when the tracking starts
+            gray_frame = self.buffers.gray(frame)
+            if self.illumination is not None:
+                self.illumination.apply(gray_frame)
+            self.flow.update(gray_frame)
+        return frame
 
     def main(self):
         """
         Main function to define zones of interest and display them on the screen.
         """
         while True:
-            _, frame = self.cap.read()
-            if self.rect_start is not None and self.rect_end is not None:
-                # Draw the rectangle on the frame
-                cv2.rectangle(frame, self.rect_start, self.rect_end, (0, 255, 0), 2)
-                if self.mesh:
-                    # Generate and display the mesh points
-                    tracked_points = self.generate_mesh()
-                    for point in tracked_points:
-                        cv2.circle(frame, point, 3, (0, 0, 255), -1)
+            self.metrics.start()
+            _, frame = self.buffers.read(self.cap)
+            self.metrics.lap('read')
+            frame = self.metrics.draw(self.process(frame))
             cv2.imshow('Frame', frame)
             key = cv2.waitKey(1) & 0xFF
+            self.metrics.lap('display')
+            self.metrics.end()
             if key in [ord('q')]:
                 break
+        self.metrics.close()
 
         # Release the video capture and close all windows
         cv2.destroyAllWindows()